@@ -0,0 +1,221 @@
+# Copyright (c) 2026 [謝忠村/Chung Tsun Shieh]. All Rights Reserved.
+# This software is proprietary and confidential.
+# Unauthorized copying of this file, via any medium is strictly prohibited.
+
+# benchmarks/bench_box_filter.py
+# -*- coding: utf-8 -*-
+# Description:
+# 比較 VisionService 答案框過濾 (IoU 去重 + 容器過濾 + 列排序) 的 NumPy 版本與舊版 Python 迴圈。
+# 1. 合成雜訊頁面 (答案框 + 手寫筆跡 + 椒鹽雜訊 + 框內格線)，走完整 _find_boxes_with_cutoff 候選框流程。
+# 2. 隨機候選框 (N = 100 ~ 3000)，只量過濾階段，顯示 O(n^2) 迴圈的成長。
+# 每組都會檢查兩個版本輸出完全相同 (整頁比較固定 config.VISION_PYRAMID=False，與舊版同為全解析度)。
+# 3. 'pyramid' 列：同一頁開啟影像金字塔，比較框數與對應框的最大邊線差 (px)。
+#    全解析度的 boundingRect 會把貼著框線的雜訊點 / 筆跡算進去 (本 fixture 比畫出的框大 4 ~ 21px)，
+#    金字塔則貼齊框線本身 (固定大 3px = 線寬 + dilate)，所以十幾 px 的邊線差是預期的；框數不同才是錯誤。
+#
+# Usage: python -m benchmarks.bench_box_filter [--pages 6] [--repeat 3]
+
+import os
+import sys
+import time
+import argparse
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config  # noqa: E402
+from services.vision_service import VisionService  # noqa: E402
+
+
+# ------------------------------------------------------------------------------
+# Reference: the loop implementation this benchmark replaces
+# ------------------------------------------------------------------------------
+def _legacy_is_inside(boxA, boxB):
+    xa, ya, wa, ha = boxA
+    xb, yb, wb, hb = boxB
+    pad = 5
+    return (xa >= xb - pad) and (ya >= yb - pad) and \
+           ((xa + wa) <= (xb + wb + pad)) and ((ya + ha) <= (yb + hb + pad))
+
+
+def _legacy_compute_iou(boxA, boxB):
+    xA = max(boxA[0], boxB[0])
+    yA = max(boxA[1], boxB[1])
+    xB = min(boxA[0] + boxA[2], boxB[0] + boxB[2])
+    yB = min(boxA[1] + boxA[3], boxB[1] + boxB[3])
+    interArea = max(0, xB - xA) * max(0, yB - yA)
+    boxAArea = boxA[2] * boxA[3]
+    boxBArea = boxB[2] * boxB[3]
+    return interArea / float(boxAArea + boxBArea - interArea + 1e-6)
+
+
+def legacy_filter_and_sort(candidate_boxes):
+    candidate_boxes = list(candidate_boxes)
+    unique_boxes = []
+    candidate_boxes.sort(key=lambda b: b[2] * b[3], reverse=True)
+    keep_indices = [True] * len(candidate_boxes)
+    for i in range(len(candidate_boxes)):
+        if not keep_indices[i]: continue
+        for j in range(i + 1, len(candidate_boxes)):
+            if not keep_indices[j]: continue
+            if _legacy_compute_iou(candidate_boxes[i], candidate_boxes[j]) > 0.8:
+                keep_indices[j] = False
+    for i in range(len(candidate_boxes)):
+        if keep_indices[i]: unique_boxes.append(candidate_boxes[i])
+
+    final_boxes = []
+    for i, boxA in enumerate(unique_boxes):
+        is_inner_box = False
+        for j, boxB in enumerate(unique_boxes):
+            if i == j: continue
+            if _legacy_is_inside(boxA, boxB):
+                if boxB[2] * boxB[3] > boxA[2] * boxA[3] * 1.1:
+                    is_inner_box = True; break
+        if not is_inner_box: final_boxes.append(boxA)
+
+    items = sorted(({'box': b, 'cy': b[1] + b[3] / 2, 'x': b[0]} for b in final_boxes), key=lambda k: k['cy'])
+    if not items: return []
+    rows, current_row = [], [items[0]]
+    for item in items[1:]:
+        if abs(item['cy'] - current_row[0]['cy']) < 50: current_row.append(item)
+        else: rows.append(current_row); current_row = [item]
+    rows.append(current_row)
+    out = []
+    for row in rows:
+        row.sort(key=lambda k: k['x'])
+        out.extend(item['box'] for item in row)
+    return out
+
+
+def vectorized_filter_and_sort(candidate_boxes):
+    arr = np.asarray(candidate_boxes, dtype=np.int64).reshape(-1, 4)
+    if not len(arr): return []
+    final = VisionService._filter_boxes(arr)
+    if not len(final): return []
+    return [tuple(int(v) for v in b) for b in VisionService._sort_reading_order(final)]
+
+
+# ------------------------------------------------------------------------------
+# Fixtures
+# ------------------------------------------------------------------------------
+def synthetic_page(seed: int, w: int = 1654, h: int = 2339) -> np.ndarray:
+    """A4@200dpi 答案卷：答案框、框內格線、筆跡、椒鹽雜訊 (RETR_TREE 會產生大量輪廓)。"""
+    rng = np.random.default_rng(seed)
+    img = np.full((h, w), 255, np.uint8)
+    y = int(h * 0.2)
+    while y < h - 400:
+        bh = int(rng.integers(250, 450))
+        cv2.rectangle(img, (100, y), (w - 100, y + bh), 0, 2)
+        for gy in range(y + 40, y + bh - 10, 40):
+            cv2.line(img, (110, gy), (w - 110, gy), 170, 1)
+        for _ in range(int(rng.integers(10, 40))):
+            p = (int(rng.integers(120, w - 300)), int(rng.integers(y + 10, y + bh - 10)))
+            cv2.line(img, p, (p[0] + int(rng.integers(20, 250)), p[1] + int(rng.integers(-15, 15))), 30, 3)
+        y += bh + int(rng.integers(40, 90))
+    noise = rng.random(img.shape)
+    img[noise < 0.004] = 0
+    img[noise > 0.997] = 255
+    img = cv2.GaussianBlur(img, (3, 3), 0)
+    return img
+
+
+def page_candidates(gray: np.ndarray, cutoff_y: int = 0):
+    """與 _find_boxes_with_cutoff 相同的候選框產生流程。"""
+    thresh = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 15, 2)
+    dilated = cv2.dilate(thresh, np.ones((3, 3), np.uint8), iterations=1)
+    contours, _ = cv2.findContours(dilated, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+    img_h, img_w = gray.shape[:2]
+    out = []
+    for cnt in contours:
+        x, y, w, h = cv2.boundingRect(cnt)
+        if w > img_w * 0.10 and h > img_h * 0.03 and not (w > img_w * 0.96 and h > img_h * 0.96):
+            if x > 5 and y > 5 and (x + w) < img_w - 5 and (y + h) < img_h - 5 and y > cutoff_y:
+                out.append((x, y, w, h))
+    return out, len(contours)
+
+
+def random_candidates(n: int, seed: int):
+    """重疊 / 巢狀的大量候選框 (模擬雜訊掃描在 RETR_TREE 下的最壞情況)。"""
+    rng = np.random.default_rng(seed)
+    base = np.stack([
+        rng.integers(10, 800, n), rng.integers(10, 2000, n),
+        rng.integers(170, 800, n), rng.integers(75, 300, n)
+    ], axis=1)
+    jitter = rng.integers(-4, 5, base.shape)
+    dup = base[: n // 3] + jitter[: n // 3]
+    boxes = np.concatenate([base, dup])[:n]
+    return [tuple(int(v) for v in b) for b in boxes]
+
+
+def _max_edge_delta(a, b) -> float:
+    """Largest border offset between boxes paired by IoU (inf if a box has no IoU > 0.9 partner)."""
+    if len(a) != len(b): return float("inf")
+    if not a: return 0.0
+    arr_a, arr_b = np.asarray(a, np.float64), np.asarray(b, np.float64)
+    iou = VisionService._iou_matrix(np.concatenate([arr_a, arr_b]))[:len(a), len(a):]
+    if (iou.max(axis=1) <= 0.9).any(): return float("inf")
+    edges = lambda r: np.stack([r[:, 0], r[:, 1], r[:, 0] + r[:, 2], r[:, 1] + r[:, 3]], axis=1)
+    return float(np.abs(edges(arr_a) - edges(arr_b[iou.argmax(axis=1)])).max())
+
+
+def _time(fn, arg, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn(arg)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument("--pages", type=int, default=6)
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--sizes", type=str, default="100,300,1000,3000")
+    args = ap.parse_args()
+
+    print(f"{'case':<22}{'contours':>10}{'cands':>8}{'legacy ms':>12}{'numpy ms':>11}{'speedup':>9}  same")
+    for seed in range(args.pages):
+        gray = synthetic_page(seed)
+        cands, n_contours = page_candidates(gray)
+        ref = legacy_filter_and_sort(cands)
+        new = vectorized_filter_and_sort(cands)
+        t_old = _time(legacy_filter_and_sort, cands, args.repeat)
+        t_new = _time(vectorized_filter_and_sort, cands, args.repeat)
+        print(f"{'page ' + str(seed) + ' filter':<22}{n_contours:>10}{len(cands):>8}{t_old*1e3:>12.2f}{t_new*1e3:>11.2f}"
+              f"{t_old / max(t_new, 1e-9):>8.1f}x  {ref == new}")
+
+        # 整頁 (含 threshold / findContours / 候選框篩選)，全解析度
+        legacy_full = lambda g: legacy_filter_and_sort(page_candidates(g)[0])
+        new_full = lambda g: VisionService._find_boxes_with_cutoff(g, 0)
+        pyramid = config.VISION_PYRAMID
+        config.VISION_PYRAMID = False
+        full_boxes = new_full(gray)
+        same = legacy_full(gray) == full_boxes
+        t_old = _time(legacy_full, gray, args.repeat)
+        t_new = _time(new_full, gray, args.repeat)
+        print(f"{'page ' + str(seed) + ' full':<22}{n_contours:>10}{len(cands):>8}{t_old*1e3:>12.2f}{t_new*1e3:>11.2f}"
+              f"{t_old / max(t_new, 1e-9):>8.1f}x  {same}")
+
+        # 影像金字塔：與全解析度比較框數與邊線差
+        config.VISION_PYRAMID = True
+        pyr_boxes = new_full(gray)
+        t_pyr = _time(new_full, gray, args.repeat)
+        config.VISION_PYRAMID = pyramid
+        print(f"{'page ' + str(seed) + ' pyramid':<22}{'-':>10}{len(pyr_boxes):>8}{t_new*1e3:>12.2f}{t_pyr*1e3:>11.2f}"
+              f"{t_new / max(t_pyr, 1e-9):>8.1f}x  boxes {len(full_boxes)}/{len(pyr_boxes)}, "
+              f"max edge delta {_max_edge_delta(full_boxes, pyr_boxes):.0f}px")
+
+    for n in [int(v) for v in args.sizes.split(",") if v]:
+        cands = random_candidates(n, seed=n)
+        ref = legacy_filter_and_sort(cands)
+        new = vectorized_filter_and_sort(cands)
+        t_old = _time(legacy_filter_and_sort, cands, 1 if n > 1000 else args.repeat)
+        t_new = _time(vectorized_filter_and_sort, cands, args.repeat)
+        print(f"{'random n=' + str(n):<22}{'-':>10}{n:>8}{t_old*1e3:>12.2f}{t_new*1e3:>11.2f}"
+              f"{t_old / max(t_new, 1e-9):>8.1f}x  {ref == new}")
+
+
+if __name__ == "__main__":
+    main()
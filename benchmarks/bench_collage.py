@@ -0,0 +1,90 @@
+# Copyright (c) 2026 [謝忠村/Chung Tsun Shieh]. All Rights Reserved.
+# This software is proprietary and confidential.
+# Unauthorized copying of this file, via any medium is strictly prohibited.
+
+# benchmarks/bench_collage.py
+# -*- coding: utf-8 -*-
+# Description:
+# 拼貼圖合成的 micro-benchmark (grids / s)：
+# 1. legacy：每張 np.full 新畫布、逐格 LANCZOS4 拉伸、BGR -> RGB -> PIL -> PNG (原本 AtomicBatchProcessor 的流程)。
+# 2. compositor：CollageCompositor 畫布池 + INTER_AREA letterbox，依拼貼圖的 UploadPolicy (預設 PNG png_level=1) 直接編碼。
+# 分別量「只合成」與「合成 + 編碼」，並列出每張的畫布配置次數與上傳大小。
+#
+# 註：合成後的畫布較平滑 (INTER_AREA + 留白)，zlib level 6 反而比舊流程慢 (0.76-0.98x)；
+#     預設 level 1 合成 + 編碼約 2.2-3x，檔案仍較小。可用 --policy "codec=png,png_level=6" 對照。
+#
+# Usage: python -m benchmarks.bench_collage [--grids 40] [--policy "codec=png,png_level=1"]
+
+import io
+import os
+import sys
+import time
+import argparse
+from typing import Callable, List, Tuple
+
+import cv2
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks.bench_upload_codec import synthetic_answer  # noqa: E402
+from services.upload_policy import UploadPolicy, get_collage_policy  # noqa: E402
+from utils.collage_compositor import CollageCell, CollageCompositor  # noqa: E402
+
+# (name, cols, rows, unit (w, h), gutter, crop size (w, h))
+LAYOUTS = [
+    ("2x2 fixed 1024x600", 2, 2, (1024, 600), 0, (1500, 700)),
+    ("1x16 one-line", 1, 16, (973, 105), 36, (1400, 160)),
+    ("2x2 half-page", 2, 2, (1024, 725), 36, (1500, 1100)),
+]
+
+
+def legacy_grid(crops: List[np.ndarray], cols: int, rows: int, unit: Tuple[int, int], encode: bool):
+    unit_w, unit_h = unit
+    canvas = np.full((rows * unit_h, cols * unit_w, 3), 255, dtype=np.uint8)
+    for idx, img in enumerate(crops[: rows * cols]):
+        x0, y0 = (idx % cols) * unit_w, (idx // cols) * unit_h
+        canvas[y0 : y0 + unit_h, x0 : x0 + unit_w] = cv2.resize(img, (unit_w, unit_h), interpolation=cv2.INTER_LANCZOS4)
+    if not encode: return canvas
+    buf = io.BytesIO()
+    Image.fromarray(cv2.cvtColor(canvas, cv2.COLOR_BGR2RGB)).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def _rate(fn: Callable[[], object], grids: int) -> Tuple[float, object]:
+    fn()  # warm-up (pool / allocator)
+    t0 = time.perf_counter()
+    out = None
+    for _ in range(grids): out = fn()
+    return grids / (time.perf_counter() - t0), out
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument("--grids", type=int, default=40)
+    ap.add_argument("--policy", type=str, default="", help="default: get_collage_policy() (config.COLLAGE_UPLOAD_POLICY)")
+    args = ap.parse_args()
+    policy = UploadPolicy.parse(args.policy) if args.policy else get_collage_policy()
+
+    print(f"policy={policy.describe()}  grids per measurement={args.grids}")
+    print(f"{'layout':<22}{'legacy':>10}{'pooled':>10}{'speedup':>9}{'legacy+enc':>12}{'pooled+enc':>12}"
+          f"{'speedup':>9}{'KB old':>9}{'KB new':>9}{'allocs':>8}")
+    for name, cols, rows, unit, gutter, (cw, ch) in LAYOUTS:
+        crops = [synthetic_answer(i, cw, ch) for i in range(cols * rows)]
+        cells = [CollageCell(img, str(i)) for i, img in enumerate(crops)]
+        comp = CollageCompositor()
+
+        def pooled():
+            canvas = comp.render(cells, cols, rows, unit, gutter)
+            comp.release(canvas)
+
+        r_old, _ = _rate(lambda: legacy_grid(crops, cols, rows, unit, False), args.grids)
+        r_new, _ = _rate(pooled, args.grids)
+        r_old_enc, blob_old = _rate(lambda: legacy_grid(crops, cols, rows, unit, True), args.grids)
+        r_new_enc, enc_new = _rate(lambda: comp.render_encoded(cells, cols, rows, unit, gutter, policy), args.grids)
+        print(f"{name:<22}{r_old:>10.1f}{r_new:>10.1f}{r_new / r_old:>8.2f}x{r_old_enc:>12.1f}{r_new_enc:>12.1f}"
+              f"{r_new_enc / r_old_enc:>8.2f}x{len(blob_old) / 1024:>9.0f}{len(enc_new.data) / 1024:>9.0f}{comp.allocations:>8}")
+
+
+if __name__ == "__main__":
+    main()
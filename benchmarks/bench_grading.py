@@ -0,0 +1,266 @@
+# Copyright (c) 2026 [謝忠村/Chung Tsun Shieh]. All Rights Reserved.
+# This software is proprietary and confidential.
+# Unauthorized copying of this file, via any medium is strictly prohibited.
+
+# benchmarks/bench_grading.py
+# -*- coding: utf-8 -*-
+# Description:
+# GradingService 批改 collage 的請求延遲 (per-call p50 / p95、calls / s、用戶端執行緒數)，比較：
+# 1. fresh：每次請求 new 一個 genai.Client (原本的寫法，每次都重新建立連線)，--workers 條執行緒。
+# 2. pooled：services/genai_clients.py 的 ClientRegistry (每把 Key 一個 Client，keep-alive 連線共用)，--workers 條執行緒。
+# 3. async：agrade_collage 經 services/async_grading.py 的 AsyncScheduler，同時在途 --in-flight 個請求 (client.aio)。
+# LLM 快取停用；請求都經過 services/rate_limiter.py (RPM / TPM bucket + AIMD 並行度)，表中 conc 為結束時的並行度，
+# 並經 services/retry_policy.py 重試 (每個模式一份批次 retry budget)，retry 為重試次數。
+#
+# 預設打本機的 Gemini 假端點 (HTTP/1.1 keep-alive)：每條新連線延遲 --connect-ms (代表 TCP + TLS 握手的來回)，
+# 每個請求再延遲 --service-ms (代表模型推論)，並回報端點實際看到的新連線數。
+# --capacity N：同時超過 N 個請求時回 429 (附 retryDelay)，用來觀察 AIMD 收斂到的並行度。
+# --fail-rate P：以機率 P 回 503，用來觀察退避重試與斷路器。
+# --live 改打真正的 Gemini API (需 GOOGLE_API_KEY；建議用便宜的 --model)，此時只量延遲。
+#
+# Usage:
+#   python -m benchmarks.bench_grading [--calls 128] [--workers 8] [--in-flight 64] [--connect-ms 60] [--service-ms 1500]
+#   python -m benchmarks.bench_grading --capacity 24 --rpm 0        # 模擬額度上限
+#   python -m benchmarks.bench_grading --fail-rate 0.1              # 模擬 5xx
+#   python -m benchmarks.bench_grading --live --model gemini-2.5-flash-lite --calls 16
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from types import SimpleNamespace
+from typing import Callable, Dict, List
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+os.environ["LLM_CACHE_MAX_MB"] = "0"  # 每次都要真的送出請求
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from google import genai  # noqa: E402
+from google.genai import types  # noqa: E402
+from benchmarks.bench_upload_codec import synthetic_answer  # noqa: E402
+from services import rate_limiter  # noqa: E402
+from services.async_grading import AsyncScheduler  # noqa: E402
+from services.genai_clients import ClientRegistry  # noqa: E402
+from services.grading_service import GradingService  # noqa: E402
+from services.retry_policy import new_retry_budget  # noqa: E402
+from services.upload_policy import EncodedImage, UploadPolicy, get_collage_policy  # noqa: E402
+from utils.page_image import PageImage  # noqa: E402
+
+RUBRIC = json.dumps({"questions": [{"id": "1", "score": 4, "rules": [{"rule": "correct result", "score": 4}]}]})
+FAKE_429 = {"error": {"code": 429, "message": "Resource has been exhausted (e.g. check quota).", "status": "RESOURCE_EXHAUSTED",
+                      "details": [{"@type": "type.googleapis.com/google.rpc.RetryInfo", "retryDelay": "1s"}]}}
+FAKE_503 = {"error": {"code": 503, "message": "The model is overloaded. Please try again later.", "status": "UNAVAILABLE"}}
+FAKE_RESPONSE = {
+    "candidates": [{"content": {"role": "model", "parts": [{"text": json.dumps(
+        {"results": [{"index": i, "score": 4, "reasoning": "ok", "breakdown": []} for i in range(4)]})}]},
+        "finishReason": "STOP"}],
+    "usageMetadata": {"promptTokenCount": 1800, "candidatesTokenCount": 120, "totalTokenCount": 1920},
+}
+
+
+class FakeGemini(ThreadingHTTPServer):
+    """
+    Local generateContent endpoint: `connect_s` stall per new connection, `service_s` per request,
+    429 whenever more than `capacity` requests are being served at once (0 = unlimited),
+    503 with probability `fail_rate`.
+    """
+    daemon_threads = True
+    request_queue_size = 256  # 64+ 條連線同時建立時不被 listen backlog 擋下
+
+    def __init__(self, connect_s: float, service_s: float, capacity: int = 0, fail_rate: float = 0.0):
+        self.connect_s = connect_s
+        self.service_s = service_s
+        self.capacity = capacity
+        self.fail_rate = fail_rate
+        self.active = 0
+        self.connections = 0
+        self.requests = 0
+        self.rejected = 0
+        self._count_lock = threading.Lock()
+        super().__init__(("127.0.0.1", 0), _FakeHandler)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/"
+
+    def reset(self):
+        with self._count_lock: self.connections = self.requests = self.rejected = 0
+
+
+class _FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        with self.server._count_lock: self.server.connections += 1
+        time.sleep(self.server.connect_s)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        srv = self.server
+        with srv._count_lock:
+            overloaded = bool(srv.capacity) and srv.active >= srv.capacity
+            if overloaded: srv.rejected += 1
+            else: srv.active += 1
+        if overloaded:
+            status, body = 429, json.dumps(FAKE_429).encode("utf-8")
+        else:
+            time.sleep(srv.service_s)
+            failed = random.random() < srv.fail_rate
+            with srv._count_lock:
+                srv.active -= 1
+                srv.requests += 1
+            if failed: status, body = 503, json.dumps(FAKE_503).encode("utf-8")
+            else: status, body = 200, json.dumps(FAKE_RESPONSE).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def collage_payload(policy: UploadPolicy) -> EncodedImage:
+    """One 2x2 collage-sized upload, encoded once so only the request itself is timed."""
+    canvas = np.vstack([np.hstack([synthetic_answer(r * 2 + c, 1024, 600) for c in range(2)]) for r in range(2)])
+    data, mime = policy.encode(PageImage(canvas, "BGR"))
+    return EncodedImage(data, mime, canvas.shape[1], canvas.shape[0])
+
+
+class ThreadSampler:
+    """Peak number of client-side threads (the fake endpoint's handler threads are excluded)."""
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="bench-sampler", daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            names = [t.name for t in threading.enumerate()]
+            self.peak = max(self.peak, sum(1 for n in names if "process_request" not in n and n != "bench-sampler"))
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def run_mode(get_client: Callable[[str], genai.Client], args, payload: EncodedImage, api_key: str,
+             use_async: bool = False) -> Dict:
+    user = SimpleNamespace(google_api_key=api_key)
+    rate_limiter.get_client = get_client
+    limiter = rate_limiter.get_rate_limiter().get(api_key)
+    rate_start = limiter.stats()
+    latencies: List[float] = []
+    errors = []
+    grade_args = (payload, "1", RUBRIC, user, "Strict", "math", 0.0, args.model)
+    budget = new_retry_budget()
+    grade_kwargs = dict(valid_indices=[0, 1, 2, 3], grid_shape=(2, 2), use_cache=False, retry_budget=budget)
+
+    def record(t0: float, res: Dict):
+        latencies.append(time.perf_counter() - t0)
+        if res.get("error") or not res.get("results"): errors.append(res.get("error", "empty"))
+
+    def one(_):
+        t0 = time.perf_counter()
+        record(t0, GradingService.grade_collage_submission(*grade_args, **grade_kwargs))
+
+    async def aone():
+        t0 = time.perf_counter()
+        record(t0, await GradingService.agrade_collage(*grade_args, **grade_kwargs))
+
+    t0 = time.perf_counter()
+    with ThreadSampler() as sampler:
+        if use_async:
+            with AsyncScheduler(args.in_flight) as sched:
+                for _ in range(args.calls): sched.submit(aone)
+            peak = sched.peak_in_flight
+        else:
+            with ThreadPoolExecutor(max_workers=args.workers) as ex:
+                list(ex.map(one, range(args.calls)))
+            peak = args.workers
+    wall = time.perf_counter() - t0
+    ms = 1e3 * np.array(latencies)
+    rate_end = limiter.stats()
+    return {"p50": float(np.percentile(ms, 50)), "p95": float(np.percentile(ms, 95)), "rate": args.calls / wall,
+            "in_flight": peak, "threads": sampler.peak, "errors": len(errors), "first_error": errors[0] if errors else "",
+            "concurrency": rate_end["concurrency"], "throttled": rate_end["throttled"] - rate_start["throttled"],
+            "retries": budget.retries}
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument("--calls", type=int, default=128)
+    ap.add_argument("--workers", type=int, default=8, help="threads for the fresh / pooled modes")
+    ap.add_argument("--in-flight", type=int, default=64, help="concurrent requests for the async mode")
+    ap.add_argument("--connect-ms", type=float, default=60.0, help="fake endpoint: stall per new connection")
+    ap.add_argument("--service-ms", type=float, default=1500.0, help="fake endpoint: stall per request")
+    ap.add_argument("--capacity", type=int, default=0, help="fake endpoint: 429 above this many concurrent requests")
+    ap.add_argument("--fail-rate", type=float, default=0.0, help="fake endpoint: fraction of requests answered with 503")
+    ap.add_argument("--rpm", type=int, default=0, help="limiter RPM per key (0 = unmetered)")
+    ap.add_argument("--tpm", type=int, default=0, help="limiter TPM per key (0 = unmetered)")
+    ap.add_argument("--max-connections", type=int, default=64)
+    ap.add_argument("--max-keepalive", type=int, default=64)
+    ap.add_argument("--live", action="store_true", help="call the real Gemini API (GOOGLE_API_KEY)")
+    ap.add_argument("--model", type=str, default="gemini-2.5-flash")
+    ap.add_argument("--policy", type=str, default=None, help="UploadPolicy spec of the payload (default: config.UPLOAD_POLICY)")
+    args = ap.parse_args()
+    import config
+    config.RATE_LIMIT_RPM, config.RATE_LIMIT_TPM, config.GRADING_MAX_IN_FLIGHT = args.rpm, args.tpm, args.in_flight
+
+    server = None
+    if args.live:
+        api_key = os.getenv("GOOGLE_API_KEY", "")
+        if not api_key: sys.exit("--live needs GOOGLE_API_KEY.")
+        base_url = None
+    else:
+        api_key = "bench-key"
+        server = FakeGemini(args.connect_ms / 1e3, args.service_ms / 1e3, args.capacity, args.fail_rate)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = server.base_url
+
+    payload = collage_payload(UploadPolicy.parse(args.policy) if args.policy else get_collage_policy())
+    registry = ClientRegistry(max_connections=args.max_connections, max_keepalive=args.max_keepalive, base_url=base_url)
+    fresh_clients: List[genai.Client] = []  # 保留參考：Client 被回收時會關閉自己的 httpx 連線池
+
+    def fresh(key: str) -> genai.Client:
+        client = genai.Client(api_key=key, http_options=types.HttpOptions(base_url=base_url))
+        fresh_clients.append(client)
+        return client
+
+    modes = [("fresh", fresh, False), ("pooled", registry.get, False), ("async", registry.get, True)]
+
+    target = "live Gemini API" if args.live else f"fake endpoint (connect {args.connect_ms:.0f} ms, service {args.service_ms:.0f} ms)"
+    print(f"{target}; {args.calls} calls; payload {len(payload.data) / 1024:.0f} KB {payload.mime_type}")
+    print(f"{'mode':<8}{'p50 ms':>9}{'p95 ms':>9}{'calls/s':>9}{'in flight':>11}{'threads':>9}{'conns':>7}"
+          f"{'conc':>6}{'429':>6}{'retry':>7}{'errors':>8}")
+    for name, factory, use_async in modes:
+        if server: server.reset()
+        # 假端點：每個模式用自己的 Key，AIMD 狀態不互相影響
+        key = api_key if args.live else f"{api_key}-{name}"
+        r = run_mode(factory, args, payload, key, use_async)
+        conns = str(server.connections) if server else "-"
+        print(f"{name:<8}{r['p50']:>9.1f}{r['p95']:>9.1f}{r['rate']:>9.1f}{r['in_flight']:>11}{r['threads']:>9}{conns:>7}"
+              f"{r['concurrency']:>6}{r['throttled']:>6}{r['retries']:>7}{r['errors']:>8}")
+        if r["first_error"]: print(f"        first error: {r['first_error'][:160]}")
+    print(f"registry: {registry.stats()}")
+    registry.close_all()
+    for client in fresh_clients: client.close()
+    if server: server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
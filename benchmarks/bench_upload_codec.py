@@ -0,0 +1,187 @@
+# Copyright (c) 2026 [謝忠村/Chung Tsun Shieh]. All Rights Reserved.
+# This software is proprietary and confidential.
+# Unauthorized copying of this file, via any medium is strictly prohibited.
+
+# benchmarks/bench_upload_codec.py
+# -*- coding: utf-8 -*-
+# Description:
+# 比較 UploadPolicy 各設定 (codec / quality / gray / bilevel / max_long_edge) 送往 Gemini 的成本：
+# 1. 編碼時間、上傳位元組 (每張平均，並列出相對基準 PNG 的倍數)。
+# 2. 離線保真度：解碼後 (放大回原尺寸) 與原圖的筆跡二值化 F1 (ink F1)，低於 0.9 代表細筆畫開始流失。
+# 3. 評分一致性 (--grade，需 GOOGLE_API_KEY)：對 fixtures.json 裡錄好的基準分數重新批改，
+#    回報 |Δscore| <= 容許值 的比例與平均誤差。先以 --record 用基準設定 (全彩 PNG) 錄製分數。
+#
+# fixtures.json (放在 --fixtures 目錄)：
+#   [{"image": "q3_s01.png", "question_id": "3", "rubric": "...", "score": 4.0}, ...]
+# 沒有 --fixtures 時使用合成的手寫答案卷 (只量 1、2 兩項)。
+#
+# Usage:
+#   python -m benchmarks.bench_upload_codec [--fixtures DIR] [--policies "codec=jpeg,quality=80,color=gray;..."]
+#   python -m benchmarks.bench_upload_codec --fixtures DIR --record      # 錄製基準分數
+#   python -m benchmarks.bench_upload_codec --fixtures DIR --grade       # 評分一致性
+
+import os
+import sys
+import json
+import time
+import argparse
+from types import SimpleNamespace
+from typing import Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from services.upload_policy import UploadPolicy  # noqa: E402
+from utils.page_image import PageImage  # noqa: E402
+
+BASELINE = "codec=png,color=color"
+DEFAULT_POLICIES = [
+    BASELINE,
+    "codec=png,color=gray",
+    "codec=png,color=bilevel",
+    "codec=jpeg,quality=90,color=color",
+    "codec=jpeg,quality=85,color=gray",
+    "codec=jpeg,quality=70,color=gray",
+    "codec=webp,quality=80,color=gray",
+    "codec=jpeg,quality=85,color=gray,max_long_edge=1600",
+    "codec=webp,quality=80,color=gray,max_long_edge=1200",
+]
+
+
+# ------------------------------------------------------------------------------
+# Fixtures
+# ------------------------------------------------------------------------------
+def synthetic_answer(seed: int, w: int = 1500, h: int = 700) -> np.ndarray:
+    """掃描風格的手寫答案區：米色紙、格線、不同粗細 / 深淺的筆畫 (含淡鉛筆)、掃描雜訊。"""
+    rng = np.random.default_rng(seed)
+    img = np.empty((h, w, 3), np.uint8)
+    img[:] = (226, 238, 244)  # BGR 米色紙
+    for gy in range(60, h - 20, 55):
+        cv2.line(img, (20, gy), (w - 20, gy), (205, 195, 190), 1)
+    cv2.rectangle(img, (8, 8), (w - 8, h - 8), (40, 40, 40), 2)
+    for _ in range(int(rng.integers(25, 45))):
+        x, y = int(rng.integers(40, w - 200)), int(rng.integers(40, h - 60))
+        pts = [(x, y)]
+        for _ in range(int(rng.integers(4, 14))):
+            x += int(rng.integers(4, 22)); y += int(rng.integers(-12, 13))
+            pts.append((x, y))
+        shade = int(rng.choice([30, 60, 110, 150]))  # 150 = 淡鉛筆
+        cv2.polylines(img, [np.array(pts, np.int32)], False, (shade, shade, shade + 10), int(rng.integers(1, 4)), cv2.LINE_AA)
+    img = cv2.GaussianBlur(img, (3, 3), 0)
+    return np.clip(img.astype(np.int16) + rng.normal(0, 4, img.shape), 0, 255).astype(np.uint8)
+
+
+def load_fixtures(path: Optional[str]) -> Tuple[List[Tuple[str, np.ndarray]], List[Dict]]:
+    if not path:
+        return [(f"synthetic_{i}", synthetic_answer(i)) for i in range(6)], []
+    records = []
+    manifest = os.path.join(path, "fixtures.json")
+    if os.path.exists(manifest):
+        with open(manifest, "r", encoding="utf-8") as f: records = json.load(f)
+    names = [r["image"] for r in records] or sorted(
+        n for n in os.listdir(path) if n.lower().endswith((".png", ".jpg", ".jpeg", ".webp", ".tif", ".tiff")))
+    images = []
+    for name in names:
+        img = cv2.imread(os.path.join(path, name), cv2.IMREAD_COLOR)
+        if img is not None: images.append((name, img))
+    return images, records
+
+
+# ------------------------------------------------------------------------------
+# Measurements
+# ------------------------------------------------------------------------------
+def _ink(gray: np.ndarray) -> np.ndarray:
+    return cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY_INV, 31, 15) > 0
+
+
+def ink_f1(original_bgr: np.ndarray, blob: bytes) -> float:
+    decoded = cv2.imdecode(np.frombuffer(blob, np.uint8), cv2.IMREAD_UNCHANGED)
+    if decoded.ndim == 3: decoded = cv2.cvtColor(decoded, cv2.COLOR_BGR2GRAY)  # 與原圖同一套灰階權重
+    ref = cv2.cvtColor(original_bgr, cv2.COLOR_BGR2GRAY)
+    if decoded.shape != ref.shape:
+        decoded = cv2.resize(decoded, (ref.shape[1], ref.shape[0]), interpolation=cv2.INTER_LINEAR)
+    a, b = _ink(ref), _ink(decoded)
+    tp = float(np.count_nonzero(a & b))
+    denom = np.count_nonzero(a) + np.count_nonzero(b)
+    return 2 * tp / denom if denom else 1.0
+
+
+def measure_encoding(policy: UploadPolicy, images: List[Tuple[str, np.ndarray]], repeat: int) -> Dict:
+    times, sizes, f1s = [], [], []
+    for _, img in images:
+        page = PageImage(img, "BGR")
+        best = float("inf")
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            blob, _ = policy.encode(page)
+            best = min(best, time.perf_counter() - t0)
+        times.append(best); sizes.append(len(blob)); f1s.append(ink_f1(img, blob))
+    return {"ms": 1e3 * float(np.mean(times)), "kb": float(np.mean(sizes)) / 1024, "ink_f1": float(np.min(f1s))}
+
+
+def grade_fixture(image: np.ndarray, record: Dict, policy: UploadPolicy, api_key: str, model: str) -> Optional[float]:
+    from services.grading_service import GradingService
+    user = SimpleNamespace(google_api_key=api_key)
+    res = GradingService.grade_submission(
+        images=[PageImage(image, "BGR")], rubric_text=record["rubric"], user=user, batch_id="bench_upload_codec",
+        student_idx=0, mode="Strict", model_id=model, allowed_labels=[str(record["question_id"])],
+        upload_policy=policy
+    )
+    if not res.get("questions"): return None
+    return float(res.get("total_score", 0.0))
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument("--fixtures", type=str, default=None)
+    ap.add_argument("--policies", type=str, default=None, help="';'-separated UploadPolicy specs")
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--record", action="store_true", help="grade with the baseline policy and store the scores")
+    ap.add_argument("--grade", action="store_true", help="re-grade every fixture with every policy")
+    ap.add_argument("--tolerance", type=float, default=0.5)
+    ap.add_argument("--model", type=str, default="gemini-2.5-pro")
+    args = ap.parse_args()
+
+    images, records = load_fixtures(args.fixtures)
+    if not images: sys.exit("No fixtures found.")
+    specs = [s for s in (args.policies.split(";") if args.policies else DEFAULT_POLICIES) if s.strip()]
+    policies = [UploadPolicy.parse(s) for s in specs]
+
+    api_key = os.getenv("GOOGLE_API_KEY", "")
+    if (args.record or args.grade) and (not api_key or not args.fixtures):
+        sys.exit("--record / --grade need --fixtures and GOOGLE_API_KEY.")
+
+    if args.record:
+        by_name = dict(images)
+        for rec in records:
+            rec["score"] = grade_fixture(by_name[rec["image"]], rec, UploadPolicy.parse(BASELINE), api_key, args.model)
+            print(f"recorded {rec['image']}: {rec['score']}")
+        with open(os.path.join(args.fixtures, "fixtures.json"), "w", encoding="utf-8") as f:
+            json.dump(records, f, ensure_ascii=False, indent=2)
+        return
+
+    print(f"{len(images)} fixture(s), encode time = best of {args.repeat}")
+    header = f"{'policy':<54}{'enc ms':>9}{'KB/img':>10}{'vs base':>10}{'ink F1':>8}"
+    if args.grade: header += f"{'agree':>8}{'mean|Δ|':>9}"
+    print(header)
+    base_kb = None
+    for policy in policies:
+        m = measure_encoding(policy, images, args.repeat)
+        if base_kb is None: base_kb = m["kb"]
+        line = f"{policy.describe():<54}{m['ms']:>9.1f}{m['kb']:>10.1f}{m['kb'] / base_kb:>9.3f}x{m['ink_f1']:>8.3f}"
+        if args.grade:
+            by_name = dict(images)
+            deltas = []
+            for rec in records:
+                if rec.get("score") is None: continue
+                score = grade_fixture(by_name[rec["image"]], rec, policy, api_key, args.model)
+                deltas.append(abs(score - rec["score"]) if score is not None else float("inf"))
+            finite = [d for d in deltas if np.isfinite(d)]
+            agree = sum(d <= args.tolerance for d in deltas) / max(1, len(deltas))
+            line += f"{agree:>8.0%}{(np.mean(finite) if finite else float('nan')):>9.2f}"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+# Copyright (c) 2026 [謝忠村/Chung Tsun Shieh]. All Rights Reserved.
+# This software is proprietary and confidential.
+# Unauthorized copying of this file, via any medium is strictly prohibited.
+
+# benchmarks/bench_vision_pyramid.py
+# -*- coding: utf-8 -*-
+# Description:
+# 影像金字塔 (config.VISION_PYRAMID) 與全解析度偵測的準確度 / 速度比較。
+# 1. 定位點：_find_markers 兩種模式的中心點最大偏差 (px)。
+# 2. 答案框：同一張對齊後頁面上，_find_boxes_with_cutoff 兩種模式各自對正解框的召回率，
+#    以及兩者配對框的最大邊線偏差 (px)。
+# 3. 夾具：合成 A4@200dpi 考卷 (傾斜 / 雜訊 / JPEG / 模糊 / 150dpi 掃描)，或 --fixtures 目錄下的實際掃描圖
+#    (實際掃描沒有正解，只比較兩種模式)。
+# 超出容許誤差時以 exit code 1 結束，可當作回歸檢查。
+#
+# Usage: python -m benchmarks.bench_vision_pyramid [--seeds 3] [--fixtures DIR] [--repeat 3]
+
+import os
+import sys
+import time
+import argparse
+from typing import List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config  # noqa: E402
+from services.vision_service import VisionService, ALIGNED_WIDTH, ALIGNED_HEIGHT  # noqa: E402
+
+MARKER_TOL_PX = 1.5       # pyramid vs full-resolution marker centres
+BOX_TOL_PX = 3            # pyramid vs full-resolution box edges
+TRUTH_TOL_PX = 6          # detected box (outer edge of the dilated border) vs drawn rectangle
+
+
+# ------------------------------------------------------------------------------
+# Fixtures
+# ------------------------------------------------------------------------------
+VARIANTS = {
+    "clean":   dict(angle=0.0, noise=0, jpeg=0, blur=0, dpi=200),
+    "skew":    dict(angle=0.8, noise=6, jpeg=0, blur=0, dpi=200),
+    "jpeg":    dict(angle=-0.5, noise=4, jpeg=60, blur=0, dpi=200),
+    "blur":    dict(angle=0.3, noise=6, jpeg=0, blur=5, dpi=200),
+    "150dpi":  dict(angle=1.2, noise=6, jpeg=75, blur=0, dpi=150),
+}
+
+
+def synthetic_page(seed: int, page: int, angle: float, noise: int, jpeg: int, blur: int, dpi: int):
+    """
+    Returns (gray page, ground-truth answer boxes in raw-page pixels).
+    定位方塊用 0.6 cm：全解析度輪廓掃描的面積下限 (頁面 0.05%) 會濾掉 200dpi 下更小的方塊。
+    """
+    import qrcode
+    rng = np.random.default_rng(seed * 10 + page)
+    w, h = ALIGNED_WIDTH, ALIGNED_HEIGHT
+    cm = w / 21.0
+    img = np.full((h, w), 255, np.uint8)
+    s = int(0.6 * cm)
+    for x, y in [(0.5, 0.5), (20.5 - 0.6, 0.5), (0.5, 29.2 - 0.6), (20.5 - 0.6, 29.2 - 0.6)]:
+        cv2.rectangle(img, (int(x * cm), int(y * cm)), (int(x * cm) + s, int(y * cm) + s), 0, -1)
+
+    q = np.array(qrcode.make(f"EXAM_BENCH{seed}-P{page}", box_size=4, border=2).convert("L"))
+    q = cv2.resize(q, (int(1.6 * cm), int(1.6 * cm)), interpolation=cv2.INTER_NEAREST)
+    qx, qy = int(w - 3.5 * cm), int(h - 3.0 * cm)
+    img[qy:qy + q.shape[0], qx:qx + q.shape[1]] = q
+    if page == 1:
+        cv2.putText(img, "Name: ________  ID: ________", (int(2 * cm), int(2.5 * cm)), cv2.FONT_HERSHEY_SIMPLEX, 1.4, 0, 2)
+
+    boxes = []
+    y = int(h * (0.22 if page == 1 else 0.06))
+    while True:
+        bh = int(rng.integers(int(3 * cm), int(6 * cm)))
+        if y + bh > h - 3.5 * cm: break
+        bx, bw = int(1.2 * cm), int(w - 2.4 * cm)
+        cv2.rectangle(img, (bx, y), (bx + bw, y + bh), 0, 2)
+        for gy in range(y + 50, y + bh - 10, 50):  # 作答格線
+            cv2.line(img, (bx + 10, gy), (bx + bw - 10, gy), 190, 1)
+        for _ in range(int(rng.integers(5, 25))):  # 手寫筆跡
+            p = (int(rng.integers(bx + 20, bx + bw - 400)), int(rng.integers(y + 20, y + bh - 20)))
+            cv2.line(img, p, (p[0] + int(rng.integers(30, 380)), p[1] + int(rng.integers(-15, 15))), 40, 3)
+        boxes.append((bx, y, bw, bh))
+        y += bh + int(rng.integers(int(0.5 * cm), int(1.2 * cm)))
+
+    A = cv2.getRotationMatrix2D((w / 2, h / 2), angle, 0.97)
+    img = cv2.warpAffine(img, A, (w, h), borderValue=255)
+    if blur: img = cv2.GaussianBlur(img, (blur, blur), 0)
+    if noise: img = np.clip(img.astype(np.int16) + rng.normal(0, noise, img.shape), 0, 255).astype(np.uint8)
+    if dpi != 200:
+        f = dpi / 200.0
+        img = cv2.resize(img, None, fx=f, fy=f, interpolation=cv2.INTER_AREA)
+        A = np.vstack([A, [0, 0, 1]]); A = (np.diag([f, f, 1.0]) @ A)[:2]
+    if jpeg: img = cv2.imdecode(cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, jpeg])[1], cv2.IMREAD_GRAYSCALE)
+
+    gt = []
+    for bx, by, bw, bh in boxes:
+        pts = np.array([[bx, by], [bx + bw, by], [bx + bw, by + bh], [bx, by + bh]], np.float32)
+        gt.append(cv2.transform(pts[None], A)[0])
+    return img, gt
+
+
+def load_fixtures(path: str) -> List[Tuple[str, np.ndarray]]:
+    out = []
+    for name in sorted(os.listdir(path)):
+        if name.lower().endswith((".png", ".jpg", ".jpeg", ".tif", ".tiff")):
+            img = cv2.imread(os.path.join(path, name), cv2.IMREAD_GRAYSCALE)
+            if img is not None: out.append((name, img))
+    return out
+
+
+# ------------------------------------------------------------------------------
+# Measurements
+# ------------------------------------------------------------------------------
+def _run(pyramid: bool, fn, *args, repeat: int = 1):
+    config.VISION_PYRAMID = pyramid
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn(*args)
+        best = min(best, time.perf_counter() - t0)
+    return best, result
+
+
+def _recall(found: List[Tuple], truth: List[Tuple]) -> Optional[float]:
+    if truth is None: return None
+    if not truth: return 1.0
+    if not found: return 0.0
+    iou = VisionService._iou_matrix(np.asarray(list(truth) + list(found), dtype=np.float64))[:len(truth), len(truth):]
+    return float((iou.max(axis=1) > 0.9).mean())
+
+
+def _box_deviation(a: List[Tuple], b: List[Tuple]) -> Tuple[int, float]:
+    """(# pairs with IoU > 0.9, max edge offset of those pairs in px)"""
+    if not a or not b: return 0, 0.0
+    arr_a, arr_b = np.asarray(a, np.float64), np.asarray(b, np.float64)
+    iou = VisionService._iou_matrix(np.concatenate([arr_a, arr_b]))[:len(a), len(a):]
+    pairs = [(i, int(np.argmax(iou[i]))) for i in range(len(a)) if iou[i].max() > 0.9]
+    if not pairs: return 0, 0.0
+    edges = lambda r: np.array([r[0], r[1], r[0] + r[2], r[1] + r[3]])
+    return len(pairs), float(max(np.abs(edges(arr_a[i]) - edges(arr_b[j])).max() for i, j in pairs))
+
+
+def evaluate(name: str, gray: np.ndarray, gt_raw: Optional[List[np.ndarray]], repeat: int) -> bool:
+    forbidden = VisionService.analyze_page(gray, find_markers=False).forbidden_rects()  # 與 analyze_page 相同：排除 QR / 條碼
+    t_mf, markers_full = _run(False, VisionService._find_markers, gray, forbidden, repeat=repeat)
+    t_mp, markers_pyr = _run(True, VisionService._find_markers, gray, forbidden, repeat=repeat)
+    if markers_full is None or markers_pyr is None:
+        marker_err = 0.0 if markers_full is None and markers_pyr is None else float("inf")
+    else:
+        marker_err = float(np.abs(np.asarray(markers_full) - np.asarray(markers_pyr)).max())
+
+    # 兩種模式都在「全解析度定位點」對齊後的同一張頁面上找框
+    if markers_full is not None:
+        M = cv2.getPerspectiveTransform(np.asarray(markers_full, np.float32), VisionService._aligned_corners())
+        page = cv2.warpPerspective(gray, M, (ALIGNED_WIDTH, ALIGNED_HEIGHT), borderValue=255)
+    else:
+        M, page = None, gray
+    truth = None
+    if gt_raw is not None and M is not None:
+        truth = [cv2.boundingRect(cv2.perspectiveTransform(q.reshape(-1, 1, 2), M).astype(np.float32)) for q in gt_raw]
+
+    cutoff = int(page.shape[0] * 0.005)
+    t_bf, boxes_full = _run(False, VisionService._find_boxes_with_cutoff, page, cutoff, repeat=repeat)
+    t_bp, boxes_pyr = _run(True, VisionService._find_boxes_with_cutoff, page, cutoff, repeat=repeat)
+    rec_f, rec_p = _recall(boxes_full, truth), _recall(boxes_pyr, truth)
+    n_pairs, box_err = _box_deviation(boxes_full, boxes_pyr)
+
+    ok = marker_err <= MARKER_TOL_PX and box_err <= BOX_TOL_PX
+    if truth is not None:
+        ok &= rec_p >= rec_f
+        truth_pairs, truth_err = _box_deviation(truth, boxes_pyr)
+        ok &= truth_pairs == len(truth) and truth_err <= TRUTH_TOL_PX
+    fmt = lambda v: "-" if v is None else f"{v:.2f}"
+    print(f"{name:<18}{t_mf*1e3:>9.1f}{t_mp*1e3:>9.1f}{marker_err:>8.2f}"
+          f"{t_bf*1e3:>9.1f}{t_bp*1e3:>9.1f}{len(boxes_full):>6}{len(boxes_pyr):>6}{n_pairs:>6}{box_err:>7.1f}"
+          f"{fmt(rec_f):>7}{fmt(rec_p):>7}  {'ok' if ok else 'FAIL'}")
+    return ok
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument("--seeds", type=int, default=3)
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--fixtures", type=str, default=None, help="directory of scanned pages (png/jpg/tif)")
+    args = ap.parse_args()
+
+    print(f"scale={getattr(config, 'VISION_PYRAMID_SCALE', 0.25)}  tolerances: markers {MARKER_TOL_PX}px, boxes {BOX_TOL_PX}px")
+    print(f"{'case':<18}{'mk full':>9}{'mk pyr':>9}{'mk err':>8}{'bx full':>9}{'bx pyr':>9}"
+          f"{'#full':>6}{'#pyr':>6}{'pairs':>6}{'bx err':>7}{'rec f':>7}{'rec p':>7}")
+    all_ok = True
+    if args.fixtures:
+        for name, gray in load_fixtures(args.fixtures):
+            all_ok &= evaluate(name[:17], gray, None, args.repeat)
+    else:
+        for seed in range(args.seeds):
+            for variant, params in VARIANTS.items():
+                for page in (1, 2):
+                    gray, gt = synthetic_page(seed, page, **params)
+                    all_ok &= evaluate(f"s{seed} {variant} p{page}", gray, gt, args.repeat)
+    print("PASS" if all_ok else "FAIL")
+    sys.exit(0 if all_ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,9 @@
+# Copyright (c) 2026 [謝忠村/Chung Tsun Shieh]. All Rights Reserved.
+# This software is proprietary and confidential.
+# Unauthorized copying of this file, via any medium is strictly prohibited.
+
+import sys
+
+from benchmarks.vision.run import main
+
+sys.exit(main())
@@ -0,0 +1,277 @@
+# Copyright (c) 2026 [謝忠村/Chung Tsun Shieh]. All Rights Reserved.
+# This software is proprietary and confidential.
+# Unauthorized copying of this file, via any medium is strictly prohibited.
+
+# benchmarks/vision/fixtures.py
+# -*- coding: utf-8 -*-
+# Description:
+# 合成的「掃描後」考卷：一份考卷 (固定版面) × 多位學生 × 每人數頁，每張附對齊 frame 中的正解答案框。
+# 1. 版面來源 (source)：
+#    - "examgen"：ExamBuilder 產生 LaTeX、xelatex 編譯、poppler 點陣化；正解取自編譯時的 layout manifest。
+#    - "synthetic"：不需 TeX 的近似版面 (同樣的定位方塊 / 頁首 / 學生資料框 / 題幹 + 0.8pt 答案框 / 右下 QR)。
+#    - "auto"：有 xelatex 與 pdftoppm 時用 examgen，否則 synthetic。
+# 2. 每位學生：答案框內加手寫風格筆跡 (部分留白)，再依 DEGRADATIONS 循環套用掃描失真
+#    (傾斜 / 透視 / 模糊 / 雜訊 / JPEG / 150dpi / 紙色與陰影)。
+# 正解框固定在對齊 frame (cm_to_aligned)，與掃描失真無關：對齊後偵測到的框直接與其比較。
+
+import os
+import shutil
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from services.vision_service import (
+    PAPER_W_CM, PAPER_H_CM, MARKER_OFFSET_CM, MARKER_SIZE_CM, ARUCO_DICT_NAME, ARUCO_IDS, ARUCO_SIZE_CM,
+    cm_to_aligned, aligned_to_cm, aruco_marker_origin_cm
+)
+
+RENDER_DPI = 200
+MARGIN_CM = 1.2             # ExamBuilder geometry: left = right = 1.2cm
+BOX_RULE_CM = 0.8 / 72.27 * 2.54
+QR_CM, QR_RIGHT_CM, QR_BOTTOM_CM = 1.3, 2.0, 1.5
+FIDUCIALS = ("aruco", "squares")   # ExamBuilder use_aruco=True / False
+
+# name -> scan distortion (angle: deg, perspective: corner jitter in cm, blur: kernel, noise: sigma,
+#                          jpeg: quality, dpi: scan resolution, shade: paper tint / shadow strength)
+DEGRADATIONS: Dict[str, Dict] = {
+    "clean":       dict(angle=0.0, perspective=0.0, blur=0, noise=2, jpeg=0, dpi=200, shade=0.0),
+    "skew":        dict(angle=1.5, perspective=0.0, blur=0, noise=5, jpeg=0, dpi=200, shade=0.1),
+    "perspective": dict(angle=-0.6, perspective=0.25, blur=0, noise=5, jpeg=85, dpi=200, shade=0.2),
+    "blur":        dict(angle=0.4, perspective=0.0, blur=5, noise=6, jpeg=0, dpi=200, shade=0.1),
+    "noisy_jpeg":  dict(angle=-1.0, perspective=0.1, blur=0, noise=10, jpeg=55, dpi=200, shade=0.3),
+    "150dpi":      dict(angle=0.8, perspective=0.1, blur=3, noise=6, jpeg=75, dpi=150, shade=0.2),
+}
+
+
+@dataclass
+class ScanPage:
+    name: str
+    student: int
+    page: int                       # 1-based page of the answer sheet
+    degradation: str
+    image: np.ndarray               # BGR scan
+    truth: List[Tuple[int, int, int, int]]   # answer boxes (x, y, w, h) in the aligned frame
+    labels: List[str]
+
+
+def _px(cm: float, dpi: int = RENDER_DPI) -> int:
+    return int(round(cm / 2.54 * dpi))
+
+
+def _paper(dpi: int = RENDER_DPI) -> np.ndarray:
+    return np.full((_px(PAPER_H_CM, dpi), _px(PAPER_W_CM, dpi)), 255, np.uint8)
+
+
+def _aligned_box_to_paper(box, dpi: int = RENDER_DPI) -> Tuple[int, int, int, int]:
+    x, y, w, h = box
+    x0, y0 = aligned_to_cm(x, y)
+    x1, y1 = aligned_to_cm(x + w, y + h)
+    return _px(x0, dpi), _px(y0, dpi), _px(x1, dpi), _px(y1, dpi)
+
+
+# ------------------------------------------------------------------------------
+# Layout sources
+# ------------------------------------------------------------------------------
+def examgen_available() -> bool:
+    return bool(shutil.which("xelatex") and shutil.which("pdftoppm"))
+
+
+def _questions(seed: int, count: int) -> List[Dict]:
+    rng = np.random.default_rng(seed)
+    return [{"text": f"Question {i + 1}: explain and compute the value asked for in part {i + 1}.",
+             "score": int(rng.integers(2, 11)), "height": float(rng.choice([3, 4, 5, 6]))} for i in range(count)]
+
+
+def examgen_layout(seed: int = 0, questions: int = 8, exam_id: str = "EXAM_BENCHVIS",
+                   fiducials: str = "aruco") -> Optional[List[Tuple[np.ndarray, List, List]]]:
+    """
+    Renders an answer sheet with ExamBuilder -> [(gray page @ RENDER_DPI, truth boxes, labels)] or None when
+    xelatex / poppler are missing or compilation fails.
+    """
+    if not examgen_available(): return None
+    from pdf2image import convert_from_bytes
+    from services.exam_gen_service import ExamBuilder
+
+    builder = ExamBuilder()
+    header = {"title": "Vision Benchmark", "subject": "Math", "exam_id": exam_id, "layout_mode": "combined",
+              "use_aruco": fiducials == "aruco"}
+    source = builder.generate_tex_source(header, _questions(seed, questions), exam_uuid=exam_id)
+    pdf = builder.compile_tex_to_pdf(source, exam_id, exam_id, None)
+    manifest = builder.last_layout_manifest
+    if not pdf or not manifest: return None
+
+    pages = []
+    for i, img in enumerate(convert_from_bytes(pdf, dpi=RENDER_DPI, grayscale=True), start=1):
+        entries = manifest.get("pages", {}).get(str(i), [])
+        pages.append((np.asarray(img.convert("L")).copy(), [tuple(e["box"]) for e in entries], [e["label"] for e in entries]))
+    return pages
+
+
+def _qr(content: str, side: int) -> np.ndarray:
+    """Same symbol as ExamBuilder._generate_qr_file (ECC M, 2-module border), printed `side` px wide."""
+    import qrcode
+    qr = qrcode.QRCode(version=None, error_correction=qrcode.constants.ERROR_CORRECT_M, box_size=10, border=2)
+    qr.add_data(content); qr.make(fit=True)
+    q = np.array(qr.make_image(fill_color="black", back_color="white").convert("L"))
+    return cv2.resize(q, (side, side), interpolation=cv2.INTER_AREA)
+
+
+def _draw_fiducials(img: np.ndarray, fiducials: str) -> None:
+    if fiducials == "aruco":
+        dictionary = cv2.aruco.getPredefinedDictionary(getattr(cv2.aruco, ARUCO_DICT_NAME))
+        side = _px(ARUCO_SIZE_CM)
+        for marker_id in ARUCO_IDS:
+            x, y = (_px(v) for v in aruco_marker_origin_cm(marker_id))
+            img[y:y + side, x:x + side] = cv2.aruco.generateImageMarker(dictionary, marker_id, side, borderBits=1)
+        return
+    far_x, far_y = PAPER_W_CM - MARKER_OFFSET_CM - MARKER_SIZE_CM, PAPER_H_CM - MARKER_OFFSET_CM - MARKER_SIZE_CM
+    for cx, cy in [(MARKER_OFFSET_CM, MARKER_OFFSET_CM), (far_x, MARKER_OFFSET_CM), (MARKER_OFFSET_CM, far_y), (far_x, far_y)]:
+        cv2.rectangle(img, (_px(cx), _px(cy)), (_px(cx + MARKER_SIZE_CM) - 1, _px(cy + MARKER_SIZE_CM) - 1), 0, -1)
+
+
+def synthetic_layout(seed: int = 0, questions: int = 8, exam_id: str = "EXAM_BENCHVIS",
+                     fiducials: str = "aruco") -> List[Tuple[np.ndarray, List, List]]:
+    """ExamBuilder-like answer sheet (combined mode) without TeX: same fiducials, margins, box rule and QR placement."""
+    specs = _questions(seed, questions)
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    x0_cm, x1_cm = MARGIN_CM, PAPER_W_CM - MARGIN_CM
+    bottom_cm = PAPER_H_CM - 2.0 - QR_BOTTOM_CM - 0.3   # keep clear of the footer and the system QR
+    pages, page, y_cm, q_idx = [], None, 0.0, 0
+
+    def new_page(num: int):
+        img = _paper()
+        _draw_fiducials(img, fiducials)
+        side = _px(QR_CM)
+        qx, qy = _px(PAPER_W_CM - QR_RIGHT_CM) - side, _px(PAPER_H_CM - QR_BOTTOM_CM) - side
+        img[qy:qy + side, qx:qx + side] = _qr(f"{exam_id}-P{num}", side)
+        # fancyhdr: subject / title / id + head rule, footer page label
+        cv2.putText(img, "Math", (_px(x0_cm), _px(1.9)), font, 0.6, 0, 1, cv2.LINE_AA)
+        cv2.putText(img, "Vision Benchmark", (_px(8.6), _px(1.9)), font, 0.6, 0, 1, cv2.LINE_AA)
+        cv2.putText(img, f"[{exam_id[:8]}]", (_px(x1_cm - 2.6), _px(1.9)), font, 0.6, 0, 1, cv2.LINE_AA)
+        cv2.line(img, (_px(x0_cm), _px(2.1)), (_px(x1_cm), _px(2.1)), 0, 1)
+        cv2.putText(img, f"Answer Sheet - p. {num}", (_px(8.2), _px(PAPER_H_CM - 1.2)), font, 0.6, 0, 1, cv2.LINE_AA)
+        top = 2.6
+        if num == 1:  # full header: title + rounded student info box (must fall above the header cutoff)
+            cv2.putText(img, "Vision Benchmark", (_px(7.0), _px(3.0)), font, 1.1, 0, 2, cv2.LINE_AA)
+            cv2.rectangle(img, (_px(x0_cm), _px(3.4)), (_px(x1_cm), _px(4.5)), 0, 2)
+            cv2.putText(img, "Subject: Math   Total: 60   Name: ________   Seat: ____", (_px(x0_cm + 0.3), _px(4.1)),
+                        font, 0.6, 0, 1, cv2.LINE_AA)
+            top = 5.0
+        return img, top
+
+    truth, labels = [], []
+    page_num = 0
+    while q_idx < len(specs):
+        q = specs[q_idx]
+        need = 0.7 + q["height"] + 0.3
+        if page is None or y_cm + need > bottom_cm:
+            if page is not None: pages.append((page, truth, labels))
+            page_num += 1
+            (page, y_cm), truth, labels = new_page(page_num), [], []
+        cv2.putText(page, f"{q_idx + 1}. ({q['score']} pts) {q['text']}", (_px(x0_cm), _px(y_cm + 0.4)),
+                    font, 0.55, 0, 1, cv2.LINE_AA)
+        top_cm, bot_cm = y_cm + 0.7, y_cm + 0.7 + q["height"]
+        rule = max(1, _px(BOX_RULE_CM))
+        cv2.rectangle(page, (_px(x0_cm), _px(top_cm)), (_px(x1_cm), _px(bot_cm)), 0, rule)
+        cv2.putText(page, f"[Q{q_idx + 1}]", (_px(x0_cm + 0.12), _px(top_cm + 0.45)), font, 0.5, 0, 1, cv2.LINE_AA)
+        ax, ay = cm_to_aligned(x0_cm, top_cm)
+        bx, by = cm_to_aligned(x1_cm, bot_cm)
+        truth.append((int(round(ax)), int(round(ay)), int(round(bx - ax)), int(round(by - ay))))
+        labels.append(f"Q{q_idx + 1}")
+        y_cm = bot_cm + 0.3
+        q_idx += 1
+    pages.append((page, truth, labels))
+    return pages
+
+
+# ------------------------------------------------------------------------------
+# Student ink and scan distortion
+# ------------------------------------------------------------------------------
+def add_handwriting(page: np.ndarray, box, rng: np.random.Generator, blank: bool = False) -> None:
+    """Handwriting-like strokes (smooth wavy words, loops, a few formula lines) inside one aligned-frame box."""
+    if blank: return
+    x0, y0, x1, y1 = _aligned_box_to_paper(box)
+    x0, y0, x1, y1 = x0 + 30, y0 + 40, x1 - 30, y1 - 20
+    if x1 - x0 < 80 or y1 - y0 < 40: return
+    shade = int(rng.choice([20, 45, 80, 120]))  # 120 ≈ 淡鉛筆
+    thick = int(rng.integers(1, 4))
+    line_h = int(rng.integers(38, 60))
+    lines = int(rng.integers(1, max(2, (y1 - y0) // line_h + 1)))
+    for li in range(lines):
+        base = y0 + 20 + li * line_h
+        if base > y1 - 10: break
+        x = x0 + int(rng.integers(0, 60))
+        right = x1 - int(rng.integers(0, (x1 - x0) // 2))
+        while x < right - 40:
+            word = int(rng.integers(40, 180))
+            t = np.linspace(0, 1, max(8, word // 3))
+            freq = rng.uniform(3, 7)
+            xs = x + t * word
+            ys = base + np.sin(t * freq * 2 * np.pi + rng.uniform(0, 6)) * rng.uniform(5, 14) + rng.normal(0, 1.2, t.size)
+            cv2.polylines(page, [np.stack([xs, ys], 1).astype(np.int32)], False, shade, thick, cv2.LINE_AA)
+            if rng.random() < 0.3:  # loop / digit
+                cv2.ellipse(page, (int(xs[-1]) + 10, base), (int(rng.integers(6, 14)), int(rng.integers(8, 16))),
+                            0, 0, 360, shade, thick, cv2.LINE_AA)
+            x += word + int(rng.integers(15, 40))
+    if rng.random() < 0.4:  # 分數線 / 底線 / 劃掉
+        yy = int(rng.integers(y0 + 20, max(y0 + 21, y1 - 10)))
+        xa = int(rng.integers(x0, max(x0 + 1, (x0 + x1) // 2)))
+        cv2.line(page, (xa, yy), (xa + int(rng.integers(60, 300)), yy + int(rng.integers(-4, 5))), shade, thick, cv2.LINE_AA)
+
+
+def degrade(page: np.ndarray, rng: np.random.Generator, angle: float, perspective: float, blur: int, noise: float,
+            jpeg: int, dpi: int, shade: float) -> np.ndarray:
+    """Gray page @ RENDER_DPI -> BGR 'scan' (rotation + perspective, blur, paper tint / shadow, noise, resolution, JPEG)."""
+    h, w = page.shape
+    src = np.float32([[0, 0], [w - 1, 0], [w - 1, h - 1], [0, h - 1]])
+    jitter = rng.uniform(-1, 1, (4, 2)) * _px(perspective) if perspective else np.zeros((4, 2))
+    A = cv2.getRotationMatrix2D((w / 2, h / 2), angle * rng.choice([-1, 1]), 0.97)
+    dst = cv2.transform(src[None], A)[0] + jitter
+    f = dpi / float(RENDER_DPI)
+    out_w, out_h = int(round(w * f)), int(round(h * f))
+    M = cv2.getPerspectiveTransform(src, (dst * f).astype(np.float32))
+    img = cv2.warpPerspective(page, M, (out_w, out_h), flags=cv2.INTER_AREA if f < 1 else cv2.INTER_LINEAR,
+                              borderValue=255)
+    if blur: img = cv2.GaussianBlur(img, (blur, blur), 0)
+
+    tint = np.array([226, 236, 242], np.float32) / 255.0  # BGR 米色紙
+    bgr = img[..., None].astype(np.float32) * tint
+    if shade:  # 書背陰影：自左向右的亮度衰減
+        ramp = 1.0 - shade * np.clip(1.0 - np.linspace(0, 1, out_w) * 6, 0, 1) ** 2
+        bgr *= ramp[None, :, None].astype(np.float32)
+    if noise: bgr += rng.normal(0, noise, bgr.shape).astype(np.float32)
+    bgr = np.clip(bgr, 0, 255).astype(np.uint8)
+    if jpeg: bgr = cv2.imdecode(cv2.imencode(".jpg", bgr, [cv2.IMWRITE_JPEG_QUALITY, jpeg])[1], cv2.IMREAD_COLOR)
+    return bgr
+
+
+def build_fixtures(students: int = 6, questions: int = 8, seed: int = 0, source: str = "auto",
+                   fiducials: str = "aruco", blank_rate: float = 0.15) -> Tuple[str, List[ScanPage]]:
+    """-> (layout source actually used, pages in student-major order)"""
+    layout = None
+    if source in ("auto", "examgen"):
+        layout = examgen_layout(seed, questions, fiducials=fiducials)
+        if layout is None and source == "examgen": raise RuntimeError("ExamGen fixtures need xelatex and poppler (pdftoppm).")
+    used = "examgen" if layout is not None else "synthetic"
+    if layout is None: layout = synthetic_layout(seed, questions, fiducials=fiducials)
+
+    names = list(DEGRADATIONS)
+    out = []
+    for s in range(students):
+        rng = np.random.default_rng(seed * 1000 + s)
+        for p, (blank_page, truth, labels) in enumerate(layout, start=1):
+            page = blank_page.copy()
+            for box in truth: add_handwriting(page, box, rng, blank=rng.random() < blank_rate)
+            deg = names[(s * len(layout) + p - 1) % len(names)]
+            out.append(ScanPage(f"s{s:02d}_p{p}_{deg}", s, p, deg, degrade(page, rng, **DEGRADATIONS[deg]),
+                                list(truth), list(labels)))
+    return used, out
+
+
+def save_fixtures(pages: List[ScanPage], path: str) -> None:
+    """Writes the scans as PNG (for inspection / reuse by the other benchmarks)."""
+    os.makedirs(path, exist_ok=True)
+    for sp in pages: cv2.imwrite(os.path.join(path, f"{sp.name}.png"), sp.image)
+
@@ -0,0 +1,292 @@
+# Copyright (c) 2026 [謝忠村/Chung Tsun Shieh]. All Rights Reserved.
+# This software is proprietary and confidential.
+# Unauthorized copying of this file, via any medium is strictly prohibited.
+
+# benchmarks/vision/run.py
+# -*- coding: utf-8 -*-
+# Description:
+# 影像階段 (VisionService) 的端到端 benchmark，夾具見 benchmarks/vision/fixtures.py。
+# 1. 逐頁計時：align (VisionService.align_page，即 align_document 並保留 PageAnalysis)、
+#    detect (detect_answer_areas)、crop (crop_images_by_layout)；
+#    collage 以「一題一組」計時 (AtomicBatchProcessor.plan_grid + create_batches，含編碼)。
+# 2. 報告：各階段 mean / p50 / p95 / max (ms)、頁面吞吐量 (pages/s)；
+#    準確度：對齊成功率、QR 解碼率、答案框 recall / precision (IoU >= 0.9)、配對框的平均 IoU 與最大邊線偏差，
+#    並依掃描失真種類分列。
+# 3. --json 輸出機器可讀結果；--baseline 與先前結果比較 (延遲超過 --tolerance、準確度下降超過
+#    --accuracy-tolerance 視為退步，以 exit code 1 結束)；--save-baseline 寫入新的基準檔。
+#    延遲與機器相關，基準檔請在同一台機器上產生。
+# 4. 不需基準檔的檢查：每頁都印有系統 QR，clean 頁的 QR 解碼率低於 MIN_CLEAN_QR_RATE 即失敗
+#    (QR 解不出時版面清單 / 頁碼判斷全部失效，曾經 0% 仍顯示 PASS)；qr_rate 也與基準檔比較。
+#    --source auto 找不到 xelatex / poppler 而改用 synthetic 夾具時，報告會註明。
+#
+# Usage:
+#   python -m benchmarks.vision [--students 6] [--questions 8] [--source auto|examgen|synthetic] [--fiducials aruco|squares]
+#   python -m benchmarks.vision --json out.json --baseline benchmarks/vision/baseline.json
+#   python -m benchmarks.vision --save-baseline benchmarks/vision/baseline.json
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+import config  # noqa: E402
+from services.vision_service import VisionService  # noqa: E402
+from benchmarks.vision.fixtures import DEGRADATIONS, FIDUCIALS, ScanPage, build_fixtures, save_fixtures  # noqa: E402
+
+RESULT_VERSION = 1
+STAGES = ("align", "detect", "crop", "collage")
+MATCH_IOU = 0.9             # detected box counts as the truth box at IoU >= 0.9
+ASSIGN_IOU = 0.5            # crops are grouped by question at IoU >= 0.5 (unmatched crops are dropped)
+MIN_REGRESSION_MS = 1.0     # sub-millisecond stages (crop) only jitter; a slowdown must also exceed this
+# accuracy keys checked against the baseline (all higher-is-better)
+ACCURACY_KEYS = ("aligned_rate", "qr_rate", "box_recall", "box_precision", "mean_iou")
+MIN_CLEAN_QR_RATE = 1.0     # every fixture page carries the system QR; undistorted scans must all decode
+
+
+# ------------------------------------------------------------------------------
+# Measurements
+# ------------------------------------------------------------------------------
+def _timed(fn, *args, repeat: int = 1, **kwargs):
+    """(best wall time in ms over `repeat` runs, result of the last run)"""
+    best, result = float("inf"), None
+    for _ in range(max(1, repeat)):
+        t0 = time.perf_counter()
+        result = fn(*args, **kwargs)
+        best = min(best, time.perf_counter() - t0)
+    return best * 1e3, result
+
+
+def match_boxes(found: List[Tuple], truth: List[Tuple]) -> Tuple[np.ndarray, np.ndarray]:
+    """-> (IoU matrix truth x found, best-matching found index per truth box or -1 below ASSIGN_IOU)"""
+    if not found or not truth: return np.zeros((len(truth), len(found))), np.full(len(truth), -1)
+    iou = VisionService._iou_matrix(np.asarray(list(truth) + list(found), dtype=np.float64))[:len(truth), len(truth):]
+    best = np.argmax(iou, axis=1)
+    best[iou[np.arange(len(truth)), best] < ASSIGN_IOU] = -1
+    return iou, best
+
+
+def box_accuracy(found: List[Tuple], truth: List[Tuple]) -> Dict:
+    iou, best = match_boxes(found, truth)
+    hit = [i for i in range(len(truth)) if best[i] >= 0 and iou[i, best[i]] >= MATCH_IOU]
+    edges = lambda r: np.array([r[0], r[1], r[0] + r[2], r[1] + r[3]], np.float64)
+    edge_err = [float(np.abs(edges(truth[i]) - edges(found[best[i]])).max()) for i in hit]
+    return {
+        "truth": len(truth), "found": len(found), "matched": len(hit),
+        "iou": [float(iou[i, best[i]]) for i in hit], "edge_err": edge_err,
+    }
+
+
+def run_pages(pages: List[ScanPage], repeat: int, manual_p1_ratio: float) -> Tuple[List[Dict], Dict[Tuple[int, str], List[Dict]]]:
+    """Align / detect / crop every page. Returns per-page records and the crops grouped by (page, question label)."""
+    records, groups = [], {}
+    for sp in pages:
+        t_align, (aligned, analysis) = _timed(VisionService.align_page, sp.image, repeat=repeat)
+        t_detect, (boxes, cutoff) = _timed(VisionService.detect_answer_areas, aligned, is_first_page=(sp.page == 1),
+                                           manual_p1_ratio=manual_p1_ratio, analysis=analysis, repeat=repeat)
+        t_crop, crops = _timed(VisionService.crop_images_by_layout, aligned, boxes, repeat=repeat)
+
+        acc = box_accuracy(boxes, sp.truth) if analysis.is_aligned else box_accuracy([], sp.truth)
+        _, best = match_boxes(boxes, sp.truth)
+        for label, j in zip(sp.labels, best):
+            if j >= 0 and j < len(crops): groups.setdefault((sp.page, label), []).append({"img": crops[j], "sid": f"S{sp.student:02d}"})
+        records.append({
+            "name": sp.name, "student": sp.student, "page": sp.page, "degradation": sp.degradation,
+            "shape": list(sp.image.shape[:2]), "aligned": bool(analysis.is_aligned), "qr": analysis.qr_content,
+            "cutoff": int(cutoff), "ms": {"align": t_align, "detect": t_detect, "crop": t_crop}, **acc,
+        })
+    return records, groups
+
+
+def run_collages(groups: Dict[Tuple[int, str], List[Dict]], repeat: int) -> List[Dict]:
+    """One collage set per question (all students), the way Phase 3 of the dashboard builds them."""
+    from ui.dashboard_view import AtomicBatchProcessor
+    processor = AtomicBatchProcessor()
+    out = []
+    for (page, label), items in sorted(groups.items()):
+        def build():
+            for item in items: item.pop("ink", None)  # plan_grid caches the ink crop; time it every run
+            return processor.create_batches(items, processor.plan_grid(items))
+        ms, batches = _timed(build, repeat=repeat)
+        out.append({"page": page, "label": label, "crops": len(items), "grids": len(batches), "ms": ms,
+                    "kb": sum(len(b["payload"].data) for b in batches) / 1024.0})
+    return out
+
+
+# ------------------------------------------------------------------------------
+# Report
+# ------------------------------------------------------------------------------
+def _stats(values: List[float]) -> Dict:
+    if not values: return {"n": 0, "mean": None, "p50": None, "p95": None, "max": None}
+    arr = np.asarray(values, np.float64)
+    return {"n": int(arr.size), "mean": float(arr.mean()), "p50": float(np.percentile(arr, 50)),
+            "p95": float(np.percentile(arr, 95)), "max": float(arr.max())}
+
+
+def _accuracy(records: List[Dict]) -> Dict:
+    truth = sum(r["truth"] for r in records)
+    found = sum(r["found"] for r in records if r["aligned"])
+    matched = sum(r["matched"] for r in records)
+    ious = [v for r in records for v in r["iou"]]
+    errs = [v for r in records for v in r["edge_err"]]
+    return {
+        "pages": len(records),
+        "aligned_rate": sum(r["aligned"] for r in records) / max(1, len(records)),
+        "qr_rate": sum(r["qr"] is not None for r in records) / max(1, len(records)),
+        "box_recall": matched / truth if truth else 1.0,
+        "box_precision": matched / found if found else (1.0 if not truth else 0.0),
+        "mean_iou": float(np.mean(ious)) if ious else 0.0,
+        "max_edge_err_px": float(max(errs)) if errs else None,
+    }
+
+
+def summarize(records: List[Dict], collages: List[Dict], wall_s: float, meta: Dict) -> Dict:
+    stages = {s: _stats([r["ms"][s] for r in records]) for s in ("align", "detect", "crop")}
+    stages["collage"] = _stats([c["ms"] for c in collages])
+    stages["collage"]["unit"] = "question"
+    page_ms = [sum(r["ms"].values()) for r in records]
+    collage_ms = sum(c["ms"] for c in collages)
+    total_ms = sum(page_ms) + collage_ms
+    return {
+        "version": RESULT_VERSION,
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "env": {"python": platform.python_version(), "opencv": cv2.__version__, "numpy": np.__version__,
+                "machine": platform.machine(), "cpus": os.cpu_count(),
+                "vision_pyramid": bool(getattr(config, "VISION_PYRAMID", False))},
+        "fixtures": meta,
+        "stages": stages,
+        "throughput": {
+            "pages": len(records), "pages_per_s": len(records) / (total_ms / 1e3) if total_ms else None,
+            "page_ms": _stats(page_ms), "collage_ms_total": collage_ms,
+            "collage_grids": sum(c["grids"] for c in collages), "wall_s": wall_s,
+        },
+        "accuracy": _accuracy(records),
+        "by_degradation": {d: _accuracy([r for r in records if r["degradation"] == d])
+                           for d in DEGRADATIONS if any(r["degradation"] == d for r in records)},
+        "pages": records,
+        "collages": collages,
+    }
+
+
+def _fmt(v, spec: str = ".1f") -> str:
+    return "-" if v is None else format(v, spec)
+
+
+def print_report(result: Dict) -> None:
+    fx, tp = result["fixtures"], result["throughput"]
+    print(f"fixtures: source={fx['source']} fiducials={fx['fiducials']} students={fx['students']} "
+          f"pages={tp['pages']} seed={fx['seed']}  pyramid={result['env']['vision_pyramid']}")
+    for note in result.get("notes", []): print(f"note: {note}")
+    print(f"{'stage':<10}{'n':>6}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}")
+    for name in STAGES:
+        s = result["stages"][name]
+        unit = " (per question)" if s.get("unit") == "question" else ""
+        print(f"{name:<10}{s['n']:>6}{_fmt(s['mean']):>10}{_fmt(s['p50']):>10}{_fmt(s['p95']):>10}{_fmt(s['max']):>10}{unit}")
+    print(f"throughput: {_fmt(tp['pages_per_s'], '.2f')} pages/s  (page p50 {_fmt(tp['page_ms']['p50'])} ms, "
+          f"p95 {_fmt(tp['page_ms']['p95'])} ms; {tp['collage_grids']} collage grid(s) in {_fmt(tp['collage_ms_total'])} ms)")
+    print(f"{'accuracy':<14}{'pages':>6}{'aligned':>9}{'qr':>7}{'recall':>8}{'prec.':>8}{'IoU':>7}{'edge px':>9}")
+    rows = [("all", result["accuracy"])] + list(result["by_degradation"].items())
+    for name, a in rows:
+        print(f"{name:<14}{a['pages']:>6}{a['aligned_rate']:>9.0%}{a['qr_rate']:>7.0%}{a['box_recall']:>8.3f}"
+              f"{a['box_precision']:>8.3f}{a['mean_iou']:>7.3f}{_fmt(a['max_edge_err_px']):>9}")
+
+
+# ------------------------------------------------------------------------------
+# Baseline
+# ------------------------------------------------------------------------------
+def check(result: Dict) -> List[str]:
+    """Baseline-free failures (empty list = ok)."""
+    failures = []
+    clean = result["by_degradation"].get("clean")
+    if clean and clean["qr_rate"] < MIN_CLEAN_QR_RATE:
+        failures.append(f"clean qr_rate {clean['qr_rate']:.0%} < {MIN_CLEAN_QR_RATE:.0%}")
+    return failures
+
+
+def compare(result: Dict, baseline: Dict, tolerance: float, accuracy_tolerance: float) -> List[str]:
+    """Regressions of `result` against `baseline` (empty list = ok); prints the comparison table."""
+    differs = {k: v for k, v in result["fixtures"].items() if baseline.get("fixtures", {}).get(k) != v}
+    if differs: print(f"warning: fixtures differ from the baseline ({differs}); latency comparison is indicative only")
+    regressions = []
+    print(f"{'vs baseline':<22}{'base':>10}{'now':>10}{'ratio':>8}")
+    for name in STAGES:
+        for key in ("p50", "p95"):
+            base, now = baseline.get("stages", {}).get(name, {}).get(key), result["stages"][name][key]
+            if not base or now is None: continue
+            ratio = now / base
+            flag = ratio > 1.0 + tolerance and now - base > MIN_REGRESSION_MS
+            print(f"{name + ' ' + key + ' ms':<22}{base:>10.1f}{now:>10.1f}{ratio:>7.2f}x{'  REGRESSION' if flag else ''}")
+            if flag: regressions.append(f"{name} {key} {base:.1f} -> {now:.1f} ms")
+    base_tp, now_tp = baseline.get("throughput", {}).get("pages_per_s"), result["throughput"]["pages_per_s"]
+    if base_tp and now_tp:
+        print(f"{'pages/s':<22}{base_tp:>10.2f}{now_tp:>10.2f}{now_tp / base_tp:>7.2f}x")
+    for key in ACCURACY_KEYS:
+        base, now = baseline.get("accuracy", {}).get(key), result["accuracy"][key]
+        if base is None: continue
+        flag = now < base - accuracy_tolerance
+        print(f"{key:<22}{base:>10.3f}{now:>10.3f}{'':>8}{'  REGRESSION' if flag else ''}")
+        if flag: regressions.append(f"{key} {base:.3f} -> {now:.3f}")
+    return regressions
+
+
+def _write_json(result: Dict, path: str) -> None:
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f: json.dump(result, f, ensure_ascii=False, indent=2)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(prog="python -m benchmarks.vision", description="VisionService benchmark on synthetic scanned exams")
+    ap.add_argument("--students", type=int, default=6)
+    ap.add_argument("--questions", type=int, default=8)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--source", choices=("auto", "examgen", "synthetic"), default="auto")
+    ap.add_argument("--fiducials", choices=FIDUCIALS, default="aruco")
+    ap.add_argument("--repeat", type=int, default=1, help="time each stage this many times and keep the best")
+    ap.add_argument("--manual-p1-ratio", type=float, default=0.15)
+    ap.add_argument("--json", type=str, default=None, help="write the full result (incl. per-page records) here")
+    ap.add_argument("--baseline", type=str, default=None, help="compare against this result file")
+    ap.add_argument("--save-baseline", type=str, default=None, help="store this run as the new baseline")
+    ap.add_argument("--tolerance", type=float, default=0.25, help="allowed p50 / p95 slowdown (0.25 = +25%%)")
+    ap.add_argument("--accuracy-tolerance", type=float, default=0.01)
+    ap.add_argument("--save-fixtures", type=str, default=None, help="also write the generated scans to this directory")
+    args = ap.parse_args(argv)
+
+    t0 = time.perf_counter()
+    source, pages = build_fixtures(args.students, args.questions, args.seed, args.source, args.fiducials)
+    print(f"generated {len(pages)} page(s) in {time.perf_counter() - t0:.1f}s")
+    if args.save_fixtures: save_fixtures(pages, args.save_fixtures)
+
+    t0 = time.perf_counter()
+    records, groups = run_pages(pages, args.repeat, args.manual_p1_ratio)
+    collages = run_collages(groups, args.repeat)
+    meta = {"source": source, "fiducials": args.fiducials, "students": args.students, "questions": args.questions,
+            "seed": args.seed, "repeat": args.repeat}
+    result = summarize(records, collages, time.perf_counter() - t0, meta)
+    result["notes"] = []
+    if args.source == "auto" and source != "examgen":
+        result["notes"].append(f"--source auto fell back to {source} fixtures (ExamGen needs xelatex and poppler); "
+                               "pages are ExamBuilder look-alikes, not ExamGenService output")
+    print_report(result)
+
+    if args.json: _write_json(result, args.json)
+    regressions = check(result)
+    if args.baseline:
+        if not os.path.exists(args.baseline): sys.exit(f"Baseline not found: {args.baseline}")
+        with open(args.baseline, "r", encoding="utf-8") as f: baseline = json.load(f)
+        regressions += compare(result, baseline, args.tolerance, args.accuracy_tolerance)
+    print("FAIL: " + "; ".join(regressions) if regressions else "PASS")
+    if args.save_baseline:
+        _write_json(result, args.save_baseline)
+        print(f"baseline written to {args.save_baseline}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -18,6 +18,7 @@ SPLITS_DIR = os.path.join(DATA_DIR, "splits")
 HISTORY_DIR = os.path.join(DATA_DIR, "history_data") 
 UPLOAD_DIR = os.path.join(DATA_DIR, "uploads")
 DRAFT_DIR = os.path.join(DATA_DIR, "drafts")
+RASTER_CACHE_DIR = os.path.join(DATA_DIR, "raster_cache")
 
 # 確保目錄存在
 for d in [DATA_DIR, UPLOAD_DIR, DRAFT_DIR, EXAM_DIR, SPLITS_DIR, HISTORY_DIR]:
@@ -44,17 +45,79 @@ COSTS = {
 EXCHANGE_RATE_TWD = 32.5
 
 # --- 效能配置 (Mac Silicon 優化) ---
-# M1/M2/M3 晶片效能強大，可以允許較高的並發
-DEFAULT_MAX_WORKERS = 10          
 DEFAULT_RETENTION_DAYS = 180
 
-# 根據方案決定批改速度
-PLAN_MAX_WORKERS = {
-    "personal": 5, # Mac 個人版
-    "free": 1,
-    "pro": 5,
-    "business": 8
-}
+# Collage 串流管線：同時留在記憶體中的頁面上限 (A4@200dpi BGR 約 11 MB/頁)
+# 0 = 依 CPU 核心數自動計算
+COLLAGE_MAX_PAGES_IN_FLIGHT = int(os.getenv("COLLAGE_MAX_PAGES_IN_FLIGHT", "0"))
+
+# PDF 轉圖磁碟快取 (LRU 依總容量淘汰)，0 = 停用
+RASTER_CACHE_MAX_MB = int(os.getenv("RASTER_CACHE_MAX_MB", "2048"))
+RASTER_DPI = 200
+# poppler 轉圖執行緒數，0 = min(4, CPU 核心數)
+RASTER_THREADS = int(os.getenv("RASTER_THREADS", "0"))
+
+# 影像分析程序池 (align / detect_answer_areas)：0 = 依 CPU 核心數與記憶體預算自動計算
+# 計算結果不足 2 個 worker 時停用，改在主程序處理
+VISION_WORKERS = int(os.getenv("VISION_WORKERS", "0"))
+VISION_POOL_MEMORY_MB = int(os.getenv("VISION_POOL_MEMORY_MB", "1536"))
+
+# 影像金字塔：定位點 / 答案框先在縮小圖 (預設 1/4) 上找候選，再回全解析度局部精修
+# 設為 0 時改回整頁全解析度偵測；粗層找到的四角定位點未通過幾何檢查時，該頁自動改回全解析度
+# 調整前請先跑 python -m benchmarks.bench_vision_pyramid (準確度回歸檢查)
+VISION_PYRAMID = os.getenv("VISION_PYRAMID", "1") == "1"
+VISION_PYRAMID_SCALE = float(os.getenv("VISION_PYRAMID_SCALE", "0.25"))
+
+# 送往 Gemini 的影像格式 (services/upload_policy.py)，空字串 = 全彩 PNG
+# 例："codec=jpeg,quality=85,color=gray,max_long_edge=2000"；以 benchmarks/bench_upload_codec.py 挑選
+# PNG 可加 png_level=1 (較快、約大 5%)
+UPLOAD_POLICY = os.getenv("UPLOAD_POLICY", "")
+# 拼貼圖的影像格式，空字串 = 沿用 UPLOAD_POLICY，但 PNG 改用 png_level=1 (拼貼圖留白多，level 6 編碼反而拖慢整體)
+COLLAGE_UPLOAD_POLICY = os.getenv("COLLAGE_UPLOAD_POLICY", "")
+
+# Collage 格線規劃：每次請求的影像 token 預算 (Gemini 每 768x768 tile 258 tokens；預設 6 tiles = 原本 2x2 x 1024x600)、
+# 每張最多幾位學生、作答區最小縮放比例 (避免字跡過小)
+COLLAGE_TOKEN_BUDGET = int(os.getenv("COLLAGE_TOKEN_BUDGET", "1548"))
+COLLAGE_MAX_CELLS = int(os.getenv("COLLAGE_MAX_CELLS", "16"))
+COLLAGE_MIN_SCALE = float(os.getenv("COLLAGE_MIN_SCALE", "0.5"))
+
+# Gemini 回應本機快取 (services/llm_cache.py)：同一 Rubric + 同樣掃描重跑時直接取回，0 = 停用
+LLM_CACHE_PATH = os.path.join(DATA_DIR, "llm_cache.sqlite3")
+LLM_CACHE_MAX_MB = int(os.getenv("LLM_CACHE_MAX_MB", "256"))
+LLM_CACHE_TTL_DAYS = float(os.getenv("LLM_CACHE_TTL_DAYS", "30"))
+
+# Gemini Client 連線池 (services/genai_clients.py)：每把 API Key 共用一個 Client，keep-alive 連線重複使用
+# MAX_CONNECTIONS / MAX_KEEPALIVE 應 >= GRADING_MAX_IN_FLIGHT (HTTP/1.1 一條連線一次一個請求，閒置上限過低會在整批同時回應時關掉連線)；
+# TIMEOUT_MS = 0 表示沿用 SDK 預設
+GENAI_MAX_CONNECTIONS = int(os.getenv("GENAI_MAX_CONNECTIONS", "64"))
+GENAI_MAX_KEEPALIVE = int(os.getenv("GENAI_MAX_KEEPALIVE", "64"))
+GENAI_KEEPALIVE_EXPIRY = float(os.getenv("GENAI_KEEPALIVE_EXPIRY", "90"))
+GENAI_TIMEOUT_MS = int(os.getenv("GENAI_TIMEOUT_MS", "0"))
+
+# asyncio 批改引擎 (services/async_grading.py)：每批同時在途的 Gemini 請求數 (全部由同一條 event-loop 執行緒等待)
+GRADING_MAX_IN_FLIGHT = int(os.getenv("GRADING_MAX_IN_FLIGHT", "64"))
+
+# Gemini 限流 (services/rate_limiter.py)：每把 API Key 的 RPM / TPM 額度 (0 = 不限)，批改與身分辨識共用
+# 預設為 Gemini 2.5 Pro 付費 Tier 1；免費額度請改小 (例 RPM=5, TPM=250000)
+# 並行度從 CONCURRENCY_INITIAL 起依成功 / 429 自動調整 (AIMD)，範圍 CONCURRENCY_MIN ~ GRADING_MAX_IN_FLIGHT
+RATE_LIMIT_RPM = int(os.getenv("RATE_LIMIT_RPM", "150"))
+RATE_LIMIT_TPM = int(os.getenv("RATE_LIMIT_TPM", "2000000"))
+CONCURRENCY_INITIAL = int(os.getenv("CONCURRENCY_INITIAL", "8"))
+CONCURRENCY_MIN = int(os.getenv("CONCURRENCY_MIN", "1"))
+
+# Gemini 重試 (services/retry_policy.py)：5xx / 逾時最多 RETRY_MAX_ATTEMPTS 次、429 最多 RETRY_QUOTA_ATTEMPTS 次 (含第一次)，
+# 指數退避 RETRY_BASE_S x 2^n (full jitter，上限 RETRY_MAX_DELAY_S)；其他 4xx 不重試
+# 每批重試額度 = RETRY_BUDGET_MIN + RETRY_BUDGET_RATIO x 請求數
+# 斷路器：連續 BREAKER_FAILURES 次 5xx / 逾時即暫停派送 BREAKER_RESET_S 秒，停擺超過 BREAKER_MAX_OUTAGE_S 秒才讓請求失敗
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "4"))
+RETRY_QUOTA_ATTEMPTS = int(os.getenv("RETRY_QUOTA_ATTEMPTS", "6"))
+RETRY_BASE_S = float(os.getenv("RETRY_BASE_S", "1.0"))
+RETRY_MAX_DELAY_S = float(os.getenv("RETRY_MAX_DELAY_S", "30"))
+RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", "0.2"))
+RETRY_BUDGET_MIN = int(os.getenv("RETRY_BUDGET_MIN", "10"))
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))
+BREAKER_RESET_S = float(os.getenv("BREAKER_RESET_S", "15"))
+BREAKER_MAX_OUTAGE_S = float(os.getenv("BREAKER_MAX_OUTAGE_S", "300"))
 
 # 方案預設配額
 PLAN_LIMITS = {
@@ -308,6 +308,24 @@ class PaymentRecordModel(Base):
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
     processed_at = Column(DateTime, nullable=True)
 
+class ExamLayoutModel(Base):
+    # [NEW] 出卷時產生的答案框版面 (對齊後 A4 frame 座標)，以系統 QR 上的 EXAM_ID 為 key
+    __tablename__ = "exam_layouts"
+    exam_id = Column(String, primary_key=True)
+    layout_json = Column(JSON, nullable=False)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+
+class LayoutTemplateModel(Base):
+    # [NEW] 「偵測版面」結果 (答案框 / 標籤 / header cutoff)，key = 'qr:<EXAM_ID>' 或 'rubric:<hash>'
+    __tablename__ = "layout_templates"
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), index=True)
+    template_key = Column(String, index=True, nullable=False)
+    layout_json = Column(JSON, nullable=False)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+
 # ==============================================================================
 #  3. Core Functions
 # ==============================================================================
@@ -998,6 +1016,42 @@ def set_sys_conf(key: str, value: str) -> bool:
         try: session.commit(); return True
         except: session.rollback(); return False
 
+def save_exam_layout(exam_id: str, layout: dict) -> bool:
+    with SessionLocal() as session:
+        row = session.get(ExamLayoutModel, exam_id)
+        if row: row.layout_json = layout
+        else: session.add(ExamLayoutModel(exam_id=exam_id, layout_json=layout))
+        try: session.commit(); return True
+        except Exception as e:
+            session.rollback(); logger.error(f"save_exam_layout failed: {e}"); return False
+
+def get_exam_layout(exam_id: str) -> Optional[Dict]:
+    with SessionLocal() as session:
+        row = session.get(ExamLayoutModel, exam_id)
+        return _ensure_dict(row.layout_json) if row else None
+
+def save_layout_template(user_id: int, template_key: str, layout: dict) -> bool:
+    with SessionLocal() as session:
+        row = session.query(LayoutTemplateModel).filter_by(user_id=user_id, template_key=template_key).first()
+        if row: row.layout_json = layout
+        else: session.add(LayoutTemplateModel(user_id=user_id, template_key=template_key, layout_json=layout))
+        try: session.commit(); return True
+        except Exception as e:
+            session.rollback(); logger.error(f"save_layout_template failed: {e}"); return False
+
+def get_layout_template(user_id: int, template_key: str) -> Optional[Dict]:
+    with SessionLocal() as session:
+        row = session.query(LayoutTemplateModel).filter_by(user_id=user_id, template_key=template_key).first()
+        return _ensure_dict(row.layout_json) if row else None
+
+def delete_layout_template(user_id: int, template_key: str) -> bool:
+    with SessionLocal() as session:
+        try:
+            res = session.query(LayoutTemplateModel).filter_by(user_id=user_id, template_key=template_key).delete()
+            session.commit(); return res > 0
+        except Exception as e:
+            session.rollback(); logger.error(f"delete_layout_template failed: {e}"); return False
+
 def get_all_batches(user_id: str) -> List[BatchRecord]:
     with SessionLocal() as session:
         sql = text("""
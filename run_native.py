@@ -111,4 +111,7 @@ def start_app():
         webview.start()
 
 if __name__ == "__main__":
+    # Vision pool 以 spawn 啟動子程序；打包後 (frozen) 必須先呼叫 freeze_support
+    import multiprocessing
+    multiprocessing.freeze_support()
     start_app()
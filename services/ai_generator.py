@@ -14,6 +14,7 @@ from io import BytesIO
 try:
     from google import genai
     from google.genai import types
+    from services.genai_clients import get_client
     HAS_GENAI = True
 except ImportError:
     HAS_GENAI = False
@@ -52,13 +53,10 @@ def generate_questions_from_material(api_key, material_text, config):
         }
 
     try:
-        # 1. 初始化 Client (關鍵修復：Timeout 單位修正)
+        # 1. 取得共用 Client (關鍵修復：Timeout 單位修正)
         # ⚠️ 注意：SDK 的 timeout 單位是「毫秒」(ms)
-        # 60000 ms = 60 秒
-        client = genai.Client(
-            api_key=api_key, 
-            http_options={'timeout': 60000} 
-        )
+        # 60000 ms = 60 秒；同一把 Key + timeout 共用連線池 (services/genai_clients.py)
+        client = get_client(api_key, timeout_ms=60000)
         
         # 2. 參數配置
         q_type = config.get("q_type", "Mixed")
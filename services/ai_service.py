@@ -3,7 +3,7 @@
 import logging
 import json
 import re
-from google import genai
+from services.genai_clients import get_client
 from google.genai import types
 from services.rubric_service import RubricService # [CRITICAL] 必須引用
 
@@ -21,7 +21,7 @@ def generate_rubric(pdf_path: str, model_name: str, api_key: str, subject: str,
     try:
         # 1. 驗證 API Key
         if not api_key: raise ValueError("Missing API Key")
-        client = genai.Client(api_key=api_key)
+        client = get_client(api_key)
         
         # 2. [關鍵] 從 RubricService 取得最新的 Prompt (包含積分規則)
         system_instr = RubricService.get_rubric_generation_prompt(
@@ -84,7 +84,7 @@ def generate_rubric1(pdf_path, model_name, api_key, subject, language, granulari
     產生評分標準 JSON。
     """
     try:
-        client = genai.Client(api_key=api_key)
+        client = get_client(api_key)
         
         # 1. 呼叫 RubricService (確保 logic 變數正確)
         system_instr = RubricService.get_rubric_generation_prompt(
@@ -272,7 +272,7 @@ def generate_rubric(pdf_path, model_name, api_key, subject, language, granularit
     [RESTORED] 整合 RubricService 的 Prompt 與舊版的後處理邏輯。
     """
     try:
-        client = genai.Client(api_key=api_key)
+        client = get_client(api_key)
         
         # 1. 取得完整 Prompt (包含舊版詳細 Schema)
         system_instr = RubricService.get_rubric_generation_prompt(
@@ -333,7 +333,7 @@ def generate_class_analysis(grading_results, rubric_text, api_key, report_mode="
     """
     try:
         real_key = _get_valid_api_key(api_key)
-        client = genai.Client(api_key=real_key)
+        client = get_client(real_key)
         
         data_summary = []
         for r in grading_results:
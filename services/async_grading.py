@@ -0,0 +1,127 @@
+# Copyright (c) 2026 [謝忠村/Chung Tsun Shieh]. All Rights Reserved.
+# This software is proprietary and confidential.
+# Unauthorized copying of this file, via any medium is strictly prohibited.
+
+# services/async_grading.py
+# -*- coding: utf-8 -*-
+# Module-Version: v2026.02.20-Async-Engine
+# Description:
+# 1. [Perf] GradingLoop：專用的 asyncio event-loop 執行緒 (daemon)。Streamlit 的 script thread 不能長時間跑 loop，
+#    也不能在 rerun 間保留 loop，所以整個程序只開一條，批改請求以 run_coroutine_threadsafe 丟進去。
+# 2. [Perf] AsyncScheduler：以 asyncio.Semaphore 限制同時在途的請求數 (config.GRADING_MAX_IN_FLIGHT)，
+#    50+ 個請求同時等待 Gemini 只佔一條執行緒，不再是每個 worker 一條 OS thread。
+# 3. [Logic] submit() 回傳 concurrent.futures.Future，呼叫端照舊用 as_completed() 更新進度 (st.* 只能在 script thread 呼叫)。
+# 4. [Safety] client.aio 底下的 httpx.AsyncClient 綁定第一次使用它的 loop；所有 aio 請求都必須經由這條 loop 送出。
+
+import asyncio
+import logging
+import threading
+import concurrent.futures
+from typing import Any, Awaitable, Callable, Coroutine, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class GradingLoop:
+    """One long-lived event loop on a daemon thread; coroutines from any thread are scheduled onto it."""
+
+    def __init__(self, name: str = "grading-loop"):
+        self.name = name
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+
+    def _run(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self._loop = loop
+        self._ready.set()
+        try:
+            loop.run_forever()
+        finally:
+            loop.close()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._ready.clear()
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+                self._ready.wait()
+                logger.info(f"{self.name} started")
+        return self._loop
+
+    def submit(self, coro: Coroutine) -> concurrent.futures.Future:
+        if threading.current_thread() is self._thread:
+            raise RuntimeError("GradingLoop.submit() called from the loop thread; await the coroutine instead")
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro: Coroutine, timeout: Optional[float] = None) -> Any:
+        """Blocks the calling thread until `coro` finishes on the loop."""
+        return self.submit(coro).result(timeout)
+
+
+class AsyncScheduler:
+    """
+    Executor-style front end over GradingLoop: submit(async_fn, *args, **kwargs) -> concurrent.futures.Future.
+    At most max_in_flight coroutines run at once; the rest wait on the semaphore (no thread each).
+    Use as a context manager to wait for every submitted job, like ThreadPoolExecutor.
+    """
+
+    def __init__(self, max_in_flight: int, loop: Optional[GradingLoop] = None):
+        self.grading_loop = loop or get_grading_loop()
+        self.max_in_flight = max(1, int(max_in_flight))
+        self._sem: Optional[asyncio.Semaphore] = None
+        self._futures: List[concurrent.futures.Future] = []
+        # 只在 loop thread 上修改；其他執行緒讀取僅供顯示
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.completed = 0
+
+    async def _bounded(self, fn: Callable[..., Awaitable[Any]], args, kwargs) -> Any:
+        if self._sem is None: self._sem = asyncio.Semaphore(self.max_in_flight)
+        async with self._sem:
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                self.in_flight -= 1
+                self.completed += 1
+
+    def submit(self, fn: Callable[..., Awaitable[Any]], *args, **kwargs) -> concurrent.futures.Future:
+        future = self.grading_loop.submit(self._bounded(fn, args, kwargs))
+        self._futures.append(future)
+        return future
+
+    def shutdown(self, wait: bool = True, cancel_futures: bool = False) -> None:
+        if cancel_futures:
+            for f in self._futures: f.cancel()
+        if wait and self._futures: concurrent.futures.wait(self._futures)
+        self._futures = []
+
+    def __enter__(self) -> "AsyncScheduler":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.shutdown(wait=True, cancel_futures=exc_type is not None)
+
+
+_default_loop: Optional[GradingLoop] = None
+_default_lock = threading.Lock()
+
+
+def get_grading_loop() -> GradingLoop:
+    """Process-wide grading event loop (started on first use, survives Streamlit reruns)."""
+    global _default_loop
+    with _default_lock:
+        if _default_loop is None: _default_loop = GradingLoop()
+        return _default_loop
+
+
+def get_max_in_flight() -> int:
+    """Concurrent Gemini requests per batch (config.GRADING_MAX_IN_FLIGHT)."""
+    import config
+    return max(1, int(getattr(config, "GRADING_MAX_IN_FLIGHT", 64)))
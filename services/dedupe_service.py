@@ -0,0 +1,122 @@
+# Copyright (c) 2026 [謝忠村/Chung Tsun Shieh]. All Rights Reserved.
+# This software is proprietary and confidential.
+# Unauthorized copying of this file, via any medium is strictly prohibited.
+
+# services/dedupe_service.py
+# -*- coding: utf-8 -*-
+# Module-Version: v2026.02.15-Crop-Dedupe
+# Description:
+# 1. [Perf] DedupeIndex：以 64-bit dHash 找出同一題中近乎相同的作答區 (空白、只有印刷內容、重複掃描)，
+#    只送一份給 GradingService，結果再複製給其他學生。
+# 2. [Safety] dHash 只當候選篩選；確認時先以 phase correlation 對位，再比對兩張的筆跡遮罩 (容許 ±tolerance px)，
+#    任一方多出的筆跡超過 max_ink_px 即視為不同答案 (例如 "2" 與 "3")，不會被合併。
+# 3. [Logic] 同一份索引也用在整頁 (較低解析度)：掃描機重複進紙造成的重複頁面只標記，不自動處理。
+
+import logging
+from typing import Any, Hashable, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from utils.page_image import PageImage
+
+logger = logging.getLogger(__name__)
+
+HASH_SIZE = 8
+HASH_DEAD_ZONE = 2  # 灰階差 <= 2 視為平坦 (0)：空白紙上的雜訊不會讓 dHash 位元亂跳
+
+
+def dhash(image: Any, size: int = HASH_SIZE) -> np.ndarray:
+    """Difference hash (size*size bits, packed): horizontal gradients on an INTER_AREA thumbnail, flat steps = 0."""
+    gray = PageImage.wrap(image).gray()
+    small = cv2.resize(gray, (size + 1, size), interpolation=cv2.INTER_AREA).astype(np.int16)
+    return np.packbits((small[:, 1:] - small[:, :-1] > HASH_DEAD_ZONE).ravel())
+
+
+def ink_mask(image: Any, scale: float = 1.0) -> np.ndarray:
+    """Binary ink mask (same threshold as VisionService.find_ink_bbox) at `scale`, scan specks removed."""
+    gray = PageImage.wrap(image).gray()
+    if scale != 1.0:
+        gray = cv2.resize(gray, (max(1, int(gray.shape[1] * scale)), max(1, int(gray.shape[0] * scale))),
+                          interpolation=cv2.INTER_AREA)
+    mask = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 25, 15)
+    return cv2.medianBlur(mask, 3)
+
+
+def ink_difference(a: np.ndarray, b: np.ndarray, tolerance: int = 2) -> int:
+    """
+    Ink pixels of either mask with no ink of the other within `tolerance` px, after `b` is shifted onto `a`
+    by phase correlation (crops of different students are cut from independently aligned pages).
+    """
+    if a.shape != b.shape: b = cv2.resize(b, (a.shape[1], a.shape[0]), interpolation=cv2.INTER_NEAREST)
+    (dx, dy), _ = cv2.phaseCorrelate(b.astype(np.float32), a.astype(np.float32))
+    if round(dx) or round(dy):
+        shift = np.float32([[1, 0, round(dx)], [0, 1, round(dy)]])
+        b = cv2.warpAffine(b, shift, (b.shape[1], b.shape[0]), flags=cv2.INTER_NEAREST)
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * tolerance + 1, 2 * tolerance + 1))
+    only_a = cv2.bitwise_and(a, cv2.bitwise_not(cv2.dilate(b, kernel)))
+    only_b = cv2.bitwise_and(b, cv2.bitwise_not(cv2.dilate(a, kernel)))
+    return cv2.countNonZero(only_a) + cv2.countNonZero(only_b)
+
+
+class DedupeIndex:
+    """
+    Near-duplicate index over images of one kind (crops of one question, or aligned pages).
+    match() returns the key of an earlier image judged identical, or registers the image and returns None.
+    lazy=True keeps a reference to each image and builds its ink mask only once something lands in its hash
+    neighbourhood (crops are held by the batch anyway); lazy=False stores a bit-packed mask instead (pages).
+    """
+
+    def __init__(self, hash_size: int = HASH_SIZE, max_hamming: int = 6, scale: float = 1.0, tolerance: int = 2,
+                 max_ink_px: int = 12, max_ink_frac: float = 0.00002, max_candidates: int = 8, lazy: bool = True):
+        self.hash_size = hash_size
+        self.max_hamming = max_hamming
+        self.scale = scale
+        self.tolerance = tolerance
+        self.max_ink_px = max_ink_px
+        self.max_ink_frac = max_ink_frac
+        self.max_candidates = max_candidates
+        self.lazy = lazy
+        self._keys: List[Hashable] = []
+        self._images: List[Any] = []
+        self._masks: List[Optional[Tuple[np.ndarray, Tuple[int, int]]]] = []  # packbits + shape
+        self._hashes = np.zeros((0, (hash_size * hash_size + 7) // 8), np.uint8)
+        self.hits = 0
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    @staticmethod
+    def _pack(mask: np.ndarray) -> Tuple[np.ndarray, Tuple[int, int]]:
+        return np.packbits(mask > 0), mask.shape
+
+    def _mask(self, i: int) -> np.ndarray:
+        if self._masks[i] is None: self._masks[i] = self._pack(ink_mask(self._images[i], self.scale))
+        packed, shape = self._masks[i]
+        return np.unpackbits(packed, count=shape[0] * shape[1]).reshape(shape) * np.uint8(255)
+
+    def match(self, key: Hashable, image: Any) -> Optional[Hashable]:
+        h = dhash(image, self.hash_size)
+        mask = None
+        if len(self._keys):
+            dist = np.unpackbits(self._hashes ^ h, axis=1).sum(axis=1)
+            near = [int(i) for i in np.argsort(dist, kind="stable")[: self.max_candidates] if dist[i] <= self.max_hamming]
+            if near:
+                mask = ink_mask(image, self.scale)
+                limit = max(self.max_ink_px, int(self.max_ink_frac * mask.size))
+                for i in near:
+                    if ink_difference(self._mask(i), mask, self.tolerance) <= limit:
+                        self.hits += 1
+                        return self._keys[i]
+        self._keys.append(key)
+        self._images.append(image if self.lazy else None)
+        if mask is None and not self.lazy: mask = ink_mask(image, self.scale)
+        self._masks.append(self._pack(mask) if mask is not None else None)
+        self._hashes = np.vstack([self._hashes, h[None]])
+        return None
+
+
+def page_index() -> DedupeIndex:
+    """Index for aligned pages: 256-bit hash (a shared template alone rarely collides), compared at 1/2 scale."""
+    return DedupeIndex(hash_size=16, max_hamming=12, scale=0.5, tolerance=2, max_ink_px=24, max_ink_frac=0.0001,
+                       max_candidates=4, lazy=False)
@@ -1,9 +1,13 @@
 # services/exam_gen_service.py
 # -*- coding: utf-8 -*-
-# Module-Version: v2026.01.23-Layout-Spacing-Fix
+# Module-Version: v2026.02.08-Layout-Manifest
 # Description: 
 # 1. [Fix] Compact Header: 增加 subtitle 與 學生資料欄之間的間距 (0.4cm)。
 # 2. [Core] 保留完整 LaTeX 生成邏輯與字型偵測。
+# 3. [Perf] Layout Manifest: 每個答案框以 \pdfsavepos 記錄位置 (exam.boxes)，
+#    編譯後轉成對齊 A4 frame 座標存入 DB，批改時依 QR 直接裁切，免輪廓偵測。
+# 4. [Fix] _get_font_config 縮排錯誤 (模組無法 import) 並回傳 (main, sans, mono)。
+# 5. [Feat] use_aruco: 四角改印 ArUco 定位碼 (DICT_4X4_50, id 0~3)，VisionService 可快速且穩定地對齊。
 
 import os
 import sys 
@@ -18,65 +22,81 @@ import shutil
 import platform
 from math import ceil
 from utils.localization import t
-from database.db_manager import get_sys_conf
+from database.db_manager import get_sys_conf, save_exam_layout
 from services.plans import get_plan_config
+from services.layout_manifest import parse_boxes_file, forget_manifest
+from services.vision_service import ARUCO_DICT_NAME, ARUCO_IDS, ARUCO_OFFSET_CM, ARUCO_SIZE_CM
 
 class ExamBuilder:
     def __init__(self):
         self.compiler = "xelatex"
         self.logger = logging.getLogger(__name__)
+        self.last_layout_manifest = None  # 最近一次 compile_tex_to_pdf 產生的答案框版面
 
     def _get_font_config(self):
-    """
-    [Font Strategy]
-    偵測字型路徑，支援子目錄遞迴搜尋，確保 ~/Library/Fonts 也能抓到。
-    """
-    if getattr(sys, 'frozen', False):
-        application_path = os.path.dirname(sys.executable)
-    else:
-        application_path = os.getcwd()
+        """
+        [Font Strategy]
+        偵測字型路徑，支援子目錄遞迴搜尋，確保 ~/Library/Fonts 也能抓到。
+        """
+        if getattr(sys, 'frozen', False):
+            application_path = os.path.dirname(sys.executable)
+        else:
+            application_path = os.getcwd()
         
-    local_fonts_dir = os.path.join(application_path, "fonts")
-
-    cwtex_targets = {
-        "main": "cwTeXQMing-Medium.ttf",
-        "sans": "cwTeXQHei-Bold.ttf",
-        "mono": "cwTeXQYuan-Medium.ttf"
-    }
-
-    # 定義基礎搜尋路徑
-    base_search_paths = [
-        local_fonts_dir,
-        os.path.expanduser("~/Library/Fonts"), # [新增] macOS 用戶路徑
-        "/Library/Fonts",                      # macOS 系統路徑
-        "/usr/share/fonts",                    # Linux 系統路徑
-        os.path.expanduser("~/.local/share/fonts") # Linux 用戶路徑
-    ]
+        local_fonts_dir = os.path.join(application_path, "fonts")
+
+        cwtex_targets = {
+            "main": "cwTeXQMing-Medium.ttf",
+            "sans": "cwTeXQHei-Bold.ttf",
+            "mono": "cwTeXQYuan-Medium.ttf"
+        }
+
+        # 定義基礎搜尋路徑
+        base_search_paths = [
+            local_fonts_dir,
+            os.path.expanduser("~/Library/Fonts"), # [新增] macOS 用戶路徑
+            "/Library/Fonts",                      # macOS 系統路徑
+            "/usr/share/fonts",                    # Linux 系統路徑
+            os.path.expanduser("~/.local/share/fonts") # Linux 用戶路徑
+        ]
     
-    # 如果是 Windows，加入 Windows 字型路徑
-    if platform.system() == "Windows":
-        base_search_paths.append(os.path.join(os.environ.get('WINDIR', 'C:\\Windows'), 'Fonts'))
-
-    found_fonts = {}
-
-    # 執行遞迴搜尋
-    for key, filename in cwtex_targets.items():
-        font_path = None
-        for base_path in base_search_paths:
-            if not os.path.exists(base_path):
-                continue
+        # 如果是 Windows，加入 Windows 字型路徑
+        if platform.system() == "Windows":
+            base_search_paths.append(os.path.join(os.environ.get('WINDIR', 'C:\\Windows'), 'Fonts'))
+
+        found_fonts = {}
+
+        # 執行遞迴搜尋
+        for key, filename in cwtex_targets.items():
+            font_path = None
+            for base_path in base_search_paths:
+                if not os.path.exists(base_path):
+                    continue
             
-            # [NEW] 使用 os.walk 進行子目錄遞迴搜尋
-            for root, dirs, files in os.walk(base_path):
-                if filename in files:
-                    font_path = os.path.join(root, filename)
-                    break
-            if font_path: break
+                # [NEW] 使用 os.walk 進行子目錄遞迴搜尋
+                for root, dirs, files in os.walk(base_path):
+                    if filename in files:
+                        font_path = os.path.join(root, filename)
+                        break
+                if font_path: break
         
-        # 存入找到的絕對路徑，若找不到則保留檔名讓系統回退 (Fallback)
-        found_fonts[key] = font_path if font_path else filename
+            # 只記錄找到的絕對路徑；找不到的交給 _get_font_config2 回退 (Fallback)
+            if font_path: found_fonts[key] = font_path
+
+        # [Fix] generate_tex_source 需要 (main, sans, mono) 的 fontspec 參數字串
+        if "main" not in found_fonts:
+            return self._get_font_config2()
+
+        def make_cmd(path):
+            dir_path = os.path.dirname(path).replace("\\", "/")
+            if not dir_path.endswith("/"): dir_path += "/"
+            return f"[Path={dir_path}, AutoFakeBold=3, AutoFakeSlant=.2]{{{os.path.basename(path)}}}"
+
+        main = make_cmd(found_fonts["main"])
+        sans = make_cmd(found_fonts["sans"]) if "sans" in found_fonts else main
+        mono = make_cmd(found_fonts["mono"]) if "mono" in found_fonts else main
+        return main, sans, mono
 
-    return found_fonts
     def _get_font_config2(self):
         """
         [Font Strategy]
@@ -152,6 +172,16 @@ class ExamBuilder:
             img.save(save_path)
         except Exception as e: self.logger.error(f"QR Gen Failed: {e}")
 
+    def _generate_aruco_files(self, temp_dir: str):
+        try:
+            import cv2
+            dictionary = cv2.aruco.getPredefinedDictionary(getattr(cv2.aruco, ARUCO_DICT_NAME))
+            for marker_id in ARUCO_IDS:
+                # 6x6 cells (4x4 bits + 1 border)，每格 40px，PDF 內縮放為 ARUCO_SIZE_CM
+                img = cv2.aruco.generateImageMarker(dictionary, marker_id, 240, borderBits=1)
+                cv2.imwrite(os.path.join(temp_dir, f"aruco_{marker_id}.png"), img)
+        except Exception as e: self.logger.error(f"ArUco Gen Failed: {e}")
+
     def clean_latex_content(self, text):
         if not text: return ""
         text = str(text).replace('\u00A0', ' ')
@@ -178,6 +208,7 @@ class ExamBuilder:
         total_score_str = self.calc_total_score(questions)
         
         is_compact = header_info.get('is_compact', False)
+        use_aruco = header_info.get('use_aruco', False)
         layout_mode = header_info.get('layout_mode', 'combined')
 
         lbl_score_unit = t('lbl_score_unit')
@@ -224,12 +255,28 @@ class ExamBuilder:
         tex.append(r"\newif\ifanswersheet")
         tex.append(r"\answersheetfalse") 
 
+        # [LAYOUT MANIFEST] 答案框左上角 (tikz 原點) 的頁面座標，於 shipout 時寫入 \jobname.boxes
+        tex.append(r"\newwrite\boxposfile")
+        tex.append(r"\AtBeginDocument{\immediate\openout\boxposfile=\jobname.boxes \immediate\write\boxposfile{PAPER \the\paperwidth\space\the\paperheight}}")
+        tex.append(r"\newcommand{\recordanswerbox}[3]{\pgftext[left,base,at={\pgfpointorigin}]{\pdfsavepos"
+                   r"\edef\recordanswerboxtmp{\noexpand\write\boxposfile{BOX #1 \noexpand\thepage\space\noexpand\the\noexpand\pdflastxpos\space\noexpand\the\noexpand\pdflastypos\space\the\dimexpr #2\relax\space\the\dimexpr #3\relax}}"
+                   r"\recordanswerboxtmp}}")
+
         # [MARKERS & SYSTEM QR]
         tex.append(r"\AddToShipoutPictureFG{\begin{tikzpicture}[remember picture, overlay]")
-        tex.append(r"\fill[black] ([xshift=0.5cm, yshift=-0.5cm]current page.north west) rectangle ++(0.3, -0.3);")
-        tex.append(r"\fill[black] ([xshift=-0.5cm, yshift=-0.5cm]current page.north east) rectangle ++(-0.3, -0.3);")
-        tex.append(r"\fill[black] ([xshift=0.5cm, yshift=0.5cm] current page.south west) rectangle ++(0.3, 0.3);")
-        tex.append(r"\fill[black] ([xshift=-0.5cm, yshift=0.5cm] current page.south east) rectangle ++(-0.3, 0.3);")
+        if use_aruco:
+            # ArUco id 0~3 = TL, TR, BR, BL (圖檔由 compile_tex_to_pdf 產生)
+            off, size = ARUCO_OFFSET_CM, ARUCO_SIZE_CM
+            corners = [("north west", "north west", off, -off), ("north east", "north east", -off, -off),
+                       ("south east", "south east", -off, off), ("south west", "south west", off, off)]
+            for marker_id, (anchor, page_corner, dx, dy) in zip(ARUCO_IDS, corners):
+                tex.append(rf"\node[anchor={anchor}, inner sep=0pt] at ([xshift={dx}cm, yshift={dy}cm]current page.{page_corner}) "
+                           rf"{{\IfFileExists{{aruco_{marker_id}.png}}{{\includegraphics[width={size}cm]{{aruco_{marker_id}.png}}}}{{}}}};")
+        else:
+            tex.append(r"\fill[black] ([xshift=0.5cm, yshift=-0.5cm]current page.north west) rectangle ++(0.3, -0.3);")
+            tex.append(r"\fill[black] ([xshift=-0.5cm, yshift=-0.5cm]current page.north east) rectangle ++(-0.3, -0.3);")
+            tex.append(r"\fill[black] ([xshift=0.5cm, yshift=0.5cm] current page.south west) rectangle ++(0.3, 0.3);")
+            tex.append(r"\fill[black] ([xshift=-0.5cm, yshift=0.5cm] current page.south east) rectangle ++(-0.3, 0.3);")
         
         tex.append(r"\node[anchor=south east, inner sep=0pt] at ([xshift=-2.0cm, yshift=1.5cm]current page.south east) {")
         tex.append(r"\ifanswersheet")
@@ -384,6 +431,7 @@ class ExamBuilder:
                                         tex.append(r"\textbf{(" + sub_letter + r")} ({\small " + str(sq_score) + lbl_score_unit + r"}) " + sq_text + r"\par\vspace{2pt}")
                                         tex.append(r"\noindent\begin{tikzpicture}")
                                         tex.append(r"\draw[line width=0.8pt, color=black] (0,0) rectangle (\linewidth, -" + box_h + r");")
+                                        tex.append(r"\recordanswerbox{" + label_str.strip("[]") + r"}{\linewidth}{" + box_h + r"}")
                                         tex.append(r"\node[anchor=north west, inner sep=3pt] at (0, 0) {\small \textbf{" + label_str + r"}};")
                                         tex.append(r"\end{tikzpicture}")
                                     elif mode == "text_only":
@@ -392,6 +440,7 @@ class ExamBuilder:
                                         tex.append(r"\textbf{(" + sub_letter + r")} \par\vspace{2pt}")
                                         tex.append(r"\noindent\begin{tikzpicture}")
                                         tex.append(r"\draw[line width=0.8pt, color=black] (0,0) rectangle (\linewidth, -" + box_h + r");")
+                                        tex.append(r"\recordanswerbox{" + label_str.strip("[]") + r"}{\linewidth}{" + box_h + r"}")
                                         tex.append(r"\node[anchor=north west, inner sep=3pt] at (0, 0) {\small \textbf{" + label_str + r"}};")
                                         tex.append(r"\end{tikzpicture}")
                                     tex.append(r"\end{minipage}\hfill")
@@ -403,6 +452,7 @@ class ExamBuilder:
                             tex.append(r"\par\vspace{0.1cm}")
                             tex.append(r"\noindent\begin{tikzpicture}")
                             tex.append(r"\draw[line width=0.8pt, color=black] (0,0) rectangle (\linewidth, -" + box_h + r");")
+                            tex.append(r"\recordanswerbox{" + label_str.strip("[]") + r"}{\linewidth}{" + box_h + r"}")
                             tex.append(r"\node[anchor=north west, inner sep=3pt] at (0, 0) {\small \textbf{" + label_str + r"}};")
                             tex.append(r"\end{tikzpicture}\par\vspace{0.3cm}")
                         elif mode == "box_only":
@@ -410,6 +460,7 @@ class ExamBuilder:
                             tex.append(r"\mbox{} \par\vspace{2pt}") 
                             tex.append(r"\noindent\begin{tikzpicture}")
                             tex.append(r"\draw[line width=0.8pt, color=black] (0,0) rectangle (\linewidth, -" + box_h + r");")
+                            tex.append(r"\recordanswerbox{" + label_str.strip("[]") + r"}{\linewidth}{" + box_h + r"}")
                             tex.append(r"\node[anchor=north west, inner sep=3pt] at (0, 0) {\small \textbf{" + label_str + r"}};")
                             tex.append(r"\end{tikzpicture}\par\vspace{0.3cm}")
                     
@@ -424,6 +475,7 @@ class ExamBuilder:
                              label_str = f"[Q{q_idx+1}]"
                              tex.append(r"\par\vspace{0.1cm}\noindent\begin{tikzpicture}")
                              tex.append(r"\draw[line width=0.8pt, color=black] (0,0) rectangle (2cm, -1.5cm);")
+                             tex.append(r"\recordanswerbox{" + label_str.strip("[]") + r"}{2cm}{1.5cm}")
                              tex.append(r"\node[anchor=north west, inner sep=1pt] at (0, 0) {\scriptsize \textbf{" + label_str + r"}};")
                              tex.append(r"\end{tikzpicture}")
 
@@ -488,18 +540,24 @@ class ExamBuilder:
             marketing_url, 
             logo_path=logo_path_to_use
         )
+
+        # [Layout Manifest] 存入 DB，批改時依 QR (EXAM_ID-P{n}) 直接裁切答案框
+        if pdf_bytes and self.last_layout_manifest:
+            if save_exam_layout(exam_id, self.last_layout_manifest): forget_manifest(exam_id)
         
         safe_title = re.sub(r'[\\/*?:"<>|]', "", header_info.get('title', 'Exam'))
         safe_subject = re.sub(r'[\\/*?:"<>|]', "", header_info.get('subject', 'General'))
         return pdf_bytes, f"{safe_title}_{safe_subject}.pdf"
 
     def compile_tex_to_pdf(self, tex_source, exam_id, system_qr_content, marketing_url, logo_path=None):
+        self.last_layout_manifest = None
         with tempfile.TemporaryDirectory() as temp_dir:
             for i in range(1, 15): 
                 self._generate_qr_file(f"{system_qr_content}-P{i}", os.path.join(temp_dir, f"qrcode_p{i}.png"))
                 self._generate_qr_file(f"{system_qr_content}-Q{i}", os.path.join(temp_dir, f"qrcode_q{i}.png"))
 
             if marketing_url: self._generate_qr_file(marketing_url, os.path.join(temp_dir, "marketing_qr.png"))
+            if "aruco_0.png" in tex_source: self._generate_aruco_files(temp_dir)
 
             if logo_path and os.path.exists(logo_path):
                 target_logo = os.path.join(temp_dir, "logo.png")
@@ -513,6 +571,10 @@ class ExamBuilder:
                 subprocess.run(cmd, cwd=temp_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False)
                 subprocess.run(cmd, cwd=temp_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False)
                 pdf_path = os.path.join(temp_dir, "exam.pdf")
+                boxes_path = os.path.join(temp_dir, "exam.boxes")
+                if os.path.exists(boxes_path):
+                    with open(boxes_path, "r", encoding="utf-8", errors="ignore") as f:
+                        self.last_layout_manifest = parse_boxes_file(f.read())
                 if os.path.exists(pdf_path):
                     with open(pdf_path, "rb") as f: return f.read()
                 return None
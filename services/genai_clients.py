@@ -0,0 +1,118 @@
+# Copyright (c) 2026 [謝忠村/Chung Tsun Shieh]. All Rights Reserved.
+# This software is proprietary and confidential.
+# Unauthorized copying of this file, via any medium is strictly prohibited.
+
+# services/genai_clients.py
+# -*- coding: utf-8 -*-
+# Module-Version: v2026.02.19-Client-Pool
+# Description:
+# 1. [Perf] ClientRegistry：每個 API Key (+ timeout) 只建立一個 genai.Client，所有批改執行緒共用。
+#    原本每次請求都 new 一個 Client：重新組 HttpOptions、重建 httpx 連線池，TLS 握手無法沿用。
+# 2. [Perf] 共用的 httpx 連線池開啟 keep-alive，上限由 config.GENAI_MAX_CONNECTIONS / GENAI_MAX_KEEPALIVE /
+#    GENAI_KEEPALIVE_EXPIRY 設定 (sync 與 client.aio 各一組，設定相同)。
+# 3. [Safety] genai.Client 的 models.generate_content 可跨執行緒呼叫 (httpx.Client 本身 thread-safe)；
+#    registry 以 lock 保護建立流程，同一把 Key 同時首次呼叫也只會建一個。Key 本身不寫入 log。
+
+import hashlib
+import logging
+import threading
+from typing import Dict, Optional, Tuple
+
+import httpx
+from google import genai
+from google.genai import types
+
+logger = logging.getLogger(__name__)
+
+
+def key_fingerprint(api_key: str) -> str:
+    """Short, non-reversible label for logs / stats (never log the key itself)."""
+    return hashlib.sha256((api_key or "").strip().encode("utf-8")).hexdigest()[:8]
+
+
+class ClientRegistry:
+    """
+    Process-wide genai.Client instances keyed by (API key, timeout in ms). Each client owns one pooled
+    httpx.Client / httpx.AsyncClient pair, so repeated calls on the same key reuse warm keep-alive connections.
+    """
+
+    def __init__(self, max_connections: int = 64, max_keepalive: int = 64, keepalive_expiry: float = 90.0,
+                 default_timeout_ms: Optional[int] = None, base_url: Optional[str] = None):
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive,
+                                   keepalive_expiry=keepalive_expiry)
+        self.default_timeout_ms = default_timeout_ms
+        self.base_url = base_url
+        self._clients: Dict[Tuple[str, Optional[int]], genai.Client] = {}
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+
+    def _build(self, api_key: str, timeout_ms: Optional[int]) -> genai.Client:
+        options = types.HttpOptions(base_url=self.base_url, timeout=timeout_ms, client_args={"limits": self.limits},
+                                    async_client_args={"limits": self.limits})
+        return genai.Client(api_key=api_key, http_options=options)
+
+    def get(self, api_key: str, timeout_ms: Optional[int] = None) -> genai.Client:
+        if not api_key: raise ValueError("Missing API Key")
+        api_key = api_key.strip()
+        key = (api_key, timeout_ms if timeout_ms is not None else self.default_timeout_ms)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is not None:
+                self.reused += 1
+                return client
+            client = self._build(*key)
+            self._clients[key] = client
+            self.created += 1
+        logger.info(f"genai client created (key {key_fingerprint(api_key)}, timeout={key[1]} ms, "
+                    f"pool {self.limits.max_connections}/{self.limits.max_keepalive_connections})")
+        return client
+
+    def discard(self, api_key: str) -> None:
+        """Drops (and closes) every client of one key, e.g. after the user replaced an invalid key."""
+        api_key = (api_key or "").strip()
+        with self._lock:
+            stale = [k for k in self._clients if k[0] == api_key]
+            clients = [self._clients.pop(k) for k in stale]
+        for client in clients: self._close(client)
+
+    def close_all(self) -> None:
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+        for client in clients: self._close(client)
+
+    @staticmethod
+    def _close(client: genai.Client) -> None:
+        try:
+            client.close()
+        except Exception as e:
+            logger.debug(f"genai client close failed: {e}")
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"clients": len(self._clients), "created": self.created, "reused": self.reused}
+
+
+_default_registry: Optional[ClientRegistry] = None
+_default_lock = threading.Lock()
+
+
+def get_client_registry() -> ClientRegistry:
+    """Process-wide registry configured from config.GENAI_MAX_CONNECTIONS / GENAI_MAX_KEEPALIVE / GENAI_KEEPALIVE_EXPIRY."""
+    global _default_registry
+    with _default_lock:
+        if _default_registry is None:
+            import config
+            _default_registry = ClientRegistry(
+                max_connections=getattr(config, "GENAI_MAX_CONNECTIONS", 64),
+                max_keepalive=getattr(config, "GENAI_MAX_KEEPALIVE", 64),
+                keepalive_expiry=getattr(config, "GENAI_KEEPALIVE_EXPIRY", 90.0),
+                default_timeout_ms=getattr(config, "GENAI_TIMEOUT_MS", 0) or None,
+            )
+        return _default_registry
+
+
+def get_client(api_key: str, timeout_ms: Optional[int] = None) -> genai.Client:
+    """Shared genai.Client for `api_key` (created on first use). timeout_ms=None uses config.GENAI_TIMEOUT_MS."""
+    return get_client_registry().get(api_key, timeout_ms)
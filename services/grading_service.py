@@ -1,13 +1,20 @@
 # services/grading_service.py
 # -*- coding: utf-8 -*-
-# Module-Version: v2026.01.16-Anti-Hallucination-Fixed
+# Module-Version: v2026.02.22-Retry-Policy
 # Description: Logic execution layer. Enforces strict transcription for SymPy checks.
+# [Perf] 回應經 services/llm_cache.py 快取 (model / prompt / rubric / schema / temperature / 影像 bytes)；
+#        use_cache=False 強制重新批改。命中時 cost_usd = 0 並標記 "cached"。
+# [Perf] genai.Client 改由 services/genai_clients.get_client() 取得：每把 Key 共用一個 Client 與 keep-alive 連線池。
+# [Perf] agrade_submission / agrade_collage：同樣的 prompt / 後處理，改走 client.aio，供 asyncio 排程器大量並行。
+# [Perf] 請求經 services/rate_limiter.py (每把 Key 的 RPM / TPM bucket + AIMD 並行度) 送出，429 / 503 自動降速。
+# [Fix] 請求經 services/retry_policy.py 分類重試 (退避 + jitter、批次 retry_budget、斷路器)；最終失敗的結果帶 error / error_kind，
+#       呼叫端可分辨「服務失敗」與「模型漏批」。
 
 import json
 import re
-import io
+import asyncio
 import logging
-from typing import List, Optional, Any, Dict
+from typing import List, Optional, Any, Dict, Tuple, Union
 
 from services.prompt_service import PromptService 
 
@@ -23,10 +30,15 @@ try:
 except ImportError:
     sp = None
 
-from google import genai
 from google.genai import types
 from PIL import Image
 
+from utils.page_image import PageImage
+from services.upload_policy import EncodedImage, UploadPolicy, get_upload_policy
+from services.llm_cache import cached_generate, acached_generate
+from services.rate_limiter import estimate_tokens
+from services.retry_policy import RetryBudget, generate_with_retry, agenerate_with_retry, classify
+
 logger = logging.getLogger(__name__)
 if not logger.handlers:
     _h = logging.StreamHandler()
@@ -303,23 +315,30 @@ Write ALL comments in {language}.
     def get_subject_options() -> Dict[str, str]:
         return {k: f"[{k}]" for k in PromptService._PROMPTS.keys()}
 
+    @staticmethod
+    def _image_part(image: Union[PageImage, Image.Image, EncodedImage], policy: Optional[UploadPolicy] = None) -> types.Part:
+        """Image part encoded straight from the page buffer with the upload policy (default: config.UPLOAD_POLICY)."""
+        if isinstance(image, EncodedImage):
+            return types.Part.from_bytes(data=image.data, mime_type=image.mime_type)
+        data, mime_type = (policy or get_upload_policy()).encode(image)
+        return types.Part.from_bytes(data=data, mime_type=mime_type)
+
+    @staticmethod
+    def _part_bytes(parts: List[types.Part]) -> List[bytes]:
+        """Encoded image bytes of the request parts (the content-addressed half of the cache key)."""
+        return [p.inline_data.data for p in parts if getattr(p, "inline_data", None) is not None]
+
     # -------------------------------------------------------------------------
-    # MAIN ENTRY POINTS
+    # REQUEST BUILDING (shared by the sync and asyncio entry points)
     # -------------------------------------------------------------------------
     @staticmethod
-    def grade_submission(
-        images: List[Image.Image], rubric_text: str, user: Any, batch_id: str,
-        student_idx: int, mode: str, subject: str = "univ_math", ai_memory: str = "",
-        temperature: float = 0.0, model_id: str = "gemini-2.5-pro",
-        allowed_labels: Optional[List[str]] = None, language: str = "Traditional Chinese"
-    ) -> dict:
-        
-        if not getattr(user, "google_api_key", None):
-            return {"questions": [], "total_score": 0, "general_comment": "Missing API Key"}
-
-        client = genai.Client(api_key=user.google_api_key)
+    def _submission_request(
+        images: List[Union[PageImage, Image.Image, EncodedImage]], rubric_text: str, mode: str, subject: str,
+        ai_memory: str, temperature: float, language: str, upload_policy: Optional[UploadPolicy]
+    ) -> Tuple[str, List[types.Part], dict, float]:
+        """(prompt, image parts, response schema, temperature) of one full-submission request."""
         sys_instr = GradingService._get_grading_instruction(subject, mode, language, ai_memory)
-        
+
         schema = {
             "type": "OBJECT",
             "properties": {
@@ -374,52 +393,42 @@ Write ALL comments in {language}.
 
 Output JSON.
 """
-        content = [prompt]
-        for img in images:
-            buf = io.BytesIO(); img.save(buf, format="PNG")
-            content.append(types.Part.from_bytes(data=buf.getvalue(), mime_type="image/png"))
+        parts = [GradingService._image_part(img, upload_policy) for img in images]
+        temp = 0.0 if mode == "Strict" else temperature
+        return prompt, parts, schema, temp
 
-        try:
-            resp = client.models.generate_content(
-                model=model_id,
-                contents=content,
-                config=types.GenerateContentConfig(
-                    temperature=0.0 if mode == "Strict" else temperature,
-                    response_mime_type="application/json",
-                    response_schema=schema
-                )
-            )
-            res_json = json.loads(resp.text)
-            res_json = GradingService._sanitize_json(res_json)
-            
-            rubric_obj = GradingService._safe_parse_rubric(rubric_text)
-            if rubric_obj:
-                res_json = GradingService._apply_rubric_checks(res_json, rubric_obj, mode)
+    @staticmethod
+    def _finish_submission(text: str, usage: Any, cached: bool, rubric_text: str, mode: str, model_id: str) -> dict:
+        res_json = json.loads(text)
+        res_json = GradingService._sanitize_json(res_json)
 
-            res_json["cost_usd"] = GradingService._calculate_cost(model_id, resp.usage_metadata)
-            res_json["total_score"] = sum(float(q.get("score", 0)) for q in res_json.get("questions", []))
-            return res_json
+        rubric_obj = GradingService._safe_parse_rubric(rubric_text)
+        if rubric_obj:
+            res_json = GradingService._apply_rubric_checks(res_json, rubric_obj, mode)
 
-        except Exception as e:
-            logger.error(f"Grading Error: {e}")
-            return {"questions": [], "total_score": 0, "general_comment": str(e)}
+        res_json["cost_usd"] = GradingService._calculate_cost(model_id, usage)
+        if cached: res_json["cached"] = True
+        res_json["total_score"] = sum(float(q.get("score", 0)) for q in res_json.get("questions", []))
+        return res_json
 
     @staticmethod
-    def grade_collage_submission(
-        image: Image.Image, question_id: str, rubric_text: str, user: Any,
-        mode: str, subject: str, temperature: float, model_name: str,
-        allowed_labels: Optional[List[str]] = None, valid_indices: Optional[List[int]] = None,
-        language: str = "Traditional Chinese"
-    ):
-        if not getattr(user, "google_api_key", None): return {"results": [], "cost_usd": 0.0}
-        
+    def _collage_request(
+        question_id: str, rubric_text: str, mode: str, subject: str, language: str,
+        valid_indices: Optional[List[int]], grid_shape: Optional[Tuple[int, int]]
+    ) -> Tuple[str, dict]:
+        """(prompt, response schema) of one collage (one question, many students) request."""
         sys_instr = GradingService._get_grading_instruction(subject, mode, language, "")
         whitelist_msg = f"VALID INDICES: {valid_indices}. IGNORE other cells." if valid_indices else ""
-        
+        grid_msg = ""
+        if grid_shape:
+            rows, cols = grid_shape
+            grid_msg = f"GRID: {rows} row(s) x {cols} column(s), one student per cell, numbered row by row from 0 (red number at each cell's top-left)."
+
         # [MODIFIED] 插入 SYMPY_TRANSCRIPTION_RULES 到 prompt 中
         prompt = f"""
 {sys_instr}
 # TASK: GRADE GRID (Question: {question_id})
+- {grid_msg}
 - {whitelist_msg}
 {SYMPY_TRANSCRIPTION_RULES}
 - Comment must start with "學生寫：".
@@ -428,16 +437,155 @@ Output JSON.
 {rubric_text}
 """
         schema = {"type": "OBJECT", "properties": {"results": {"type": "ARRAY", "items": {"type": "OBJECT", "properties": {"index": {"type": "INTEGER"}, "score": {"type": "NUMBER"}, "reasoning": {"type": "STRING"}, "breakdown": {"type": "ARRAY", "items": {"type": "OBJECT", "properties": {"rule": {"type": "STRING"}, "score": {"type": "NUMBER"}, "comment": {"type": "STRING"}, "sympy_expr": {"type": "STRING"}}, "required": ["score", "comment"]}}}, "required": ["index", "score"]}}}}
+        return prompt, schema
+
+    @staticmethod
+    def _finish_collage(text: str, usage: Any, cached: bool, model_name: str) -> dict:
+        res = json.loads(text)
+        out = {"results": res.get("results", []), "cost_usd": GradingService._calculate_cost(model_name, usage)}
+        if cached: out["cached"] = True
+        return out
+
+    # -------------------------------------------------------------------------
+    # MAIN ENTRY POINTS
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def grade_submission(
+        images: List[Union[PageImage, Image.Image]], rubric_text: str, user: Any, batch_id: str,
+        student_idx: int, mode: str, subject: str = "univ_math", ai_memory: str = "",
+        temperature: float = 0.0, model_id: str = "gemini-2.5-pro",
+        allowed_labels: Optional[List[str]] = None, language: str = "Traditional Chinese",
+        upload_policy: Optional[UploadPolicy] = None, use_cache: bool = True,
+        retry_budget: Optional[RetryBudget] = None
+    ) -> dict:
+        
+        if not getattr(user, "google_api_key", None):
+            return {"questions": [], "total_score": 0, "general_comment": "Missing API Key"}
+
+        prompt, parts, schema, temp = GradingService._submission_request(
+            images, rubric_text, mode, subject, ai_memory, temperature, language, upload_policy)
+
+        try:
+            images_bytes = GradingService._part_bytes(parts)
+            text, usage, cached = cached_generate(
+                "grade_submission", model_id, prompt, images_bytes,
+                lambda: generate_with_retry(
+                    user.google_api_key, estimate_tokens(prompt, images_bytes), retry_budget,
+                    model=model_id,
+                    contents=[prompt] + parts,
+                    config=types.GenerateContentConfig(
+                        temperature=temp,
+                        response_mime_type="application/json",
+                        response_schema=schema
+                    )
+                ),
+                rubric_text=rubric_text, schema=schema, temperature=temp, use_cache=use_cache
+            )
+            return GradingService._finish_submission(text, usage, cached, rubric_text, mode, model_id)
+
+        except Exception as e:
+            logger.error(f"Grading Error: {e}")
+            return {"questions": [], "total_score": 0, "general_comment": str(e), "error": str(e), "error_kind": classify(e)}
+
+    @staticmethod
+    def grade_collage_submission(
+        image: Union[PageImage, Image.Image, EncodedImage], question_id: str, rubric_text: str, user: Any,
+        mode: str, subject: str, temperature: float, model_name: str,
+        allowed_labels: Optional[List[str]] = None, valid_indices: Optional[List[int]] = None,
+        language: str = "Traditional Chinese", upload_policy: Optional[UploadPolicy] = None,
+        grid_shape: Optional[Tuple[int, int]] = None, use_cache: bool = True,
+        retry_budget: Optional[RetryBudget] = None
+    ):
+        if not getattr(user, "google_api_key", None): return {"results": [], "cost_usd": 0.0}
+        prompt, schema = GradingService._collage_request(question_id, rubric_text, mode, subject, language, valid_indices, grid_shape)
+
+        try:
+            part = GradingService._image_part(image, upload_policy)
+            images_bytes = GradingService._part_bytes([part])
+            text, usage, cached = cached_generate(
+                "grade_collage", model_name, prompt, images_bytes,
+                lambda: generate_with_retry(
+                    user.google_api_key, estimate_tokens(prompt, images_bytes), retry_budget,
+                    model=model_name,
+                    contents=[prompt, part],
+                    config=types.GenerateContentConfig(temperature=temperature, response_mime_type="application/json", response_schema=schema)
+                ),
+                rubric_text=rubric_text, schema=schema, temperature=temperature, use_cache=use_cache
+            )
+            return GradingService._finish_collage(text, usage, cached, model_name)
+        except Exception as e:
+            logger.error(f"Collage Grading Error: {e}")
+            return {"results": [], "cost_usd": 0.0, "error": str(e), "error_kind": classify(e)}
+
+    # -------------------------------------------------------------------------
+    # ASYNCIO ENTRY POINTS (client.aio；由 services/async_grading.py 的 event-loop 執行緒驅動)
+    # -------------------------------------------------------------------------
+    @staticmethod
+    async def agrade_submission(
+        images: List[Union[PageImage, Image.Image, EncodedImage]], rubric_text: str, user: Any, batch_id: str,
+        student_idx: int, mode: str, subject: str = "univ_math", ai_memory: str = "",
+        temperature: float = 0.0, model_id: str = "gemini-2.5-pro",
+        allowed_labels: Optional[List[str]] = None, language: str = "Traditional Chinese",
+        upload_policy: Optional[UploadPolicy] = None, use_cache: bool = True,
+        retry_budget: Optional[RetryBudget] = None
+    ) -> dict:
+        """grade_submission() on the SDK's async client; image encoding runs in a worker thread, not on the loop."""
+        if not getattr(user, "google_api_key", None):
+            return {"questions": [], "total_score": 0, "general_comment": "Missing API Key"}
+
+        try:
+            prompt, parts, schema, temp = await asyncio.to_thread(
+                GradingService._submission_request,
+                images, rubric_text, mode, subject, ai_memory, temperature, language, upload_policy)
+            images_bytes = GradingService._part_bytes(parts)
+            text, usage, cached = await acached_generate(
+                "grade_submission", model_id, prompt, images_bytes,
+                lambda: agenerate_with_retry(
+                    user.google_api_key, estimate_tokens(prompt, images_bytes), retry_budget,
+                    model=model_id,
+                    contents=[prompt] + parts,
+                    config=types.GenerateContentConfig(
+                        temperature=temp,
+                        response_mime_type="application/json",
+                        response_schema=schema
+                    )
+                ),
+                rubric_text=rubric_text, schema=schema, temperature=temp, use_cache=use_cache
+            )
+            return GradingService._finish_submission(text, usage, cached, rubric_text, mode, model_id)
+
+        except Exception as e:
+            logger.error(f"Grading Error: {e}")
+            return {"questions": [], "total_score": 0, "general_comment": str(e), "error": str(e), "error_kind": classify(e)}
+
+    @staticmethod
+    async def agrade_collage(
+        image: Union[PageImage, Image.Image, EncodedImage], question_id: str, rubric_text: str, user: Any,
+        mode: str, subject: str, temperature: float, model_name: str,
+        allowed_labels: Optional[List[str]] = None, valid_indices: Optional[List[int]] = None,
+        language: str = "Traditional Chinese", upload_policy: Optional[UploadPolicy] = None,
+        grid_shape: Optional[Tuple[int, int]] = None, use_cache: bool = True,
+        retry_budget: Optional[RetryBudget] = None
+    ):
+        """grade_collage_submission() on the SDK's async client (collage payloads arrive already encoded)."""
+        if not getattr(user, "google_api_key", None): return {"results": [], "cost_usd": 0.0}
+        prompt, schema = GradingService._collage_request(question_id, rubric_text, mode, subject, language, valid_indices, grid_shape)
 
         try:
-            client = genai.Client(api_key=user.google_api_key)
-            buf = io.BytesIO(); image.save(buf, format="PNG")
-            resp = client.models.generate_content(
-                model=model_name,
-                contents=[prompt, types.Part.from_bytes(data=buf.getvalue(), mime_type="image/png")],
-                config=types.GenerateContentConfig(temperature=temperature, response_mime_type="application/json", response_schema=schema)
+            if isinstance(image, EncodedImage): part = GradingService._image_part(image)
+            else: part = await asyncio.to_thread(GradingService._image_part, image, upload_policy)
+            images_bytes = GradingService._part_bytes([part])
+            text, usage, cached = await acached_generate(
+                "grade_collage", model_name, prompt, images_bytes,
+                lambda: agenerate_with_retry(
+                    user.google_api_key, estimate_tokens(prompt, images_bytes), retry_budget,
+                    model=model_name,
+                    contents=[prompt, part],
+                    config=types.GenerateContentConfig(temperature=temperature, response_mime_type="application/json", response_schema=schema)
+                ),
+                rubric_text=rubric_text, schema=schema, temperature=temperature, use_cache=use_cache
             )
-            res = json.loads(resp.text)
-            return {"results": res.get("results", []), "cost_usd": GradingService._calculate_cost(model_name, resp.usage_metadata)}
+            return GradingService._finish_collage(text, usage, cached, model_name)
         except Exception as e:
-            return {"results": [], "cost_usd": 0.0, "error": str(e)}
+            logger.error(f"Collage Grading Error: {e}")
+            return {"results": [], "cost_usd": 0.0, "error": str(e), "error_kind": classify(e)}
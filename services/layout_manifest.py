@@ -0,0 +1,129 @@
+# Copyright (c) 2026 [謝忠村/Chung Tsun Shieh]. All Rights Reserved.
+# This software is proprietary and confidential.
+# Unauthorized copying of this file, via any medium is strictly prohibited.
+
+# services/layout_manifest.py
+# -*- coding: utf-8 -*-
+# Module-Version: v2026.02.08-Layout-Manifest
+# Description:
+# 1. [Perf] 系統出的考卷在編譯時就知道每個答案框的位置 (ExamBuilder 以 \pdfsavepos 寫出 .boxes)，
+#    轉成對齊後 A4 frame 座標存入 DB (exam_layouts)；批改時以 QR 上的 EXAM_ID 查表直接裁切，不做輪廓偵測。
+# 2. [Logic] 對齊 frame 的定義 (cm_to_aligned) 與 VisionService 共用：四角定位方塊中心 -> (0,0) ~ (W-1, H-1)。
+# 3. [Safety] 頁面未對齊 (找不到定位點) 時，以紙張尺寸比例換算回原始頁面座標。
+
+import re
+import logging
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from services.vision_service import (
+    ALIGNED_WIDTH, ALIGNED_HEIGHT, PAPER_W_CM, PAPER_H_CM, cm_to_aligned, aligned_to_cm
+)
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 1
+
+_PT_PER_CM = 72.27 / 2.54
+_SP_PER_PT = 65536.0
+
+
+def _dim_to_cm(token: str) -> float:
+    """'483.69687pt' -> cm"""
+    return float(token.replace("pt", "")) / _PT_PER_CM
+
+
+def parse_boxes_file(text: str) -> Optional[Dict]:
+    """
+    Parses the `.boxes` file written by ExamBuilder during xelatex shipout:
+        PAPER <paperwidth> <paperheight>
+        BOX <label> <page> <xpos sp> <ypos sp> <width> <height>
+    xpos/ypos are the top-left corner of the answer box, measured from the bottom-left of the page.
+    Returns the manifest dict (boxes in the aligned A4 frame) or None if nothing usable was found.
+    """
+    paper_h_cm = PAPER_H_CM
+    pages: Dict[str, List[Dict]] = {}
+    for line in (text or "").splitlines():
+        parts = line.split()
+        if not parts: continue
+        try:
+            if parts[0] == "PAPER" and len(parts) >= 3:
+                paper_h_cm = _dim_to_cm(parts[2])
+            elif parts[0] == "BOX" and len(parts) >= 7:
+                label, page = parts[1], int(parts[2])
+                x_cm = int(parts[3]) / _SP_PER_PT / _PT_PER_CM
+                y_cm = paper_h_cm - int(parts[4]) / _SP_PER_PT / _PT_PER_CM
+                w_cm, h_cm = _dim_to_cm(parts[5]), _dim_to_cm(parts[6])
+                x0, y0 = cm_to_aligned(x_cm, y_cm)
+                x1, y1 = cm_to_aligned(x_cm + w_cm, y_cm + h_cm)
+                box = [int(round(x0)), int(round(y0)), int(round(x1 - x0)), int(round(y1 - y0))]
+                pages.setdefault(str(page), []).append({"label": label, "box": box})
+        except (ValueError, IndexError):
+            logger.warning(f"Skipping malformed layout line: {line!r}")
+
+    if not pages: return None
+    return {"version": MANIFEST_VERSION, "frame": [ALIGNED_WIDTH, ALIGNED_HEIGHT], "pages": pages}
+
+
+_SYSTEM_QR = re.compile(r'^(.+)-(P|Page|Q)(\d+)$')
+
+
+def parse_qr_exam_id(qr_content: Optional[str]) -> Optional[str]:
+    """'EXAM_1A2B3C4D-P2' / '-Q1' -> 'EXAM_1A2B3C4D'"""
+    if not qr_content: return None
+    match = _SYSTEM_QR.match(qr_content.strip())
+    return match.group(1) if match else None
+
+
+def to_page_frame(box, image_shape, is_aligned: bool) -> Tuple[int, int, int, int]:
+    """
+    Manifest boxes are in the aligned frame. For a page that could not be aligned,
+    map them onto the raw page assuming it is the full A4 sheet.
+    """
+    x, y, w, h = box
+    if is_aligned: return int(x), int(y), int(w), int(h)
+    img_h, img_w = image_shape[:2]
+    x0_cm, y0_cm = aligned_to_cm(x, y)
+    x1_cm, y1_cm = aligned_to_cm(x + w, y + h)
+    sx, sy = img_w / PAPER_W_CM, img_h / PAPER_H_CM
+    return (int(round(x0_cm * sx)), int(round(y0_cm * sy)),
+            int(round((x1_cm - x0_cm) * sx)), int(round((y1_cm - y0_cm) * sy)))
+
+
+# ------------------------------------------------------------------------------
+# Lookup (DB-backed, memoized per process)
+# ------------------------------------------------------------------------------
+_memo: Dict[str, Optional[Dict]] = {}
+_memo_lock = threading.Lock()
+
+
+def get_manifest(exam_id: str) -> Optional[Dict]:
+    with _memo_lock:
+        if exam_id in _memo: return _memo[exam_id]
+    try:
+        from database.db_manager import get_exam_layout
+        manifest = get_exam_layout(exam_id)
+    except Exception as e:
+        logger.warning(f"Layout manifest lookup failed for {exam_id}: {e}")
+        return None
+    with _memo_lock:
+        _memo[exam_id] = manifest
+    return manifest
+
+
+def forget_manifest(exam_id: str) -> None:
+    with _memo_lock:
+        _memo.pop(exam_id, None)
+
+
+def lookup_page_boxes(qr_content: Optional[str]) -> Optional[List[Dict]]:
+    """
+    Decoded system QR -> [{"label", "box"}] for that answer-sheet page (aligned frame),
+    [] for a known exam page without boxes, None when the exam has no manifest.
+    """
+    match = _SYSTEM_QR.match(qr_content.strip()) if qr_content else None
+    if not match: return None
+    manifest = get_manifest(match.group(1))
+    if not manifest: return None
+    if match.group(2) == "Q": return []  # 題目卷頁面 (separate 模式) 沒有答案框
+    return list(manifest.get("pages", {}).get(match.group(3), []))
@@ -0,0 +1,212 @@
+# Copyright (c) 2026 [謝忠村/Chung Tsun Shieh]. All Rights Reserved.
+# This software is proprietary and confidential.
+# Unauthorized copying of this file, via any medium is strictly prohibited.
+
+# services/llm_cache.py
+# -*- coding: utf-8 -*-
+# Module-Version: v2026.02.18-LLM-Cache
+# Description:
+# 1. [Perf] LLMCache：Gemini 回應的本機快取 (SQLite)，Key = sha256(model, prompt, rubric, schema, temperature, 影像 bytes)。
+#    同一份 Rubric + 同樣的掃描重跑 (當機後重來、UI rerun、重新產生報表) 直接取回，不再送出請求。
+# 2. [Logic] 只存模型原始回應文字 (resp.text)；解析 / SymPy 驗算等後處理每次照常執行，命中時費用記為 0。
+# 3. [Safety] TTL (config.LLM_CACHE_TTL_DAYS) 過期即視為未命中；總容量超過 LLM_CACHE_MAX_MB 時依最後使用時間淘汰。
+# 4. [Config] cached_generate() 包住一次請求；呼叫端傳 use_cache=False (刻意重新批改) 時略過查詢，但仍以新回應覆寫快取。
+# 5. [Perf] acached_generate()：asyncio 版本 (client.aio)。SQLite 讀寫在 1 ms 內，直接在 event loop 上執行。
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_VERSION = 1
+EVICT_TARGET = 0.9   # 淘汰到容量上限的 90%，避免每次寫入都觸發
+
+
+class LLMCache:
+    """
+    SQLite-backed response cache shared by every grading thread (one connection, serialized by a lock).
+    Values are small JSON documents ({"text": ...}); hits bump `accessed`, which is the LRU clock.
+    """
+
+    def __init__(self, path: str, max_bytes: int, ttl_seconds: float):
+        self.path = path
+        self.max_bytes = int(max_bytes)
+        self.ttl_seconds = float(ttl_seconds)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " key TEXT PRIMARY KEY, kind TEXT, model TEXT, value TEXT NOT NULL, size INTEGER NOT NULL,"
+                " created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_accessed ON responses(accessed)")
+            self._conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+            self._conn.commit()
+
+    # ------------------------------------------------------------------
+    # Keys
+    # ------------------------------------------------------------------
+    @staticmethod
+    def make_key(model_id: str, prompt: str, rubric_text: str = "", schema: Any = None,
+                 temperature: Optional[float] = None, images: Iterable[bytes] = ()) -> str:
+        """Content address of one request: every input that can change the model's answer."""
+        h = hashlib.sha256()
+        header = json.dumps({"v": SCHEMA_VERSION, "model": model_id, "temperature": temperature,
+                             "schema": schema}, sort_keys=True, ensure_ascii=False, default=str)
+        for part in (header, prompt or "", rubric_text or ""):
+            data = part.encode("utf-8")
+            h.update(len(data).to_bytes(8, "little")); h.update(data)
+        for blob in images:
+            h.update(len(blob).to_bytes(8, "little")); h.update(hashlib.sha256(blob).digest())
+        return h.hexdigest()
+
+    # ------------------------------------------------------------------
+    # Lookup / store
+    # ------------------------------------------------------------------
+    def get(self, key: str) -> Optional[Dict]:
+        now = time.time()
+        try:
+            with self._lock:
+                row = self._conn.execute("SELECT value, created FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None and self.ttl_seconds > 0 and now - row[1] > self.ttl_seconds:
+                    self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self._conn.commit()
+                    row = None
+                if row is None:
+                    self.misses += 1
+                    return None
+                self._conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+                self._conn.commit()
+                self.hits += 1
+            return json.loads(row[0])
+        except Exception as e:
+            logger.warning(f"LLM cache read failed ({key[:12]}): {e}")
+            with self._lock: self.misses += 1
+            return None
+
+    def put(self, key: str, value: Dict, kind: str = "", model: str = "") -> None:
+        try:
+            data = json.dumps(value, ensure_ascii=False)
+            now = time.time()
+            with self._lock:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO responses (key, kind, model, value, size, created, accessed) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (key, kind, model, data, len(data.encode("utf-8")), now, now))
+                self._conn.commit()
+            self.evict()
+        except Exception as e:
+            logger.warning(f"LLM cache write failed ({key[:12]}): {e}")
+
+    # ------------------------------------------------------------------
+    # Maintenance
+    # ------------------------------------------------------------------
+    def evict(self) -> int:
+        """Drops expired rows, then least-recently-used rows until the cache fits in max_bytes. Returns rows removed."""
+        removed = 0
+        with self._lock:
+            if self.ttl_seconds > 0:
+                removed += self._conn.execute("DELETE FROM responses WHERE created < ?",
+                                              (time.time() - self.ttl_seconds,)).rowcount
+            total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total > self.max_bytes:
+                target = int(self.max_bytes * EVICT_TARGET)
+                cutoff = None
+                for size, accessed in self._conn.execute("SELECT size, accessed FROM responses ORDER BY accessed"):
+                    if total <= target: break
+                    total -= size; cutoff = accessed
+                if cutoff is not None:
+                    removed += self._conn.execute("DELETE FROM responses WHERE accessed <= ?", (cutoff,)).rowcount
+            if removed: self._conn.commit()
+        return removed
+
+    def stats(self) -> Dict:
+        with self._lock:
+            rows, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+            return {"hits": self.hits, "misses": self.misses, "entries": rows, "bytes": size}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+
+
+_default_cache: Optional[LLMCache] = None
+_default_failed = False
+_default_lock = threading.Lock()
+
+
+def get_llm_cache() -> Optional[LLMCache]:
+    """Process-wide cache configured from config.LLM_CACHE_PATH / LLM_CACHE_MAX_MB / LLM_CACHE_TTL_DAYS (None = disabled)."""
+    global _default_cache, _default_failed
+    with _default_lock:
+        if _default_cache is None and not _default_failed:
+            import config
+            max_mb = getattr(config, "LLM_CACHE_MAX_MB", 0)
+            if not max_mb or max_mb <= 0: return None
+            try:
+                _default_cache = LLMCache(config.LLM_CACHE_PATH, max_mb * 1024 * 1024,
+                                          getattr(config, "LLM_CACHE_TTL_DAYS", 30) * 86400)
+            except Exception as e:
+                logger.error(f"LLM cache unavailable ({getattr(config, 'LLM_CACHE_PATH', '?')}): {e}")
+                _default_failed = True
+        return _default_cache
+
+
+def _lookup(model_id: str, prompt: str, images: Iterable[bytes], rubric_text: str, schema: Any,
+            temperature: Optional[float], use_cache: bool) -> Tuple[Optional[LLMCache], Optional[str], Optional[str]]:
+    """(cache, key, cached text or None) for one request; cache is None when caching is disabled."""
+    cache = get_llm_cache()
+    if cache is None: return None, None, None
+    key = LLMCache.make_key(model_id, prompt, rubric_text, schema, temperature, images)
+    if use_cache:
+        hit = cache.get(key)
+        if hit and isinstance(hit.get("text"), str): return cache, key, hit["text"]
+    return cache, key, None
+
+
+def _store(cache: Optional[LLMCache], key: Optional[str], resp: Any, kind: str, model_id: str,
+           validate: Optional[Callable[[str], Any]]) -> Tuple[str, Any, bool]:
+    text = resp.text
+    if cache is not None and text:
+        try:
+            if validate is not None: validate(text)
+            cache.put(key, {"text": text}, kind=kind, model=model_id)
+        except Exception:
+            pass
+    return text, getattr(resp, "usage_metadata", None), False
+
+
+def cached_generate(kind: str, model_id: str, prompt: str, images: Iterable[bytes], generate: Callable[[], Any],
+                    rubric_text: str = "", schema: Any = None, temperature: Optional[float] = None,
+                    use_cache: bool = True, validate: Optional[Callable[[str], Any]] = json.loads) -> Tuple[str, Any, bool]:
+    """
+    Returns (response text, usage_metadata, cache hit). `generate()` performs the actual request (exceptions
+    propagate to the caller); its text is stored only if `validate(text)` succeeds, so a malformed answer
+    is never replayed. use_cache=False skips the lookup (deliberate regrade) but still refreshes the entry.
+    """
+    cache, key, text = _lookup(model_id, prompt, images, rubric_text, schema, temperature, use_cache)
+    if text is not None: return text, None, True
+    return _store(cache, key, generate(), kind, model_id, validate)
+
+
+async def acached_generate(kind: str, model_id: str, prompt: str, images: Iterable[bytes],
+                           agenerate: Callable[[], Awaitable[Any]], rubric_text: str = "", schema: Any = None,
+                           temperature: Optional[float] = None, use_cache: bool = True,
+                           validate: Optional[Callable[[str], Any]] = json.loads) -> Tuple[str, Any, bool]:
+    """cached_generate() for the asyncio engine: `agenerate()` returns the request coroutine (client.aio)."""
+    images = list(images)
+    cache, key, text = _lookup(model_id, prompt, images, rubric_text, schema, temperature, use_cache)
+    if text is not None: return text, None, True
+    return _store(cache, key, await agenerate(), kind, model_id, validate)
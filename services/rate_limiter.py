@@ -0,0 +1,278 @@
+# Copyright (c) 2026 [謝忠村/Chung Tsun Shieh]. All Rights Reserved.
+# This software is proprietary and confidential.
+# Unauthorized copying of this file, via any medium is strictly prohibited.
+
+# services/rate_limiter.py
+# -*- coding: utf-8 -*-
+# Module-Version: v2026.02.21-Rate-Limiter
+# Description:
+# 1. [Perf] KeyLimiter：每把 API Key 一組 token bucket (RPM：請求數、TPM：估計 token 數)，批改 / 身分辨識 (OCR)
+#    所有 Gemini 請求共用；額度不足時排隊等待，而不是送出後收到 429。
+# 2. [Perf] AIMD 並行度：成功即加大 (slow start 每次 +1，第一次壅塞後每個視窗 +1)，429 / 503 時減半並暫停派送
+#    (優先採用伺服器回傳的 retryDelay)。取代依方案寫死的 PLAN_MAX_WORKERS / _get_max_workers。
+# 3. [Logic] 估計 token = prompt 字數 / 4 + 影像 tiles (upload_policy.estimate_image_tokens) + 預估輸出；
+#    回應帶 usage_metadata 時以實際用量回補 TPM bucket。
+# 4. [Config] config.RATE_LIMIT_RPM / RATE_LIMIT_TPM (0 = 不限)、CONCURRENCY_INITIAL / CONCURRENCY_MIN，
+#    並行上限 = GRADING_MAX_IN_FLIGHT。同一套 limiter 同時支援執行緒 (limited_generate) 與 asyncio (alimited_generate)。
+
+import io
+import re
+import time
+import asyncio
+import logging
+import threading
+from collections import deque
+from typing import Any, Deque, Dict, Iterable, Optional
+
+from PIL import Image
+
+from services.genai_clients import get_client, key_fingerprint
+from services.upload_policy import estimate_image_tokens
+
+logger = logging.getLogger(__name__)
+
+OVERLOAD_CODES = (429, 503)
+OVERLOAD_STATUSES = ("RESOURCE_EXHAUSTED", "UNAVAILABLE")
+DEFAULT_PAUSE_S = 2.0          # 429 未附 retryDelay 時暫停派送的秒數
+MAX_PAUSE_S = 60.0
+DEFAULT_OUTPUT_TOKENS = 2048   # 批改 JSON (含 breakdown / reasoning) 的預估輸出量
+DECREASE_COOLDOWN_S = 2.0      # 同一波 429 (多個在途請求一起失敗) 只減半一次
+_RETRY_DELAY_RE = re.compile(r"retryDelay['\"]?\s*[:=]\s*['\"]?(\d+(?:\.\d+)?)s")
+
+
+class TokenBucket:
+    """Continuously refilled bucket: `per_minute` units / 60 s, holding at most `burst_s` seconds' worth."""
+
+    def __init__(self, per_minute: float, burst_s: float = 10.0):
+        self.rate = per_minute / 60.0
+        self.capacity = max(1.0, self.rate * burst_s)
+        self.level = self.capacity
+        self._stamp = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def reserve(self, amount: float, now: float) -> float:
+        """Debits `amount` (the level may go negative) and returns how long the caller must wait before sending."""
+        self._refill(now)
+        self.level -= amount
+        return 0.0 if self.level >= 0 else -self.level / self.rate
+
+    def credit(self, amount: float) -> None:
+        """Returns (or, if negative, charges) units after the real usage is known."""
+        self.level = min(self.capacity, self.level + amount)
+
+
+def is_overload(exc: BaseException) -> bool:
+    code = getattr(exc, "code", None)
+    status = str(getattr(exc, "status", "") or "")
+    return code in OVERLOAD_CODES or status in OVERLOAD_STATUSES
+
+
+def retry_delay(exc: BaseException) -> Optional[float]:
+    """Server-suggested delay of a 429 (google.rpc.RetryInfo "retryDelay": "17s"), if present."""
+    m = _RETRY_DELAY_RE.search(str(getattr(exc, "details", "") or exc))
+    return float(m.group(1)) if m else None
+
+
+def estimate_tokens(prompt: str, images: Iterable[bytes] = (), output_tokens: int = DEFAULT_OUTPUT_TOKENS) -> int:
+    """Rough request size for TPM metering: ~4 characters / token plus Gemini's per-tile image cost."""
+    total = len(prompt or "") // 4 + int(output_tokens)
+    for blob in images:
+        try:
+            w, h = Image.open(io.BytesIO(blob)).size  # 只讀檔頭，不解碼
+        except Exception:
+            w, h = 1536, 1536
+        total += estimate_image_tokens(w, h)
+    return total
+
+
+class KeyLimiter:
+    """
+    RPM / TPM buckets plus an AIMD concurrency window for one API key. Slots are handed over FIFO to both
+    threads (threading.Event) and coroutines (asyncio.Future on their own loop), so the sync and async
+    paths share one budget.
+    """
+
+    def __init__(self, rpm: float = 0, tpm: float = 0, initial: int = 8, minimum: int = 1, maximum: int = 64,
+                 name: str = ""):
+        self.name = name
+        self.requests = TokenBucket(rpm) if rpm > 0 else None
+        self.tokens = TokenBucket(tpm) if tpm > 0 else None
+        self.maximum = max(1, int(maximum))
+        self.minimum = max(1, min(int(minimum), self.maximum))
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.slow_start = True
+        self.in_use = 0
+        self.paused_until = 0.0
+        self._last_decrease = 0.0
+        self._waiters: Deque[Any] = deque()
+        self._lock = threading.Lock()
+        self.completed = 0
+        self.throttled = 0
+        self.wait_s = 0.0
+
+    # ------------------------------------------------------------------
+    # Concurrency window
+    # ------------------------------------------------------------------
+    def _free(self) -> bool:
+        return self.in_use < int(self.limit)
+
+    def _wake(self) -> None:
+        """Hands free slots to waiters (lock held). in_use is taken on the waiter's behalf."""
+        while self._waiters and self._free():
+            waiter = self._waiters.popleft()
+            self.in_use += 1
+            if isinstance(waiter, threading.Event):
+                waiter.set()
+            else:
+                loop, fut = waiter
+                loop.call_soon_threadsafe(self._grant, fut)
+
+    def _grant(self, fut: asyncio.Future) -> None:
+        if fut.done(): self.release()  # 等待中的 task 已被取消：把名額還回去
+        else: fut.set_result(None)
+
+    def acquire(self) -> None:
+        with self._lock:
+            if not self._waiters and self._free():
+                self.in_use += 1
+                return
+            event = threading.Event()
+            self._waiters.append(event)
+        event.wait()
+
+    async def aacquire(self) -> None:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if not self._waiters and self._free():
+                self.in_use += 1
+                return
+            fut = loop.create_future()
+            self._waiters.append((loop, fut))
+        await fut
+
+    def release(self) -> None:
+        with self._lock:
+            self.in_use -= 1
+            self._wake()
+
+    # ------------------------------------------------------------------
+    # Rate
+    # ------------------------------------------------------------------
+    def reserve(self, est_tokens: int) -> float:
+        """Debits one request and `est_tokens`; returns the delay before it may be sent."""
+        with self._lock:
+            now = time.monotonic()
+            wait = max(0.0, self.paused_until - now)
+            if self.requests: wait = max(wait, self.requests.reserve(1, now))
+            if self.tokens: wait = max(wait, self.tokens.reserve(est_tokens, now))
+            self.wait_s += wait
+            return wait
+
+    # ------------------------------------------------------------------
+    # Feedback (AIMD)
+    # ------------------------------------------------------------------
+    def on_success(self, est_tokens: int, actual_tokens: Optional[int]) -> None:
+        with self._lock:
+            self.completed += 1
+            if self.tokens and actual_tokens: self.tokens.credit(est_tokens - actual_tokens)
+            self.limit = min(self.maximum, self.limit + (1.0 if self.slow_start else 1.0 / self.limit))
+            self._wake()
+
+    def on_overload(self, exc: BaseException) -> None:
+        with self._lock:
+            self.throttled += 1
+            now = time.monotonic()
+            pause = min(MAX_PAUSE_S, retry_delay(exc) or DEFAULT_PAUSE_S)
+            self.paused_until = max(self.paused_until, now + pause)
+            if now - self._last_decrease >= DECREASE_COOLDOWN_S:
+                self.limit = max(float(self.minimum), self.limit * 0.5)
+                self.slow_start = False
+                self._last_decrease = now
+                logger.warning(f"Gemini overload (key {self.name}): concurrency -> {int(self.limit)}, pause {pause:.1f}s")
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"concurrency": int(self.limit), "in_flight": self.in_use, "waiting": len(self._waiters),
+                    "completed": self.completed, "throttled": self.throttled, "wait_s": round(self.wait_s, 1)}
+
+
+class RateLimiter:
+    """KeyLimiter per API key (keyed by fingerprint, created on first use with the same settings)."""
+
+    def __init__(self, rpm: float = 0, tpm: float = 0, initial: int = 8, minimum: int = 1, maximum: int = 64):
+        self.settings = dict(rpm=rpm, tpm=tpm, initial=initial, minimum=minimum, maximum=maximum)
+        self._limiters: Dict[str, KeyLimiter] = {}
+        self._lock = threading.Lock()
+
+    def get(self, api_key: str) -> KeyLimiter:
+        fp = key_fingerprint(api_key)
+        with self._lock:
+            limiter = self._limiters.get(fp)
+            if limiter is None:
+                limiter = self._limiters[fp] = KeyLimiter(name=fp, **self.settings)
+            return limiter
+
+    def stats(self, api_key: str) -> Dict:
+        return self.get(api_key).stats()
+
+
+_default_limiter: Optional[RateLimiter] = None
+_default_lock = threading.Lock()
+
+
+def get_rate_limiter() -> RateLimiter:
+    """Process-wide limiter from config.RATE_LIMIT_RPM / RATE_LIMIT_TPM / CONCURRENCY_* / GRADING_MAX_IN_FLIGHT."""
+    global _default_limiter
+    with _default_lock:
+        if _default_limiter is None:
+            import config
+            _default_limiter = RateLimiter(
+                rpm=getattr(config, "RATE_LIMIT_RPM", 0), tpm=getattr(config, "RATE_LIMIT_TPM", 0),
+                initial=getattr(config, "CONCURRENCY_INITIAL", 8), minimum=getattr(config, "CONCURRENCY_MIN", 1),
+                maximum=getattr(config, "GRADING_MAX_IN_FLIGHT", 64),
+            )
+        return _default_limiter
+
+
+def _usage_tokens(resp: Any) -> Optional[int]:
+    usage = getattr(resp, "usage_metadata", None)
+    return getattr(usage, "total_token_count", None) if usage is not None else None
+
+
+def limited_generate(api_key: str, est_tokens: int, **request) -> Any:
+    """client.models.generate_content(**request) metered by the key's limiter (blocks the calling thread)."""
+    limiter = get_rate_limiter().get(api_key)
+    limiter.acquire()
+    try:
+        wait = limiter.reserve(est_tokens)
+        if wait > 0: time.sleep(wait)
+        try:
+            resp = get_client(api_key).models.generate_content(**request)
+        except Exception as e:
+            if is_overload(e): limiter.on_overload(e)
+            raise
+        limiter.on_success(est_tokens, _usage_tokens(resp))
+        return resp
+    finally:
+        limiter.release()
+
+
+async def alimited_generate(api_key: str, est_tokens: int, **request) -> Any:
+    """limited_generate() on client.aio: waiting for a slot / the bucket suspends the coroutine, not a thread."""
+    limiter = get_rate_limiter().get(api_key)
+    await limiter.aacquire()
+    try:
+        wait = limiter.reserve(est_tokens)
+        if wait > 0: await asyncio.sleep(wait)
+        try:
+            resp = await get_client(api_key).aio.models.generate_content(**request)
+        except Exception as e:
+            if is_overload(e): limiter.on_overload(e)
+            raise
+        limiter.on_success(est_tokens, _usage_tokens(resp))
+        return resp
+    finally:
+        limiter.release()
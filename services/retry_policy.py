@@ -0,0 +1,288 @@
+# Copyright (c) 2026 [謝忠村/Chung Tsun Shieh]. All Rights Reserved.
+# This software is proprietary and confidential.
+# Unauthorized copying of this file, via any medium is strictly prohibited.
+
+# services/retry_policy.py
+# -*- coding: utf-8 -*-
+# Module-Version: v2026.02.22-Retry-Policy
+# Description:
+# 1. [Logic] classify()：把 Gemini 例外分成 transient (5xx / 逾時 / 連線中斷)、quota (429)、bad_request (其他 4xx)、
+#    outage (斷路器開啟) 與 error (本機 / 無法判斷)。只有 transient 與 quota 會重試；bad_request 同樣請求再送也一樣失敗。
+# 2. [Perf] RetryPolicy：指數退避 + full jitter (避免整批請求同時重送)；429 另以 retryDelay 為下限，
+#    並由 rate_limiter 的 on_overload 同步降低並行度。
+# 3. [Perf] RetryBudget：每個批次的重試額度 = RETRY_BUDGET_MIN + RETRY_BUDGET_RATIO × 首次請求數，
+#    額度用完後失敗直接回報，不再讓重試量隨錯誤率放大。
+# 4. [Safety] CircuitBreaker：每把 API Key 連續 BREAKER_FAILURES 次 transient 失敗即開啟，暫停派送 BREAKER_RESET_S 秒
+#    (每次重新開啟加倍)，之後只放一個探測請求；停擺超過 BREAKER_MAX_OUTAGE_S 才讓請求以 CircuitOpenError 失敗。
+# 5. [Logic] generate_with_retry / agenerate_with_retry 包在 rate_limiter.limited_generate / alimited_generate 外層；
+#    退避期間不佔用 limiter 的並行名額。
+
+import time
+import random
+import asyncio
+import logging
+import threading
+from typing import Any, Dict, Optional
+
+import httpx
+
+from services.genai_clients import key_fingerprint
+from services.rate_limiter import limited_generate, alimited_generate, retry_delay
+
+logger = logging.getLogger(__name__)
+
+TRANSIENT = "transient"
+QUOTA = "quota"
+BAD_REQUEST = "bad_request"
+OUTAGE = "outage"
+UNKNOWN = "error"
+RETRYABLE = (TRANSIENT, QUOTA)
+# 這些失敗代表服務本身有問題；批次裡對應的作答區不值得再用單張高解析度請求補救
+SERVICE_FAILURES = (TRANSIENT, QUOTA, OUTAGE)
+
+TRANSIENT_CODES = (408, 500, 502, 503, 504)
+TRANSIENT_STATUSES = ("UNAVAILABLE", "DEADLINE_EXCEEDED", "INTERNAL")
+PROBE_POLL_S = 1.0  # 半開狀態下，探測請求以外的呼叫端每隔多久再檢查一次
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised when a key's breaker has been open longer than the allowed outage."""
+
+
+def classify(exc: BaseException) -> str:
+    if isinstance(exc, CircuitOpenError): return OUTAGE
+    code = getattr(exc, "code", None)
+    status = str(getattr(exc, "status", "") or "")
+    if code == 429 or status == "RESOURCE_EXHAUSTED": return QUOTA
+    if code in TRANSIENT_CODES or status in TRANSIENT_STATUSES: return TRANSIENT
+    if isinstance(code, int) and 400 <= code < 500: return BAD_REQUEST
+    if isinstance(exc, (httpx.TransportError, ConnectionError, TimeoutError, asyncio.TimeoutError)): return TRANSIENT
+    return UNKNOWN
+
+
+class RetryPolicy:
+    """Attempt limits and exponential backoff with full jitter; 429s wait at least the server's retryDelay."""
+
+    def __init__(self, max_attempts: int = 4, quota_attempts: int = 6, base_s: float = 1.0, max_delay_s: float = 30.0):
+        self.max_attempts = max(1, int(max_attempts))
+        self.quota_attempts = max(1, int(quota_attempts))
+        self.base_s = base_s
+        self.max_delay_s = max_delay_s
+
+    def should_retry(self, kind: str, attempt: int) -> bool:
+        """`attempt` is the number of attempts already made (1 after the first failure)."""
+        if kind == QUOTA: return attempt < self.quota_attempts
+        if kind == TRANSIENT: return attempt < self.max_attempts
+        return False
+
+    def delay(self, attempt: int, exc: Optional[BaseException] = None) -> float:
+        backoff = random.uniform(0, min(self.max_delay_s, self.base_s * (2 ** (attempt - 1))))
+        hinted = retry_delay(exc) if exc is not None else None
+        return max(backoff, min(self.max_delay_s, hinted)) if hinted else backoff
+
+
+class RetryBudget:
+    """Per-batch retry allowance: `minimum` plus `ratio` retries per first attempt (thread-safe)."""
+
+    def __init__(self, ratio: float = 0.2, minimum: int = 10):
+        self.ratio = ratio
+        self.minimum = minimum
+        self.attempts = 0
+        self.retries = 0
+        self.denied = 0
+        self._lock = threading.Lock()
+
+    def record_attempt(self) -> None:
+        with self._lock: self.attempts += 1
+
+    def try_spend(self) -> bool:
+        with self._lock:
+            if self.retries < self.minimum + self.ratio * self.attempts:
+                self.retries += 1
+                return True
+            self.denied += 1
+            return False
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"retries": self.retries, "retries_denied": self.denied}
+
+
+class CircuitBreaker:
+    """
+    Closed -> open after `failures` consecutive transient errors; open pauses every caller until `reset_s`
+    elapses, then half-open lets exactly one probe through. A probe that fails reopens with a doubled pause.
+    Any answer from the server (success, 429, 4xx) counts as the service being up.
+    """
+
+    def __init__(self, failures: int = 5, reset_s: float = 15.0, max_reset_s: float = 120.0,
+                 max_outage_s: float = 300.0, name: str = ""):
+        self.name = name
+        self.threshold = max(1, int(failures))
+        self.base_reset_s = reset_s
+        self.max_reset_s = max_reset_s
+        self.max_outage_s = max_outage_s
+        self.state = "closed"
+        self.consecutive = 0
+        self.reset_s = reset_s
+        self.reopen_at = 0.0
+        self.outage_start = 0.0
+        self.opened = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def before_call(self) -> float:
+        """0 if the caller may send now, otherwise how long to wait before asking again."""
+        with self._lock:
+            if self.state == "closed": return 0.0
+            now = time.monotonic()
+            if self.state == "open" and now >= self.reopen_at:
+                self.state = "half_open"
+                self._probing = False
+            if self.state == "half_open" and not self._probing:
+                self._probing = True
+                return 0.0
+            if now - self.outage_start > self.max_outage_s:
+                raise CircuitOpenError(f"Gemini unavailable for {now - self.outage_start:.0f}s (key {self.name})")
+            return max(PROBE_POLL_S, self.reopen_at - now)
+
+    def abandon(self) -> None:
+        """The caller was cancelled mid-call; let another caller probe."""
+        with self._lock: self._probing = False
+
+    def record(self, kind: Optional[str]) -> None:
+        """Outcome of a call: None on success, otherwise classify() of the error."""
+        with self._lock:
+            if kind in (OUTAGE, UNKNOWN):
+                self._probing = False  # 沒有得到伺服器的回應，不改變狀態
+                return
+            if kind != TRANSIENT:
+                if self.state != "closed":
+                    logger.info(f"Gemini circuit closed (key {self.name})")
+                self.state = "closed"
+                self.consecutive = 0
+                self.reset_s = self.base_reset_s
+                self._probing = False
+                return
+            self.consecutive += 1
+            now = time.monotonic()
+            if self.state == "half_open":
+                self.reset_s = min(self.max_reset_s, self.reset_s * 2)
+            elif self.state == "closed" and self.consecutive >= self.threshold:
+                self.outage_start = now
+            else:
+                return
+            self.state = "open"
+            self.reopen_at = now + self.reset_s
+            self._probing = False
+            self.opened += 1
+            logger.warning(f"Gemini circuit open (key {self.name}): pausing dispatch for {self.reset_s:.0f}s")
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"circuit": self.state, "circuit_opened": self.opened}
+
+
+_default_policy: Optional[RetryPolicy] = None
+_breakers: Dict[str, CircuitBreaker] = {}
+_default_lock = threading.Lock()
+
+
+def get_retry_policy() -> RetryPolicy:
+    """Process-wide policy from config.RETRY_MAX_ATTEMPTS / RETRY_QUOTA_ATTEMPTS / RETRY_BASE_S / RETRY_MAX_DELAY_S."""
+    global _default_policy
+    with _default_lock:
+        if _default_policy is None:
+            import config
+            _default_policy = RetryPolicy(
+                max_attempts=getattr(config, "RETRY_MAX_ATTEMPTS", 4),
+                quota_attempts=getattr(config, "RETRY_QUOTA_ATTEMPTS", 6),
+                base_s=getattr(config, "RETRY_BASE_S", 1.0), max_delay_s=getattr(config, "RETRY_MAX_DELAY_S", 30.0),
+            )
+        return _default_policy
+
+
+def get_breaker(api_key: str) -> CircuitBreaker:
+    """Circuit breaker per API key (keyed by fingerprint) from config.BREAKER_*."""
+    fp = key_fingerprint(api_key)
+    with _default_lock:
+        breaker = _breakers.get(fp)
+        if breaker is None:
+            import config
+            breaker = _breakers[fp] = CircuitBreaker(
+                failures=getattr(config, "BREAKER_FAILURES", 5), reset_s=getattr(config, "BREAKER_RESET_S", 15.0),
+                max_outage_s=getattr(config, "BREAKER_MAX_OUTAGE_S", 300.0), name=fp,
+            )
+        return breaker
+
+
+def new_retry_budget() -> RetryBudget:
+    """Fresh budget for one grading batch (config.RETRY_BUDGET_RATIO / RETRY_BUDGET_MIN)."""
+    import config
+    return RetryBudget(ratio=getattr(config, "RETRY_BUDGET_RATIO", 0.2), minimum=getattr(config, "RETRY_BUDGET_MIN", 10))
+
+
+def _next_delay(policy: RetryPolicy, budget: Optional[RetryBudget], kind: str, attempt: int,
+                exc: BaseException) -> Optional[float]:
+    """Backoff before the next attempt, or None when the error should surface."""
+    if not policy.should_retry(kind, attempt): return None
+    if budget is not None and not budget.try_spend():
+        logger.warning(f"Retry budget exhausted; giving up after {kind} error: {exc}")
+        return None
+    delay = policy.delay(attempt, exc)
+    logger.info(f"Gemini {kind} error (attempt {attempt}), retrying in {delay:.1f}s: {exc}")
+    return delay
+
+
+def generate_with_retry(api_key: str, est_tokens: int, budget: Optional[RetryBudget] = None, **request) -> Any:
+    """limited_generate() with classified retries, jittered backoff, the batch budget and the key's breaker."""
+    policy, breaker = get_retry_policy(), get_breaker(api_key)
+    if budget is not None: budget.record_attempt()
+    attempt = 0
+    while True:
+        wait = breaker.before_call()
+        if wait > 0:
+            time.sleep(wait)
+            continue
+        attempt += 1
+        try:
+            resp = limited_generate(api_key, est_tokens, **request)
+        except Exception as e:
+            kind = classify(e)
+            breaker.record(kind)
+            delay = _next_delay(policy, budget, kind, attempt, e)
+            if delay is None: raise
+            time.sleep(delay)
+            continue
+        except BaseException:
+            breaker.abandon()
+            raise
+        breaker.record(None)
+        return resp
+
+
+async def agenerate_with_retry(api_key: str, est_tokens: int, budget: Optional[RetryBudget] = None, **request) -> Any:
+    """generate_with_retry() on client.aio: backoff and breaker pauses suspend the coroutine."""
+    policy, breaker = get_retry_policy(), get_breaker(api_key)
+    if budget is not None: budget.record_attempt()
+    attempt = 0
+    while True:
+        wait = breaker.before_call()
+        if wait > 0:
+            await asyncio.sleep(wait)
+            continue
+        attempt += 1
+        try:
+            resp = await alimited_generate(api_key, est_tokens, **request)
+        except Exception as e:
+            kind = classify(e)
+            breaker.record(kind)
+            delay = _next_delay(policy, budget, kind, attempt, e)
+            if delay is None: raise
+            await asyncio.sleep(delay)
+            continue
+        except BaseException:
+            breaker.abandon()
+            raise
+        breaker.record(None)
+        return resp
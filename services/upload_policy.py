@@ -0,0 +1,142 @@
+# Copyright (c) 2026 [謝忠村/Chung Tsun Shieh]. All Rights Reserved.
+# This software is proprietary and confidential.
+# Unauthorized copying of this file, via any medium is strictly prohibited.
+
+# services/upload_policy.py
+# -*- coding: utf-8 -*-
+# Module-Version: v2026.02.11-Upload-Policy
+# Description:
+# 1. [Perf] UploadPolicy：送往 Gemini 的影像格式 (codec / quality / 色彩 / 最長邊) 可逐次指定，
+#    取代固定的全彩 PNG (掃描手寫頁動輒數 MB，zlib 編碼也慢)。
+# 2. [Logic] color = "color" | "gray" | "bilevel" (自適應二值化 + 1-bit PNG)；max_long_edge 以 INTER_AREA 縮小。
+# 3. [Config] 預設值來自 config.UPLOAD_POLICY (例 "codec=jpeg,quality=85,color=gray,max_long_edge=2000")，
+#    未設定時維持原本的全彩 PNG。benchmarks/bench_upload_codec.py 比較各設定的大小 / 時間 / 評分一致性。
+# 4. [Perf] EncodedImage：已編碼的影像 (例如拼貼圖) 可直接交給 GradingService，不再保留原始陣列。
+# 5. [Perf] get_collage_policy()：拼貼圖 (合成後大片留白、已平滑) 預設 PNG png_level=1，zlib level 6 會讓合成 + 編碼
+#    比舊流程還慢；可由 config.COLLAGE_UPLOAD_POLICY 另外指定 (benchmarks/bench_collage.py)。
+
+import logging
+from dataclasses import dataclass, replace
+from typing import Tuple, Union
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from utils.page_image import PageImage
+
+logger = logging.getLogger(__name__)
+
+CODECS = {"png": (".png", "image/png"), "jpeg": (".jpg", "image/jpeg"), "webp": (".webp", "image/webp")}
+COLOR_MODES = ("color", "gray", "bilevel")
+# Gemini 影像 token：兩邊皆 <= 384px 計一塊；否則切成 768x768 tiles，每塊 258 tokens
+GEMINI_TILE_PX, GEMINI_TILE_TOKENS = 768, 258
+
+
+def estimate_image_tokens(width: int, height: int) -> int:
+    if width <= 384 and height <= 384: return GEMINI_TILE_TOKENS
+    return GEMINI_TILE_TOKENS * int(np.ceil(width / GEMINI_TILE_PX)) * int(np.ceil(height / GEMINI_TILE_PX))
+
+
+@dataclass(frozen=True)
+class UploadPolicy:
+    codec: str = "png"          # png | jpeg | webp
+    quality: int = 90           # jpeg / webp quality (0-100); ignored for png
+    color: str = "color"        # color | gray | bilevel
+    max_long_edge: int = 0      # 0 = keep the original resolution
+    png_level: int = 6          # zlib level for png (1 = fastest; ~5% larger on scans, 2-3x faster)
+
+    def __post_init__(self):
+        if self.codec not in CODECS: raise ValueError(f"Unknown upload codec: {self.codec}")
+        if self.color not in COLOR_MODES: raise ValueError(f"Unknown upload color mode: {self.color}")
+
+    @classmethod
+    def parse(cls, spec: str) -> "UploadPolicy":
+        """'codec=jpeg,quality=85,color=gray,max_long_edge=2000' (unspecified keys keep their defaults)."""
+        kwargs = {}
+        for item in (spec or "").split(","):
+            if not item.strip(): continue
+            key, _, value = item.partition("=")
+            key, value = key.strip().lower(), value.strip().lower()
+            if key in ("quality", "max_long_edge", "png_level"): kwargs[key] = int(value)
+            elif key in ("codec", "color"): kwargs[key] = "jpeg" if value == "jpg" else value
+            else: raise ValueError(f"Unknown upload policy key: {key}")
+        return cls(**kwargs)
+
+    def describe(self) -> str:
+        parts = [f"codec={self.codec}"]
+        if self.codec != "png": parts.append(f"quality={self.quality}")
+        elif self.png_level != 6: parts.append(f"png_level={self.png_level}")
+        parts.append(f"color={self.color}")
+        if self.max_long_edge: parts.append(f"max_long_edge={self.max_long_edge}")
+        return ",".join(parts)
+
+    @property
+    def mime_type(self) -> str:
+        return CODECS[self.codec][1]
+
+    def prepare(self, image: Union[PageImage, Image.Image, np.ndarray]) -> np.ndarray:
+        """Pixels as they will be encoded (BGR or single channel), after color reduction and resizing."""
+        page = PageImage.wrap(image)
+        arr = page.bgr() if self.color == "color" else page.gray()
+        h, w = arr.shape[:2]
+        if self.max_long_edge and max(h, w) > self.max_long_edge:
+            scale = self.max_long_edge / float(max(h, w))
+            arr = cv2.resize(arr, (max(1, int(round(w * scale))), max(1, int(round(h * scale)))), interpolation=cv2.INTER_AREA)
+        if self.color == "bilevel":
+            # 自適應門檻保留淡鉛筆字；背景 (掃描陰影 / 紙色) 歸白
+            block = max(15, (min(arr.shape[:2]) // 40) | 1)
+            arr = cv2.adaptiveThreshold(arr, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, block, 15)
+        return arr
+
+    def encode(self, image: Union[PageImage, Image.Image, np.ndarray]) -> Tuple[bytes, str]:
+        """-> (encoded bytes, mime type)"""
+        arr = self.prepare(image)
+        ext, mime = CODECS[self.codec]
+        if self.codec == "png":
+            params = [cv2.IMWRITE_PNG_COMPRESSION, int(self.png_level)]
+            if self.color == "bilevel": params += [cv2.IMWRITE_PNG_BILEVEL, 1]
+        elif self.codec == "jpeg":
+            params = [cv2.IMWRITE_JPEG_QUALITY, int(self.quality)]
+        else:
+            params = [cv2.IMWRITE_WEBP_QUALITY, int(self.quality)]
+        ok, buf = cv2.imencode(ext, arr, params)
+        if not ok: raise ValueError(f"cv2.imencode failed for {self.describe()} ({arr.shape})")
+        return buf.tobytes(), mime
+
+
+@dataclass(frozen=True)
+class EncodedImage:
+    """An image already encoded for upload (e.g. a collage whose canvas went back to the pool)."""
+    data: bytes
+    mime_type: str
+    width: int = 0
+    height: int = 0
+
+
+DEFAULT_POLICY = UploadPolicy()
+# 拼貼圖用的 PNG zlib level：level 1 仍比舊流程的 PIL PNG 小，合成 + 編碼約快 2-3 倍
+COLLAGE_PNG_LEVEL = 1
+
+
+def get_upload_policy() -> UploadPolicy:
+    """Process-wide default from config.UPLOAD_POLICY (invalid specs fall back to full-colour PNG)."""
+    try:
+        import config
+        spec = getattr(config, "UPLOAD_POLICY", "")
+        return UploadPolicy.parse(spec) if spec else DEFAULT_POLICY
+    except Exception as e:
+        logger.warning(f"Invalid UPLOAD_POLICY, using PNG: {e}")
+        return DEFAULT_POLICY
+
+
+def get_collage_policy() -> UploadPolicy:
+    """Policy for collages: config.COLLAGE_UPLOAD_POLICY, else the upload policy with fast PNG (png_level=1)."""
+    try:
+        import config
+        spec = getattr(config, "COLLAGE_UPLOAD_POLICY", "")
+        if spec: return UploadPolicy.parse(spec)
+    except Exception as e:
+        logger.warning(f"Invalid COLLAGE_UPLOAD_POLICY, using UPLOAD_POLICY: {e}")
+    policy = get_upload_policy()
+    return replace(policy, png_level=COLLAGE_PNG_LEVEL) if policy.codec == "png" else policy
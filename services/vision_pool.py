@@ -0,0 +1,276 @@
+# Copyright (c) 2026 [謝忠村/Chung Tsun Shieh]. All Rights Reserved.
+# This software is proprietary and confidential.
+# Unauthorized copying of this file, via any medium is strictly prohibited.
+
+# services/vision_pool.py
+# -*- coding: utf-8 -*-
+# Module-Version: v2026.02.07-Vision-Pool
+# Description:
+# 1. [Perf] 以 ProcessPoolExecutor 執行頁面分析 (align_page + detect_answer_areas)，掃描階段不再只用一個核心。
+# 2. [Perf] 頁面經 multiprocessing.shared_memory 傳遞，不 pickle 整頁陣列；
+#    結果 (對齊圖 + 灰階) 由 worker 直接寫入主程序預先配置的輸出緩衝區。
+# 3. [Logic] Worker 數 = min(CPU - 1, 記憶體預算 / 單一 worker 估計用量)；不足 2 個時停用，改回同程序處理。
+# 4. [Safety] Pool 故障 (BrokenProcessPool 等) 時，該頁改在主程序處理，不中斷批改。
+
+import os
+import atexit
+import logging
+import threading
+import weakref
+import multiprocessing as mp
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import replace
+from multiprocessing import shared_memory
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+import config
+from services.vision_service import VisionService, AlignedPage, ALIGNED_WIDTH, ALIGNED_HEIGHT
+
+logger = logging.getLogger(__name__)
+
+# 單一 worker 記憶體估計：程序本身 (Python + numpy + cv2) 約 120 MB，
+# 加上一頁 A4@200dpi 的工作集 (原圖 / 灰階 / 二值化 / 對齊圖) 約 4 x 11.6 MB
+_WORKER_BASE_MB = 120
+_PAGE_MB = ALIGNED_WIDTH * ALIGNED_HEIGHT * 3 / (1024 * 1024)
+_WORKER_EST_MB = _WORKER_BASE_MB + 4 * _PAGE_MB
+
+
+# ==============================================================================
+# Worker side
+# ==============================================================================
+def _init_worker():
+    # 每個程序只用單執行緒 OpenCV，避免 N 個 worker x N 個執行緒互相搶核心
+    try: cv2.setNumThreads(1)
+    except Exception: pass
+
+
+def _vision_task(in_spec, out_name: str, to_bgr: bool, layout: Optional[dict]):
+    """
+    Runs in a worker process. Reads the page from shared memory, aligns it and
+    writes [aligned image | gray] into the caller's output buffer.
+    Returns only small metadata (shapes, analysis without pixels, layout boxes).
+    """
+    in_name, in_shape, in_dtype = in_spec
+    shm_in = shared_memory.SharedMemory(name=in_name)
+    shm_out = shared_memory.SharedMemory(name=out_name)
+    try:
+        image = np.ndarray(in_shape, dtype=in_dtype, buffer=shm_in.buf)
+        if to_bgr and image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)  # 輸入緩衝區保持原樣，失敗時主程序可重做
+
+        aligned, analysis = VisionService.align_page(image)
+        boxes_cutoff = None
+        if layout is not None:
+            boxes_cutoff = VisionService.detect_answer_areas(aligned, analysis=analysis, **layout)
+
+        out_img = np.ndarray(aligned.shape, dtype=aligned.dtype, buffer=shm_out.buf)
+        out_img[...] = aligned
+        gray = analysis.gray
+        out_gray = np.ndarray(gray.shape, dtype=gray.dtype, buffer=shm_out.buf, offset=out_img.nbytes)
+        out_gray[...] = gray
+
+        # aligned image 與 analysis 同一座標系：主程序由 analysis.shape 還原輸出陣列
+        meta = replace(analysis, gray=None)
+        del image, out_img, out_gray, aligned, gray
+        return meta, boxes_cutoff
+    finally:
+        shm_in.close()
+        shm_out.close()
+
+
+# ==============================================================================
+# Parent side
+# ==============================================================================
+def _shm_array(shm: shared_memory.SharedMemory, shape, dtype, offset: int = 0) -> np.ndarray:
+    """
+    Zero-copy ndarray over a shared-memory block. The block is closed once the
+    array (and every view of it) has been garbage collected.
+    """
+    arr = np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)
+    weakref.finalize(arr, _close_quietly, shm)
+    return arr
+
+
+def _close_quietly(shm: shared_memory.SharedMemory):
+    try: shm.close()
+    except BufferError: pass  # 另一個 view 仍在使用，等它的 finalizer
+    except Exception: pass
+
+
+def _unlink_quietly(shm: shared_memory.SharedMemory):
+    try: shm.unlink()
+    except Exception: pass
+
+
+class _PendingPage:
+    """Handle of one page submitted to the pool; result() returns an AlignedPage."""
+
+    def __init__(self, pool: "VisionPool", image: np.ndarray, to_bgr: bool, layout: Optional[dict]):
+        self._to_bgr = to_bgr
+        self._layout = layout
+        self._shape = tuple(image.shape)
+        self._dtype = image.dtype
+
+        self._shm_in = shared_memory.SharedMemory(create=True, size=max(1, image.nbytes))
+        np.ndarray(image.shape, dtype=image.dtype, buffer=self._shm_in.buf)[...] = image
+
+        # 輸出：對齊圖 (最大為原圖或 A4 frame) + 灰階
+        channels = image.shape[2] if image.ndim == 3 else 1
+        max_hw = max(image.shape[0] * image.shape[1], ALIGNED_WIDTH * ALIGNED_HEIGHT)
+        self._shm_out = shared_memory.SharedMemory(create=True, size=max_hw * (channels + 1) * image.dtype.itemsize)
+        self._channels = channels
+
+        try:
+            self._future = pool._executor.submit(
+                _vision_task, (self._shm_in.name, self._shape, self._dtype.str),
+                self._shm_out.name, to_bgr, layout
+            )
+        except Exception as e:
+            logger.warning(f"Vision pool submit failed, falling back to in-process: {e}")
+            self._future = None
+
+    def done(self) -> bool:
+        return self._future is None or self._future.done()
+
+    def discard(self):
+        """Releases the buffers of a page whose result is no longer needed."""
+        if self._future is not None:
+            self._future.cancel()
+            try: self._future.result()
+            except Exception: pass
+        for shm in (self._shm_in, self._shm_out):
+            _close_quietly(shm); _unlink_quietly(shm)
+
+    def _local_fallback(self) -> AlignedPage:
+        image = np.ndarray(self._shape, dtype=self._dtype, buffer=self._shm_in.buf).copy()
+        if self._to_bgr and image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+        aligned, analysis = VisionService.align_page(image)
+        layout = VisionService.detect_answer_areas(aligned, analysis=analysis, **self._layout) if self._layout is not None else None
+        return AlignedPage(image=aligned, analysis=analysis,
+                           matrix=analysis.homography if analysis.is_aligned else None, layout=layout)
+
+    def result(self) -> AlignedPage:
+        try:
+            if self._future is None:
+                return self._local_fallback()
+            try:
+                meta, layout = self._future.result()
+            except Exception as e:
+                logger.warning(f"Vision worker failed, processing page in-process: {e}")
+                return self._local_fallback()
+
+            h, w = meta.shape[:2]
+            img_shape = (h, w, self._channels) if self._channels > 1 else (h, w)
+            image = _shm_array(self._shm_out, img_shape, self._dtype)
+            gray = _shm_array(self._shm_out, (h, w), self._dtype, offset=image.nbytes)
+            analysis = replace(meta, gray=gray)
+            return AlignedPage(image=image, analysis=analysis,
+                               matrix=analysis.homography if analysis.is_aligned else None, layout=layout)
+        finally:
+            # Unlink 只移除名稱；已 map 的輸出緩衝區在陣列被回收前仍然有效
+            _close_quietly(self._shm_in)
+            _unlink_quietly(self._shm_in)
+            _unlink_quietly(self._shm_out)
+
+
+class VisionPool:
+    """
+    Process pool for page analysis. Pages travel through shared memory; the
+    parent gets AlignedPage objects whose pixels live in shared memory (zero-copy).
+    """
+
+    def __init__(self, max_workers: int):
+        self.max_workers = int(max_workers)
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=mp.get_context("spawn"),  # fork + 執行緒 (Streamlit) 不安全；macOS 預設亦為 spawn
+            initializer=_init_worker
+        )
+
+    def submit(self, image: np.ndarray, to_bgr: bool = False, layout: Optional[dict] = None) -> _PendingPage:
+        """
+        Queues one raw page. `to_bgr` converts an RGB page inside the worker;
+        `layout` = detect_answer_areas kwargs (is_first_page / manual_p1_ratio) to also detect boxes.
+        """
+        return _PendingPage(self, image, to_bgr, layout)
+
+    def align_students(
+        self,
+        students: Iterable[Tuple[int, List[np.ndarray]]],
+        max_pages_in_flight: int = 16,
+        to_bgr: bool = True,
+        layout_fn: Optional[Callable[[int, int], Optional[dict]]] = None
+    ) -> Iterator[Tuple[int, List[AlignedPage]]]:
+        """
+        Consumes (idx, raw pages) and yields (idx, [AlignedPage]) in order while
+        keeping up to `max_pages_in_flight` pages queued in the workers.
+        `layout_fn(idx, page_idx)` returns detect_answer_areas kwargs or None.
+        """
+        cap = max(1, int(max_pages_in_flight))
+        pending = deque()
+        in_flight = 0
+        students = iter(students)
+        exhausted = False
+
+        try:
+            while True:
+                while not exhausted and in_flight < cap:
+                    try: idx, pages = next(students)
+                    except StopIteration:
+                        exhausted = True; break
+                    handles = [
+                        self.submit(img, to_bgr=to_bgr, layout=layout_fn(idx, p_idx) if layout_fn else None)
+                        for p_idx, img in enumerate(pages)
+                    ]
+                    pages = None
+                    pending.append((idx, handles))
+                    in_flight += len(handles)
+                if not pending: return
+                idx, handles = pending.popleft()
+                in_flight -= len(handles)
+                yield idx, [h.result() for h in handles]
+        finally:
+            # 消費端提前結束 (例外 / break)：釋放尚未取回的共享記憶體
+            for _, handles in pending:
+                for h in handles: h.discard()
+
+    def shutdown(self):
+        try: self._executor.shutdown(wait=False, cancel_futures=True)
+        except Exception: pass
+
+
+def plan_workers(cpu_count: Optional[int] = None, memory_budget_mb: Optional[int] = None) -> int:
+    """Number of vision processes that fit the CPU count and the memory budget."""
+    cpu = cpu_count or os.cpu_count() or 1
+    budget = memory_budget_mb if memory_budget_mb is not None else getattr(config, "VISION_POOL_MEMORY_MB", 1536)
+    by_mem = int(budget // _WORKER_EST_MB)
+    return max(0, min(cpu - 1, by_mem))
+
+
+_default_pool = None
+_default_lock = threading.Lock()
+
+
+def get_vision_pool() -> Optional[VisionPool]:
+    """
+    Process-wide pool (spawning workers is expensive, so it lives for the whole app).
+    Returns None when fewer than 2 workers are available -> callers stay in-process.
+    """
+    global _default_pool
+    with _default_lock:
+        if _default_pool is None:
+            workers = getattr(config, "VISION_WORKERS", 0) or plan_workers()
+            if workers < 2: return None
+            try:
+                _default_pool = VisionPool(workers)
+                atexit.register(_default_pool.shutdown)
+                logger.info(f"Vision pool started with {workers} workers")
+            except Exception as e:
+                logger.warning(f"Vision pool unavailable: {e}")
+                return None
+        return _default_pool
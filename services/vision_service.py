@@ -4,140 +4,305 @@
 
 # services/vision_service.py
 # -*- coding: utf-8 -*-
-# Module-Version: v2026.01.01-Vision-Page-Fix
+# Module-Version: v2026.02.03-Vision-Single-Pass
 # Description: 
-# 1. [Fix] 'align_document' ignores QR/Barcodes to prevent "Black Screen" distortion.
-# 2. [Safety] Added a "Sanity Check" - if alignment results in a black/tiny image, return original.
-# 3. [Fix] Cutoff logic now respects manual slider (Priority: Barcode > QR > Manual > Default).
-# 4. [Logic] Regex-based page detection (Robust for P3, P10, and Marketing QR).
+# 1. [Perf] 'analyze_page' runs QR / Barcode / marker detection ONCE per page and returns a PageAnalysis.
+#    align_document / get_header_cutoff_y / extract_header_image / detect_answer_areas accept it.
+#    'AlignedPageCache' keeps one warp per (student, page) for the whole batch.
+# 2. [Fix] 'align_document' ignores QR/Barcodes to prevent "Black Screen" distortion.
+# 3. [Safety] Added a "Sanity Check" - if alignment results in a black/tiny image, return original.
+# 4. [Fix] Cutoff logic now respects manual slider (Priority: Barcode > QR > Manual > Default).
+# 5. [Logic] Regex-based page detection (Robust for P3, P10, and Marketing QR).
+# 6. [Perf] Box dedup / container filter / row sort vectorized with NumPy (IoU & containment matrices).
+# 7. [Perf] ArUco fiducials (optional on generated exams): detected in the corner ROIs of a downscaled page,
+#    refined with cornerSubPix at full resolution; falls back to the square-contour sweep.
+# 8. [Perf] Image pyramid (config.VISION_PYRAMID): corner squares and answer boxes are found on a 1/4-scale copy,
+#    then only the marker windows / box border strips are re-thresholded at full resolution.
+#    [Fix] Corner-square quads (pyramid and full resolution) must pass a geometry check (one centre per quadrant,
+#    near-parallelogram); a pyramid quad that fails falls back to the full-resolution sweep.
+#    [Fix] The coarse box threshold scales its offset with the pyramid level (255·s²): one speck pixel no longer
+#    turns a whole coarse block into ink, so scanner noise stops producing extra answer boxes.
+# 9. [Perf] 'trim_to_ink': answer crops are cut to the written region (projection profiles, ruled lines removed)
+#    before they are composited / uploaded.
+# 10. [Perf] 'classify_blank_crops': every crop of a question is classified in one stacked pass (residual ink after
+#    the question's common printed template is subtracted), so blank answers never reach a collage cell.
+#    [Fix] Crops are registered onto the stack median before voting and the template is subtracted with a 1px
+#    tolerance; a crop is blank only if its raw ink also stays near the template's own ink (a short answer most
+#    students wrote in the same spot is no longer absorbed into the template and scored 0).
+# 11. [Fix] 'prepare_page': orientation (QR symbol axis, else thumbnail projection profiles) is fixed before the
+#    marker search; 90° / 180° scans used to align wrongly and fall through to the per-student rescue path.
+# 12. [Fix] '_decode_qr': when the full-page multi decode finds nothing, the bottom-right corner is decoded again
+#    at 2x (the ~100px system QR is below what detectAndDecodeMulti resolves), so qr_content / the layout manifest
+#    lookup work on generated exams.
+# 13. [Safety] 'answer_crop_masks': besides the blank mask, returns which crops carry no written ink beyond the
+#    question template; only those may share a grading result with a near-duplicate crop (handwriting never does).
 
 import cv2
 import numpy as np
 import logging
 import re  # [New] 用於正則表達式提取頁碼
+import threading
+from dataclasses import dataclass, field, replace
+from itertools import combinations
 from typing import List, Tuple, Optional
 
 logger = logging.getLogger(__name__)
 
+# Standard A4 at ~200dpi (aligned frame)
+ALIGNED_WIDTH, ALIGNED_HEIGHT = 1654, 2339
+
+# --- Physical layout of generated sheets (cm from the top-left paper corner) ---
+# The aligned frame is defined by the centres of the tikz corner squares: TL centre -> (0,0), BR centre -> (W-1,H-1).
+PAPER_W_CM, PAPER_H_CM = 21.0, 29.7
+MARKER_OFFSET_CM, MARKER_SIZE_CM = 0.5, 0.3
+_MARKER_CENTER_CM = MARKER_OFFSET_CM + MARKER_SIZE_CM / 2
+
+# ArUco fiducials (ExamBuilder use_aruco): one marker per corner, ids in TL, TR, BR, BL order
+ARUCO_DICT_NAME = "DICT_4X4_50"
+ARUCO_IDS = (0, 1, 2, 3)
+ARUCO_OFFSET_CM, ARUCO_SIZE_CM = 0.5, 0.7
+ARUCO_DETECT_LONG_EDGE = 1200   # detection runs on a page downscaled to this long edge
+ARUCO_CORNER_ROI = 0.2          # fraction of width / height searched around each page corner
+
+# Image pyramid (config.VISION_PYRAMID): coarse detection level and refinement limits
+PYRAMID_MIN_LONG_EDGE = 400     # no pyramid when the coarse level would be smaller than this
+PYRAMID_MARKER_CANDIDATES = 8   # largest coarse square candidates refined at full resolution
+MARKER_QUAD_TOL = 0.03          # corner-square quad: |TL + BR - TR - BL| (parallelogram residual) / page diagonal
+PYRAMID_EDGE_FILL = 0.9         # a box border is a strip column / row inked along >= 90% of its length
+                                # (scanner noise under adaptiveThreshold stays well below that)
+
+# System QR fallback (_decode_qr): bottom-right region re-decoded at 2x when the full-page multi decode finds nothing
+QR_ROI_FRAC = 0.25
+QR_ROI_UPSCALE = 2.0
+
+# Ink trimming (trim_to_ink): a row / column needs this many ink pixels to count as written
+INK_MIN_RUN = 3
+
+# Batch blank detection (classify_blank_crops): crops of one question are compared at BLANK_SCALE
+BLANK_SCALE = 0.5
+BLANK_TEMPLATE_FRAC = 0.85      # a pixel inked in >= 85% of the registered crops is printed content, not an answer
+BLANK_TEMPLATE_MIN_CROPS = 4    # fewer crops: no template, printed content counts as ink (never blank)
+BLANK_MAX_SHIFT = 12            # crop-to-stack registration offsets beyond this (px at BLANK_SCALE) are ignored
+BLANK_SPECKLE_PX = 4            # ink components smaller than this are scanner noise (keeps 1px pencil strokes)
+BLANK_MAX_INK_PX = 8            # residual ink pixels (at BLANK_SCALE) still treated as blank paper
+BLANK_MAX_INK_RATIO = 0.0001
+BLANK_RAW_SLACK = 0.05          # a blank crop's raw ink stays within 5% of the template's own ink
+
+# Orientation pre-pass (detect_orientation): QR symbol axis first, then projection-profile asymmetry on a thumbnail
+ORIENT_THUMB_LONG_EDGE = 400
+ORIENT_A4_ASPECT_TOL = 0.12     # landscape raster treated as a rotated A4 page when |w/h - 29.7/21| <= this
+ORIENT_MIN_ASYMMETRY = 0.35     # portrait 180° flip needs the page this much bottom-heavy (and not left-aligned)
+_ROTATE_CODES = {90: cv2.ROTATE_90_CLOCKWISE, 180: cv2.ROTATE_180, 270: cv2.ROTATE_90_COUNTERCLOCKWISE}
+
+
+def cm_to_aligned(x_cm: float, y_cm: float) -> Tuple[float, float]:
+    """Paper position (cm from the top-left corner) -> aligned A4 frame pixels."""
+    span_x = PAPER_W_CM - 2 * _MARKER_CENTER_CM
+    span_y = PAPER_H_CM - 2 * _MARKER_CENTER_CM
+    return (
+        (x_cm - _MARKER_CENTER_CM) / span_x * (ALIGNED_WIDTH - 1),
+        (y_cm - _MARKER_CENTER_CM) / span_y * (ALIGNED_HEIGHT - 1),
+    )
+
+
+def aligned_to_cm(x_px: float, y_px: float) -> Tuple[float, float]:
+    span_x = PAPER_W_CM - 2 * _MARKER_CENTER_CM
+    span_y = PAPER_H_CM - 2 * _MARKER_CENTER_CM
+    return (
+        _MARKER_CENTER_CM + x_px / (ALIGNED_WIDTH - 1) * span_x,
+        _MARKER_CENTER_CM + y_px / (ALIGNED_HEIGHT - 1) * span_y,
+    )
+
+
+def aruco_marker_origin_cm(marker_id: int) -> Tuple[float, float]:
+    """Top-left paper position (cm) of the ArUco marker printed at corner `marker_id`."""
+    near, far_x, far_y = ARUCO_OFFSET_CM, PAPER_W_CM - ARUCO_OFFSET_CM - ARUCO_SIZE_CM, PAPER_H_CM - ARUCO_OFFSET_CM - ARUCO_SIZE_CM
+    return [(near, near), (far_x, near), (far_x, far_y), (near, far_y)][ARUCO_IDS.index(marker_id)]
+
+
+@dataclass
+class PageAnalysis:
+    """
+    Single-pass scan result of one page.
+    All coordinates are in the frame of the analysed image; `is_aligned` tells
+    whether that frame is the warped A4 frame produced by `VisionService.align_page`.
+    """
+    shape: Tuple[int, int]
+    gray: np.ndarray
+    qr_payloads: List[str] = field(default_factory=list)
+    qr_boxes: List[np.ndarray] = field(default_factory=list)
+    barcodes: List[Tuple[str, np.ndarray]] = field(default_factory=list)
+    markers: Optional[np.ndarray] = None      # (4, 2) TL, TR, BR, BL
+    homography: Optional[np.ndarray] = None   # raw page -> aligned A4 frame
+    is_aligned: bool = False
+
+    @property
+    def qr_content(self) -> Optional[str]:
+        """First decoded QR payload (same semantics as the old detect_qr_marker)."""
+        return self.qr_payloads[0] if self.qr_payloads else None
+
+    def start_barcode_y(self) -> Optional[int]:
+        """Bottom Y of the [START_Q] linear barcode, if any."""
+        for info, pts in self.barcodes:
+            if "START_Q" in info or "[START_Q]" in info:
+                return int(np.max(pts[:, 1]))
+        return None
+
+    def forbidden_rects(self) -> List[Tuple[int, int, int, int]]:
+        """QR / Barcode zones (padded) that must not be mistaken for fiducials."""
+        rects = []
+        for pts in list(self.qr_boxes) + [p for _, p in self.barcodes]:
+            x, y, w, h = cv2.boundingRect(pts.astype(int))
+            rects.append((x - 10, y - 10, w + 20, h + 20))
+        return rects
+
+    def matches(self, image: np.ndarray) -> bool:
+        return tuple(image.shape[:2]) == tuple(self.shape)
+
+
+@dataclass
+class AlignedPage:
+    """One warped page plus the perspective matrix used to produce it (None = unaligned fallback)."""
+    image: np.ndarray
+    analysis: PageAnalysis
+    matrix: Optional[np.ndarray] = None
+    layout: Optional[Tuple[List[Tuple[int, int, int, int]], int]] = None  # detect_answer_areas() result, if precomputed
+
+
+class AlignedPageCache:
+    """
+    (student_idx, page_idx) -> AlignedPage.
+    Shared by all phases of a batch so every page is analysed and warped exactly once.
+    """
+    def __init__(self):
+        self._pages = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Tuple[int, int], raw_image: Optional[np.ndarray] = None) -> Optional[AlignedPage]:
+        with self._lock:
+            page = self._pages.get(key)
+            if page is not None:
+                self.hits += 1
+                return page
+        if raw_image is None: return None
+
+        aligned_img, analysis = VisionService.align_page(raw_image)
+        page = AlignedPage(
+            image=aligned_img, analysis=analysis,
+            matrix=analysis.homography if analysis.is_aligned else None
+        )
+        with self._lock:
+            self.misses += 1
+            self._pages[key] = page
+        return page
+
+    def put(self, key: Tuple[int, int], page: AlignedPage) -> None:
+        """Stores a page aligned elsewhere (e.g. by the vision process pool)."""
+        with self._lock:
+            self.misses += 1
+            self._pages[key] = page
+
+    def pages_of(self, student_idx: int) -> List[AlignedPage]:
+        with self._lock:
+            keys = sorted(k for k in self._pages if k[0] == student_idx)
+            return [self._pages[k] for k in keys]
+
+    def drop(self, key: Tuple[int, int]) -> None:
+        with self._lock:
+            self._pages.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._pages.clear()
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            return key in self._pages
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._pages)
+
+
 class VisionService:
 
+    # -------------------------------------------------------------------------
+    # Single-Pass Page Analysis
+    # -------------------------------------------------------------------------
     @staticmethod
-    def detect_qr_marker(image: np.ndarray) -> Optional[str]:
-        """Detects the top-right QR Code."""
+    def _to_gray(image: np.ndarray) -> np.ndarray:
+        if len(image.shape) == 3: return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        return image
+
+    @staticmethod
+    def _decode_qr(gray: np.ndarray) -> Tuple[List[str], List[np.ndarray]]:
         try:
             qcd = cv2.QRCodeDetector()
-            retval, decoded_info, points, _ = qcd.detectAndDecodeMulti(image)
-            if retval and len(decoded_info) > 0:
-                return decoded_info[0]
-            return None
+            retval, decoded_info, points, _ = qcd.detectAndDecodeMulti(gray)
+            if retval and points is not None and len(points) > 0:
+                return list(decoded_info), [np.asarray(p, dtype=np.float32).reshape(-1, 2) for p in points]
+            # 系統 QR 在 200dpi 只有約 100px (每模組 3~4px)，整頁 Multi 解不出來；改在右下角區域放大後單獨解碼
+            h, w = gray.shape[:2]
+            x0, y0 = int(w * (1 - QR_ROI_FRAC)), int(h * (1 - QR_ROI_FRAC))
+            roi = cv2.resize(gray[y0:, x0:], None, fx=QR_ROI_UPSCALE, fy=QR_ROI_UPSCALE, interpolation=cv2.INTER_CUBIC)
+            text, points, _ = qcd.detectAndDecode(roi)
+            if text and points is not None:
+                pts = np.asarray(points, dtype=np.float32).reshape(-1, 2) / QR_ROI_UPSCALE + (x0, y0)
+                return [text], [pts.astype(np.float32)]
         except Exception:
-            return None
+            pass
+        return [], []
 
     @staticmethod
-    def detect_linear_barcode_position(image: np.ndarray) -> Optional[int]:
-        """
-        Attempts to detect the [START_Q] linear barcode.
-        Returns the Y-coordinate of the bottom of the barcode if found.
-        """
+    def _decode_barcodes(gray: np.ndarray) -> List[Tuple[str, np.ndarray]]:
         try:
-            if not hasattr(cv2, 'barcode_BarcodeDetector'): return None
+            if not hasattr(cv2, 'barcode_BarcodeDetector'): return []
             bd = cv2.barcode_BarcodeDetector()
-            retval, decoded_info, decoded_type, points = bd.detectAndDecode(image)
-            
-            if retval and len(decoded_info) > 0:
-                for i, info in enumerate(decoded_info):
-                    # Check for our specific marker
-                    if "START_Q" in info or "[START_Q]" in info:
-                        pts = points[i]
-                        max_y = np.max(pts[:, 1])
-                        return int(max_y)
-            return None
+            # OpenCV >= 4.8 moved the 4-tuple API to detectAndDecodeWithType
+            if hasattr(bd, 'detectAndDecodeWithType'):
+                retval, decoded_info, _, points = bd.detectAndDecodeWithType(gray)
+            else:
+                retval, decoded_info, _, points = bd.detectAndDecode(gray)
+            if retval and points is not None and len(points) > 0:
+                return [(str(info), np.asarray(pts, dtype=np.float32).reshape(-1, 2)) for info, pts in zip(decoded_info, points)]
         except Exception:
-            return None
+            pass
+        return []
 
     @staticmethod
-    def get_header_cutoff_y(image: np.ndarray, is_first_page: bool = True, manual_p1_ratio: float = 0.15) -> int:
-        img_h = image.shape[0]
-        if not is_first_page:
-            # 非首頁，只留極少邊界 (0.5%)
-            return int(img_h * 0.005) 
-
-        default_cutoff = int(img_h * manual_p1_ratio)
-
-        # 1. [Priority 1] Linear Barcode (Absolute Truth)
-        barcode_y = VisionService.detect_linear_barcode_position(image)
-        if barcode_y is not None:
-            return int(barcode_y + (img_h * 0.015))
-
-        # 2. [Priority 2] QR Code vs Manual Slider
+    def _pyramid_scale(shape) -> float:
+        """Coarse level used by marker / box detection (1.0 = pyramid disabled or page already small)."""
         try:
-            qcd = cv2.QRCodeDetector()
-            retval, decoded_info, points, _ = qcd.detectAndDecodeMulti(image)
-            if retval and len(points) > 0:
-                qr_points = points[0]
-                max_y = np.max(qr_points[:, 1])
-                dynamic_cutoff = int(max_y + (img_h * 0.01))
-                
-                # [CRITICAL FIX] Use MAX. If manual slider is huge, it overrides auto-detection.
-                # 防止誤判：如果 QR Code 在右下角 (System QR)，位置會很低 (>30%)，
-                # 此時應忽略該 QR 的位置，改用 Manual Slider 或 Default。
-                if dynamic_cutoff < img_h * 0.3:
-                    return max(dynamic_cutoff, default_cutoff)
-                    
-            return default_cutoff
+            import config
+            if not getattr(config, "VISION_PYRAMID", True): return 1.0
+            scale = float(getattr(config, "VISION_PYRAMID_SCALE", 0.25))
         except Exception:
-            return default_cutoff
+            scale = 0.25
+        if not 0.0 < scale < 1.0 or max(shape[:2]) * scale < PYRAMID_MIN_LONG_EDGE: return 1.0
+        return scale
 
     @staticmethod
-    def extract_header_image(image: np.ndarray, is_first_page: bool = True, manual_p1_ratio: float = 0.15) -> Optional[np.ndarray]:
-        cutoff_y = VisionService.get_header_cutoff_y(image, is_first_page, manual_p1_ratio)
-        if cutoff_y < 50: return None
-        return image[0:cutoff_y, :]
+    def _downscale(gray: np.ndarray, scale: float) -> Tuple[np.ndarray, float, float]:
+        """INTER_AREA copy at `scale`; returns (small, fx, fy) with fx/fy = full px per small px."""
+        h, w = gray.shape[:2]
+        sw, sh = max(1, int(round(w * scale))), max(1, int(round(h * scale)))
+        small = cv2.resize(gray, (sw, sh), interpolation=cv2.INTER_AREA)
+        return small, w / float(sw), h / float(sh)
 
     @staticmethod
-    def align_document(image: np.ndarray) -> np.ndarray:
-        """
-        Aligns document using 4-corner detection.
-        Includes safety mechanisms to prevent black screens caused by QR interference.
-        """
-        if len(image.shape) == 3: gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        else: gray = image
-        
-        orig_h, orig_w = image.shape[:2]
-        
-        # --- Step 1: Identify Forbidden Zones (QR/Barcodes) ---
-        forbidden_rects = []
-        try:
-            qcd = cv2.QRCodeDetector()
-            retval, _, points, _ = qcd.detectAndDecodeMulti(image)
-            if retval and len(points) > 0:
-                for pts in points:
-                    pts = pts.astype(int)
-                    x, y, w, h = cv2.boundingRect(pts)
-                    forbidden_rects.append((x-10, y-10, w+20, h+20))
-        except: pass
-
-        try:
-            if hasattr(cv2, 'barcode_BarcodeDetector'):
-                bd = cv2.barcode_BarcodeDetector()
-                retval, _, _, points = bd.detectAndDecode(image)
-                if retval and len(points) > 0:
-                    for pts in points:
-                        pts = pts.astype(int)
-                        x, y, w, h = cv2.boundingRect(pts)
-                        forbidden_rects.append((x-10, y-10, w+20, h+20))
-        except: pass
-
+    def _marker_candidates(gray: np.ndarray, forbidden_rects: List[Tuple[int, int, int, int]],
+                           img_area: float, min_ratio: float = 0.0005) -> List[Tuple[float, np.ndarray]]:
+        """(area, 4-point approx) of every square-ish blob that passes the size / forbidden-zone filters."""
         thresh = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY_INV, 11, 2)
         contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
         
         potential_markers = []
-        img_area = orig_w * orig_h
-        
         for cnt in contours:
             area = cv2.contourArea(cnt)
             # Filter 1: Size (Too small = noise, Too big = page border)
-            if area < img_area * 0.0005 or area > img_area * 0.05: continue
+            if area < img_area * min_ratio or area > img_area * 0.05: continue
             
             # Filter 2: Forbidden Zones (The Fix!)
             x, y, w, h = cv2.boundingRect(cnt)
@@ -152,23 +317,167 @@ class VisionService:
             peri = cv2.arcLength(cnt, True)
             approx = cv2.approxPolyDP(cnt, 0.04 * peri, True)
             if len(approx) == 4: potential_markers.append((area, approx))
+        return potential_markers
+
+    @staticmethod
+    def _find_markers(gray: np.ndarray, forbidden_rects: List[Tuple[int, int, int, int]]) -> Optional[np.ndarray]:
+        """Finds the 4 corner squares and returns their centers ordered TL, TR, BR, BL."""
+        scale = VisionService._pyramid_scale(gray.shape)
+        if scale < 1.0:
+            quad, coarse_found = VisionService._find_markers_pyramid(gray, forbidden_rects, scale)
+            # 粗層的面積下限比全解析度寬鬆：粗層不到 4 個候選時全解析度也找不到，不必重掃
+            if quad is not None or not coarse_found: return quad
+            logger.debug("Pyramid marker search found no valid quad; retrying at full resolution")
+
+        orig_h, orig_w = gray.shape[:2]
+        potential_markers = VisionService._marker_candidates(gray, forbidden_rects, orig_w * orig_h)
         
-        # If we can't find 4 markers, return original (Don't force it!)
+        # If we can't find 4 markers, give up (Don't force it!)
         if len(potential_markers) < 4: 
-            return image
+            return None
         
         potential_markers.sort(key=lambda x: x[0], reverse=True)
-        best_4_markers = [x[1] for x in potential_markers[:4]]
-        
-        centers = []
-        for marker in best_4_markers:
+        scored = []
+        for area, marker in potential_markers[:PYRAMID_MARKER_CANDIDATES]:
             M = cv2.moments(marker)
-            if M["m00"] != 0: centers.append([int(M["m10"]/M["m00"]), int(M["m01"]/M["m00"])])
-            
-        if len(centers) != 4: return image
-        
-        # --- Step 3: Order Points & Warp ---
-        centers = np.array(centers)
+            if M["m00"] != 0: scored.append((area, [int(M["m10"]/M["m00"]), int(M["m01"]/M["m00"])]))
+        if len(scored) < 4: return None
+        # 最大的 4 個方塊不成四角形 (例如模糊後 QR 未被排除) 時，改挑面積最大且幾何合理的組合；都不合理則維持原本行為
+        quad = VisionService._pick_marker_quad(scored, gray.shape)
+        if quad is not None: return quad
+        return VisionService._order_corners(np.array([c for _, c in scored[:4]]))
+
+    @staticmethod
+    def _marker_quad_ok(corners: np.ndarray, shape) -> bool:
+        """Ordered TL, TR, BR, BL centres look like the page's corner squares: one per quadrant, near-parallelogram."""
+        h, w = shape[:2]
+        tl, tr, br, bl = np.asarray(corners, dtype=np.float64)
+        if not (tl[0] < w / 2 > bl[0] and tr[0] > w / 2 < br[0] and tl[1] < h / 2 > tr[1] and bl[1] > h / 2 < br[1]):
+            return False
+        return float(np.hypot(*(tl + br - tr - bl))) <= MARKER_QUAD_TOL * float(np.hypot(w, h))
+
+    @staticmethod
+    def _pick_marker_quad(scored: List[Tuple[float, np.ndarray]], shape) -> Optional[np.ndarray]:
+        """Largest-area set of 4 candidate centres (area, centre) that passes _marker_quad_ok, ordered TL, TR, BR, BL."""
+        ranked = sorted(scored, key=lambda x: x[0], reverse=True)[:PYRAMID_MARKER_CANDIDATES]
+        for combo in sorted(combinations(ranked, 4), key=lambda c: -sum(a for a, _ in c)):
+            quad = VisionService._order_corners(np.array([c for _, c in combo], dtype=np.float32))
+            if VisionService._marker_quad_ok(quad, shape): return quad
+        return None
+
+    @staticmethod
+    def _find_markers_pyramid(gray: np.ndarray, forbidden_rects: List[Tuple[int, int, int, int]],
+                              scale: float) -> Tuple[Optional[np.ndarray], bool]:
+        """
+        Coarse-to-fine marker search: candidates come from the downscaled page, then each one is
+        re-thresholded in a small full-resolution window and its centre taken from the
+        full-resolution contour moments (sub-pixel). Same filters as the full-resolution sweep.
+        Refined centres must stay near their coarse centre and the chosen quad must pass _marker_quad_ok.
+        Returns (quad or None, whether the coarse level had >= 4 candidates); the caller falls back to the
+        full-resolution sweep only in the second case.
+        """
+        orig_h, orig_w = gray.shape[:2]
+        img_area = orig_w * orig_h
+        small, fx, fy = VisionService._downscale(gray, scale)
+        small_forbidden = [(x / fx, y / fy, w / fx, h / fy) for (x, y, w, h) in forbidden_rects]
+        # 粗層的輪廓面積偏小 (邊緣被平均掉)，下限放寬一半；精修時再用原本的門檻
+        coarse = VisionService._marker_candidates(small, small_forbidden, small.shape[0] * small.shape[1], min_ratio=0.00025)
+        if len(coarse) < 4: return None, False
+        coarse.sort(key=lambda x: x[0], reverse=True)
+
+        pad = int(np.ceil(2 * max(fx, fy))) + 8  # 粗層定位誤差 + adaptiveThreshold 視窗半徑
+        refined = []
+        for _, approx in coarse[:PYRAMID_MARKER_CANDIDATES]:
+            bx, by, bw, bh = cv2.boundingRect(approx)
+            x0, y0 = max(0, int(bx * fx) - pad), max(0, int(by * fy) - pad)
+            x1, y1 = min(orig_w, int((bx + bw) * fx) + pad), min(orig_h, int((by + bh) * fy) + pad)
+            roi_forbidden = [(x - x0, y - y0, w, h) for (x, y, w, h) in forbidden_rects]
+            target = np.array([(bx + bw / 2) * fx - x0, (by + bh / 2) * fy - y0])
+            best = None
+            for area, cand in VisionService._marker_candidates(gray[y0:y1, x0:x1], roi_forbidden, img_area):
+                M = cv2.moments(cand)
+                if M["m00"] == 0: continue
+                center = np.array([M["m10"] / M["m00"], M["m01"] / M["m00"]])
+                dist = float(np.hypot(*(center - target)))
+                if best is None or dist < best[0]: best = (dist, area, center + (x0, y0))
+            if best is None or best[0] > 2 * max(fx, fy) + 2: continue  # 精修結果離粗層中心太遠：視窗裡是別的東西
+            if any(np.hypot(*(best[2] - c)) < 2 for _, c in refined): continue  # 兩個粗候選精修到同一個方塊
+            refined.append((best[1], best[2]))
+
+        if len(refined) < 4: return None, True
+        # 幾何檢查不過時回傳 None，由 _find_markers 改走全解析度掃描
+        return VisionService._pick_marker_quad(refined, gray.shape), True
+
+    @staticmethod
+    def _aruco_detector():
+        """Cached cv2.aruco.ArucoDetector (None if this OpenCV build has no aruco module)."""
+        detector = getattr(VisionService, "_aruco_detector_cache", None)
+        if detector is None:
+            try:
+                dictionary = cv2.aruco.getPredefinedDictionary(getattr(cv2.aruco, ARUCO_DICT_NAME))
+                params = cv2.aruco.DetectorParameters()
+                params.cornerRefinementMethod = cv2.aruco.CORNER_REFINE_NONE  # 全解析度再做 cornerSubPix
+                detector = cv2.aruco.ArucoDetector(dictionary, params)
+            except Exception:
+                detector = False
+            VisionService._aruco_detector_cache = detector
+        return detector or None
+
+    @staticmethod
+    def _aruco_targets(marker_id: int) -> np.ndarray:
+        """The 4 corners (TL, TR, BR, BL) of a printed marker in the aligned frame."""
+        x0, y0 = aruco_marker_origin_cm(marker_id)
+        s = ARUCO_SIZE_CM
+        return np.array([cm_to_aligned(x, y) for x, y in
+                         [(x0, y0), (x0 + s, y0), (x0 + s, y0 + s), (x0, y0 + s)]], dtype=np.float32)
+
+    @staticmethod
+    def _find_aruco(gray: np.ndarray) -> Tuple[Optional[np.ndarray], Optional[np.ndarray]]:
+        """
+        Finds the corner ArUco markers and returns (homography raw -> aligned, centres TL/TR/BR/BL).
+        Detection runs on the four corner ROIs of a downscaled copy (fallback: the whole
+        downscaled page); corners are then refined on the full-resolution image.
+        Needs at least 3 of the 4 markers (12 point pairs).
+        """
+        detector = VisionService._aruco_detector()
+        if detector is None: return None, None
+
+        h, w = gray.shape[:2]
+        scale = min(1.0, ARUCO_DETECT_LONG_EDGE / float(max(h, w)))
+        small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if scale < 1.0 else gray
+        sh, sw = small.shape[:2]
+        rh, rw = int(sh * ARUCO_CORNER_ROI), int(sw * ARUCO_CORNER_ROI)
+
+        def _detect(img, ox, oy, found):
+            corners, ids, _ = detector.detectMarkers(img)
+            if ids is None: return
+            for c, marker_id in zip(corners, ids.flatten()):
+                marker_id = int(marker_id)
+                if marker_id in ARUCO_IDS and marker_id not in found:
+                    found[marker_id] = (c.reshape(4, 2) + (ox, oy)) / scale
+
+        found = {}
+        for ox, oy in [(0, 0), (sw - rw, 0), (sw - rw, sh - rh), (0, sh - rh)]:
+            _detect(small[oy:oy + rh, ox:ox + rw], ox, oy, found)
+        if len(found) < 3:
+            _detect(small, 0, 0, found)
+        if len(found) < 3: return None, None
+
+        ids = sorted(found)
+        src = np.concatenate([found[i] for i in ids]).astype(np.float32)
+        if scale < 1.0:
+            win = max(2, int(round(1.5 / scale)))
+            criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.01)
+            src = cv2.cornerSubPix(gray, src.reshape(-1, 1, 2), (win, win), (-1, -1), criteria).reshape(-1, 2)
+        dst = np.concatenate([VisionService._aruco_targets(i) for i in ids])
+        H, _ = cv2.findHomography(src, dst, 0)
+        if H is None: return None, None
+
+        centers = np.array([found[i].mean(axis=0) if i in found else [np.nan, np.nan] for i in ARUCO_IDS], dtype=np.float32)
+        return H, centers
+
+    @staticmethod
+    def _order_corners(centers: np.ndarray) -> np.ndarray:
         sorted_y = centers[np.argsort(centers[:, 1])]
         top_2 = sorted_y[:2]; bottom_2 = sorted_y[2:]
         
@@ -177,153 +486,428 @@ class VisionService:
         rect[1] = top_2[np.argmax(top_2[:, 0])] # TR
         rect[2] = bottom_2[np.argmax(bottom_2[:, 0])] # BR
         rect[3] = bottom_2[np.argmin(bottom_2[:, 0])] # BL
-        
-        width, height = 1654, 2339 # Standard A4 at ~200dpi
-        dst = np.array([[0, 0], [width-1, 0], [width-1, height-1], [0, height-1]], dtype="float32")
-        M = cv2.getPerspectiveTransform(rect, dst)
-        aligned_img = cv2.warpPerspective(image, M, (width, height))
+        return rect
+
+    @staticmethod
+    def _aligned_corners() -> np.ndarray:
+        width, height = ALIGNED_WIDTH, ALIGNED_HEIGHT
+        return np.array([[0, 0], [width-1, 0], [width-1, height-1], [0, height-1]], dtype="float32")
+
+    @staticmethod
+    def rotate_upright(image: np.ndarray, rotation: int) -> np.ndarray:
+        """Rotates `image` clockwise by `rotation` (0 / 90 / 180 / 270) degrees."""
+        code = _ROTATE_CODES.get(rotation % 360)
+        return image if code is None else cv2.rotate(image, code)
+
+    @staticmethod
+    def _qr_rotation(analysis: PageAnalysis) -> Optional[int]:
+        """Clockwise rotation that makes the first QR symbol upright (its corner order follows the symbol, not the page)."""
+        for pts in analysis.qr_boxes:
+            if len(pts) < 2: continue
+            dx, dy = pts[1] - pts[0]
+            return int(round(-np.degrees(np.arctan2(dy, dx)) / 90.0)) % 4 * 90
+        return None
 
-        # --- Step 4: Final Sanity Check (Anti-Blackout) ---
+    @staticmethod
+    def _header_rotation(analysis: PageAnalysis) -> Optional[int]:
+        """Clockwise rotation that brings the [START_Q] barcode (printed under the header) to the top edge."""
+        h, w = analysis.shape
+        for info, pts in analysis.barcodes:
+            if "START_Q" not in info: continue
+            cx, cy = pts.mean(axis=0)
+            # 離哪一邊最近：上 -> 0、右 -> 270、下 -> 180、左 -> 90
+            edges = {0: cy / h, 270: 1 - cx / w, 180: 1 - cy / h, 90: cx / w}
+            return min(edges, key=edges.get)
+        return None
+
+    @staticmethod
+    def _profile_asymmetry(ink: np.ndarray) -> Tuple[float, float]:
+        """
+        (top-heaviness, left-alignment) of a binarised page in [-1, 1]; positive = looks upright.
+        Exam pages fill from the top, and printed lines share a left margin while their right ends are ragged.
+        """
+        h, w = ink.shape
+        # 框線 / 格線 (長直線、長橫線) 不算：否則答案框左右兩邊會讓左右對齊程度相同
+        lines = cv2.morphologyEx(ink, cv2.MORPH_OPEN, np.ones((max(3, h // 30), 1), np.uint8))
+        lines |= cv2.morphologyEx(ink, cv2.MORPH_OPEN, np.ones((1, max(3, w // 8)), np.uint8))
+        ink = ink & ~lines
+        rows = ink.sum(axis=1).astype(np.float64)
+        band = max(1, h // 4)
+        top, bottom = rows[:band].sum(), rows[-band:].sum()
+        vertical = (top - bottom) / max(1.0, top + bottom)
+
+        written = np.flatnonzero(ink.sum(axis=1) >= 3)
+        if len(written) < 5: return vertical, 0.0
+        firsts = np.argmax(ink[written], axis=1)
+        lasts = w - 1 - np.argmax(ink[written, ::-1], axis=1)
+        # 最常見的行首 / 行尾位置 (±1%) 佔多少列：印刷文字有共同左邊界，行尾參差
+        bins = np.arange(0, w + max(2, w // 50), max(2, w // 50))
+        left = np.histogram(firsts, bins)[0].max() / float(len(written))
+        right = np.histogram(lasts, bins)[0].max() / float(len(written))
+        return vertical, float(left - right)
+
+    @staticmethod
+    def detect_orientation(image: np.ndarray, analysis: Optional[PageAnalysis] = None) -> int:
+        """
+        Clockwise rotation (0 / 90 / 180 / 270) that makes a scanned page upright.
+        1. A decoded QR symbol gives the answer directly; else the [START_Q] barcode must sit at the top.
+        2. Otherwise a thumbnail: an A4-landscape raster is a 90° / 270° page (profile cues pick which);
+           a portrait page is only flipped when it is clearly bottom-heavy and not left-aligned.
+        """
+        if analysis is not None:
+            rotation = VisionService._qr_rotation(analysis)
+            if rotation is None: rotation = VisionService._header_rotation(analysis)
+            if rotation is not None: return rotation
+
+        gray = analysis.gray if analysis is not None else VisionService._to_gray(image)
+        h, w = gray.shape[:2]
+        scale = min(1.0, ORIENT_THUMB_LONG_EDGE / float(max(h, w)))
+        thumb = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if scale < 1.0 else gray
+        ink = cv2.adaptiveThreshold(thumb, 1, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 15, 15)
+
+        def _score(rotation: int) -> Tuple[float, float]:
+            return VisionService._profile_asymmetry(VisionService.rotate_upright(ink, rotation))
+
+        if w > h:
+            if abs(w / float(h) - PAPER_H_CM / PAPER_W_CM) > ORIENT_A4_ASPECT_TOL: return 0
+            return max((90, 270), key=lambda r: sum(_score(r)))
+        vertical, left = _score(0)
+        if vertical < -ORIENT_MIN_ASYMMETRY and left <= 0: return 180
+        return 0
+
+    @staticmethod
+    def prepare_page(image: np.ndarray) -> Tuple[np.ndarray, PageAnalysis, int]:
+        """
+        Page pre-pass: (upright image, full analysis, applied clockwise rotation).
+        Orientation is fixed before the marker search, so corner squares / boxes are found on an upright page.
+        """
+        analysis = VisionService.analyze_page(image, find_markers=False)
+        rotation = VisionService.detect_orientation(image, analysis)
+        if rotation:
+            logger.info(f"Page rotated {rotation}° to upright")
+            image = VisionService.rotate_upright(image, rotation)
+            analysis = VisionService.analyze_page(image, find_markers=False)
+        VisionService._attach_markers(analysis)
+        return image, analysis, rotation
+
+    @staticmethod
+    def analyze_page(image: np.ndarray, find_markers: bool = True) -> PageAnalysis:
+        """
+        Runs the expensive page-level detectors exactly once:
+        grayscale plane, QR payloads/boxes, barcodes, fiducial markers and homography.
+        """
+        gray = VisionService._to_gray(image)
+        qr_payloads, qr_boxes = VisionService._decode_qr(gray)
+        barcodes = VisionService._decode_barcodes(gray)
+        analysis = PageAnalysis(
+            shape=tuple(gray.shape[:2]), gray=gray,
+            qr_payloads=qr_payloads, qr_boxes=qr_boxes, barcodes=barcodes
+        )
+        if find_markers: VisionService._attach_markers(analysis)
+        return analysis
+
+    @staticmethod
+    def _attach_markers(analysis: PageAnalysis) -> None:
+        """Fiducial search (ArUco first, then corner squares) on an analysed page; fills markers / homography."""
+        homography, markers = VisionService._find_aruco(analysis.gray)
+        if homography is not None:
+            analysis.markers, analysis.homography = markers, homography
+            return
+        markers = VisionService._find_markers(analysis.gray, analysis.forbidden_rects())
+        if markers is not None:
+            analysis.markers = markers
+            analysis.homography = cv2.getPerspectiveTransform(markers, VisionService._aligned_corners())
+
+    @staticmethod
+    def _resolve_analysis(image: np.ndarray, analysis: Optional[PageAnalysis], find_markers: bool = False) -> PageAnalysis:
+        if analysis is not None and analysis.matches(image): return analysis
+        return VisionService.analyze_page(image, find_markers=find_markers)
+
+    @staticmethod
+    def detect_qr_marker(image: np.ndarray, analysis: Optional[PageAnalysis] = None) -> Optional[str]:
+        """Detects the top-right QR Code."""
+        return VisionService._resolve_analysis(image, analysis).qr_content
+
+    @staticmethod
+    def detect_linear_barcode_position(image: np.ndarray, analysis: Optional[PageAnalysis] = None) -> Optional[int]:
+        """
+        Attempts to detect the [START_Q] linear barcode.
+        Returns the Y-coordinate of the bottom of the barcode if found.
+        """
+        return VisionService._resolve_analysis(image, analysis).start_barcode_y()
+
+    @staticmethod
+    def get_header_cutoff_y(image: np.ndarray, is_first_page: bool = True, manual_p1_ratio: float = 0.15,
+                            analysis: Optional[PageAnalysis] = None) -> int:
+        img_h = image.shape[0]
+        if not is_first_page:
+            # 非首頁，只留極少邊界 (0.5%)
+            return int(img_h * 0.005) 
+
+        default_cutoff = int(img_h * manual_p1_ratio)
+        analysis = VisionService._resolve_analysis(image, analysis)
+
+        # 1. [Priority 1] Linear Barcode (Absolute Truth)
+        barcode_y = analysis.start_barcode_y()
+        if barcode_y is not None:
+            return int(barcode_y + (img_h * 0.015))
+
+        # 2. [Priority 2] QR Code vs Manual Slider
+        try:
+            if len(analysis.qr_boxes) > 0:
+                qr_points = analysis.qr_boxes[0]
+                max_y = np.max(qr_points[:, 1])
+                dynamic_cutoff = int(max_y + (img_h * 0.01))
+                
+                # [CRITICAL FIX] Use MAX. If manual slider is huge, it overrides auto-detection.
+                # 防止誤判：如果 QR Code 在右下角 (System QR)，位置會很低 (>30%)，
+                # 此時應忽略該 QR 的位置，改用 Manual Slider 或 Default。
+                if dynamic_cutoff < img_h * 0.3:
+                    return max(dynamic_cutoff, default_cutoff)
+                    
+            return default_cutoff
+        except Exception:
+            return default_cutoff
+
+    @staticmethod
+    def extract_header_image(image: np.ndarray, is_first_page: bool = True, manual_p1_ratio: float = 0.15,
+                             analysis: Optional[PageAnalysis] = None) -> Optional[np.ndarray]:
+        cutoff_y = VisionService.get_header_cutoff_y(image, is_first_page, manual_p1_ratio, analysis=analysis)
+        if cutoff_y < 50: return None
+        return image[0:cutoff_y, :]
+
+    @staticmethod
+    def _project_analysis(analysis: PageAnalysis, aligned_img: np.ndarray, M: np.ndarray) -> PageAnalysis:
+        """Maps QR / Barcode geometry of a raw-page analysis into the aligned frame (no re-detection)."""
+        def _warp(pts: np.ndarray) -> np.ndarray:
+            return cv2.perspectiveTransform(pts.reshape(-1, 1, 2).astype(np.float32), M).reshape(-1, 2)
+
+        gray = VisionService._to_gray(aligned_img)
+        return replace(
+            analysis,
+            shape=tuple(gray.shape[:2]), gray=gray,
+            qr_boxes=[_warp(p) for p in analysis.qr_boxes],
+            barcodes=[(info, _warp(p)) for info, p in analysis.barcodes],
+            markers=VisionService._aligned_corners(),
+            homography=M, is_aligned=True
+        )
+
+    @staticmethod
+    def align_page(image: np.ndarray, analysis: Optional[PageAnalysis] = None) -> Tuple[np.ndarray, PageAnalysis]:
+        """
+        Aligns the page and returns (aligned_image, analysis_in_aligned_frame).
+        Without a matching analysis the page goes through prepare_page first (rotated / upside-down scans are
+        turned upright). If alignment is not possible the (upright) image and its analysis are returned.
+        """
+        if analysis is None or not analysis.matches(image):
+            image, analysis, _ = VisionService.prepare_page(image)
+        if analysis.is_aligned or analysis.homography is None:
+            return image, analysis
+
+        M = analysis.homography
+        aligned_img = cv2.warpPerspective(image, M, (ALIGNED_WIDTH, ALIGNED_HEIGHT))
+
+        # --- Final Sanity Check (Anti-Blackout) ---
         # If the result is suspicious (e.g. mostly black or tiny file size), revert.
         if aligned_img is None or aligned_img.size == 0:
-            return image
+            return image, analysis
             
         # Check mean brightness. Valid docs are mostly white (>200). 
         # If mean < 50, it's pitch black or dark grey -> Fail.
-        gray_aligned = cv2.cvtColor(aligned_img, cv2.COLOR_BGR2GRAY)
-        mean_val = np.mean(gray_aligned)
+        aligned_analysis = VisionService._project_analysis(analysis, aligned_img, M)
+        mean_val = np.mean(aligned_analysis.gray)
         if mean_val < 50: 
-            return image
+            return image, analysis
 
+        return aligned_img, aligned_analysis
+
+    @staticmethod
+    def align_document(image: np.ndarray, analysis: Optional[PageAnalysis] = None) -> np.ndarray:
+        """
+        Aligns document using 4-corner detection.
+        Includes safety mechanisms to prevent black screens caused by QR interference.
+        Pass a PageAnalysis from `analyze_page` to skip re-detecting QR/Barcodes/markers.
+        """
+        aligned_img, _ = VisionService.align_page(image, analysis)
         return aligned_img
 
     @staticmethod
-    def _is_inside(boxA, boxB):
-        xa, ya, wa, ha = boxA
-        xb, yb, wb, hb = boxB
-        pad = 5
-        return (xa >= xb - pad) and (ya >= yb - pad) and \
-               ((xa + wa) <= (xb + wb + pad)) and ((ya + ha) <= (yb + hb + pad))
+    def _iou_matrix(boxes: np.ndarray) -> np.ndarray:
+        """Pairwise IoU of (N, 4) x, y, w, h boxes via broadcasting -> (N, N)."""
+        x1, y1 = boxes[:, 0], boxes[:, 1]
+        x2, y2 = x1 + boxes[:, 2], y1 + boxes[:, 3]
+        inter_w = np.clip(np.minimum(x2[:, None], x2[None, :]) - np.maximum(x1[:, None], x1[None, :]), 0, None)
+        inter_h = np.clip(np.minimum(y2[:, None], y2[None, :]) - np.maximum(y1[:, None], y1[None, :]), 0, None)
+        inter = inter_w * inter_h
+        area = boxes[:, 2] * boxes[:, 3]
+        return inter / (area[:, None] + area[None, :] - inter + 1e-6)
 
     @staticmethod
-    def _compute_iou(boxA, boxB):
-        xA = max(boxA[0], boxB[0])
-        yA = max(boxA[1], boxB[1])
-        xB = min(boxA[0] + boxA[2], boxB[0] + boxB[2])
-        yB = min(boxA[1] + boxA[3], boxB[1] + boxB[3])
+    def _inside_matrix(boxes: np.ndarray, pad: int = 5) -> np.ndarray:
+        """inside[i, j] = box i lies within box j (with `pad` px tolerance) -> (N, N) bool."""
+        x1, y1 = boxes[:, 0], boxes[:, 1]
+        x2, y2 = x1 + boxes[:, 2], y1 + boxes[:, 3]
+        return (
+            (x1[:, None] >= x1[None, :] - pad) & (y1[:, None] >= y1[None, :] - pad) &
+            (x2[:, None] <= x2[None, :] + pad) & (y2[:, None] <= y2[None, :] + pad)
+        )
 
-        interArea = max(0, xB - xA) * max(0, yB - yA)
-        boxAArea = boxA[2] * boxA[3]
-        boxBArea = boxB[2] * boxB[3]
+    @staticmethod
+    def _filter_boxes(candidates: np.ndarray, iou_threshold: float = 0.8) -> np.ndarray:
+        """
+        Filter 1: greedy NMS (largest area first, IoU > threshold suppressed).
+        Filter 2: drop boxes that sit inside a box >10% larger.
+        """
+        area = candidates[:, 2] * candidates[:, 3]
+        boxes = candidates[np.argsort(-area, kind="stable")]
+        n = len(boxes)
 
-        iou = interArea / float(boxAArea + boxBArea - interArea + 1e-6)
-        return iou
+        # 只有保留下來的框會壓掉後面的框 -> 逐列走訪上三角矩陣 (每列為向量運算)
+        suppress = np.triu(VisionService._iou_matrix(boxes) > iou_threshold, k=1)
+        keep = np.ones(n, dtype=bool)
+        for i in np.flatnonzero(suppress.any(axis=1)):
+            if keep[i]: keep &= ~suppress[i]
+        boxes = boxes[keep]
+
+        area = boxes[:, 2] * boxes[:, 3]
+        is_inner = (VisionService._inside_matrix(boxes) & (area[None, :] > area[:, None] * 1.1)).any(axis=1)
+        return boxes[~is_inner]
 
     @staticmethod
-    def _find_boxes_with_cutoff(image: np.ndarray, cutoff_y: int) -> List[Tuple[int, int, int, int]]:
-        if len(image.shape) == 3: gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        else: gray = image
-        
-        thresh = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 15, 2)
+    def _sort_reading_order(boxes: np.ndarray, row_threshold: int = 50) -> np.ndarray:
+        """Rows by center Y (anchored on the row's first box), then left-to-right within a row."""
+        cy = boxes[:, 1] + boxes[:, 3] / 2
+        order = np.argsort(cy, kind="stable")
+        boxes, cy = boxes[order], cy[order]
+
+        row_id = np.empty(len(boxes), dtype=np.int64)
+        start, row = 0, 0
+        while start < len(boxes):
+            end = int(np.searchsorted(cy, cy[start] + row_threshold, side="left"))
+            end = max(end, start + 1)
+            row_id[start:end] = row
+            start, row = end, row + 1
+        return boxes[np.lexsort((boxes[:, 0], row_id))]
+
+    @staticmethod
+    def _box_candidate_mask(rects: np.ndarray, img_w: int, img_h: int, cutoff_y: int, slack: int = 0) -> np.ndarray:
+        """Size / page-border / cutoff filters of _find_boxes_with_cutoff; `slack` px loosens them for coarse boxes."""
+        x, y, w, h = rects.T
+        mask = (w + 2 * slack > img_w * 0.10) & (h + 2 * slack > img_h * 0.03)
+        mask &= ~((w - 2 * slack > img_w * 0.96) & (h - 2 * slack > img_h * 0.96))
+        mask &= (x + slack > 5) & (y + slack > 5) & ((x + w) - slack < img_w - 5) & ((y + h) - slack < img_h - 5)
+        mask &= y + slack > cutoff_y
+        return mask
+
+    @staticmethod
+    def _box_threshold(gray: np.ndarray, offset: float = 2) -> np.ndarray:
+        thresh = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 15, offset)
         kernel = np.ones((3,3), np.uint8)
-        dilated = cv2.dilate(thresh, kernel, iterations=1)
-        
-        contours, _ = cv2.findContours(dilated, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-        
-        candidate_boxes = []
+        return cv2.dilate(thresh, kernel, iterations=1)
+
+    @staticmethod
+    def _refine_edge(gray: np.ndarray, pos: int, lo: int, hi: int, axis: int, outer_first: bool, search: int) -> int:
+        """
+        Full-resolution position of one box border near the coarse estimate `pos`.
+        Thresholds only a thin strip (`lo`..`hi` along the border, `pos` +/- search across it) and returns
+        the outer end of the ink run (columns / rows inked along >= PYRAMID_EDGE_FILL of the strip)
+        closest to `pos`; `pos` if there is none.
+        axis=1: vertical border (x position), axis=0: horizontal border (y position).
+        """
+        pad = 8  # adaptiveThreshold 15x15 視窗半徑 + dilate
+        limit = gray.shape[1] if axis == 1 else gray.shape[0]
+        a0, a1 = max(0, pos - search - pad), min(limit, pos + search + pad + 1)
+        if a1 - a0 <= 2 * pad or hi - lo < 4: return pos
+        strip = gray[lo:hi, a0:a1] if axis == 1 else gray[a0:a1, lo:hi]
+        ink = VisionService._box_threshold(strip) > 0
+        profile = ink.mean(axis=0) if axis == 1 else ink.mean(axis=1)
+        core = slice(pad if a0 > 0 else 0, len(profile) - pad if a1 < limit else len(profile))
+        hits = np.flatnonzero(profile[core] >= PYRAMID_EDGE_FILL) + a0 + core.start
+        if not len(hits): return pos
+
+        runs = np.split(hits, np.flatnonzero(np.diff(hits) > 1) + 1)
+        run = min(runs, key=lambda r: 0 if r[0] <= pos <= r[-1] else min(abs(r[0] - pos), abs(r[-1] - pos)))
+        return int(run[0] if outer_first else run[-1])
+
+    @staticmethod
+    def _refine_box(gray: np.ndarray, box, search: int) -> Tuple[int, int, int, int]:
+        """Snaps the 4 borders of an up-scaled coarse box to the full-resolution lines."""
+        x, y, w, h = (int(v) for v in box)
+        x2, y2 = x + w - 1, y + h - 1
+        # 只看邊線中段，避開圓角與鄰近框線的交會處
+        ys, ye = y + h // 5, y + h - h // 5
+        xs, xe = x + w // 5, x + w - w // 5
+        nx = VisionService._refine_edge(gray, x, ys, ye, 1, True, search)
+        nx2 = VisionService._refine_edge(gray, x2, ys, ye, 1, False, search)
+        ny = VisionService._refine_edge(gray, y, xs, xe, 0, True, search)
+        ny2 = VisionService._refine_edge(gray, y2, xs, xe, 0, False, search)
+        return nx, ny, nx2 - nx + 1, ny2 - ny + 1
+
+    @staticmethod
+    def _find_boxes_with_cutoff(image: np.ndarray, cutoff_y: int) -> List[Tuple[int, int, int, int]]:
+        gray = VisionService._to_gray(image)
         img_h, img_w = image.shape[:2]
-        min_w = img_w * 0.10
-        min_h = img_h * 0.03
-        
-        for cnt in contours:
-            x, y, w, h = cv2.boundingRect(cnt)
-            if w > min_w and h > min_h:
-                if w > img_w * 0.96 and h > img_h * 0.96: continue
-                if x > 5 and y > 5 and (x+w) < img_w-5 and (y+h) < img_h-5:
-                    if y > cutoff_y:
-                        candidate_boxes.append((x, y, w, h))
-
-        if not candidate_boxes: return []
-
-        # Filter 1: IoU
-        unique_boxes = []
-        candidate_boxes.sort(key=lambda b: b[2]*b[3], reverse=True)
-        keep_indices = [True] * len(candidate_boxes)
-        for i in range(len(candidate_boxes)):
-            if not keep_indices[i]: continue
-            for j in range(i + 1, len(candidate_boxes)):
-                if not keep_indices[j]: continue
-                if VisionService._compute_iou(candidate_boxes[i], candidate_boxes[j]) > 0.8:
-                    keep_indices[j] = False
-        for i in range(len(candidate_boxes)):
-            if keep_indices[i]: unique_boxes.append(candidate_boxes[i])
-
-        # Filter 2: Container
-        final_boxes = []
-        for i, boxA in enumerate(unique_boxes):
-            is_inner_box = False
-            for j, boxB in enumerate(unique_boxes):
-                if i == j: continue
-                if VisionService._is_inside(boxA, boxB):
-                     areaA = boxA[2] * boxA[3]
-                     areaB = boxB[2] * boxB[3]
-                     if areaB > areaA * 1.1:
-                        is_inner_box = True; break
-            if not is_inner_box: final_boxes.append(boxA)
-
-        # Sort
-        boxes_with_center = []
-        for b in final_boxes:
-            x, y, w, h = b
-            cy = y + (h / 2)
-            boxes_with_center.append({'box': b, 'cy': cy, 'x': x})
-        boxes_with_center.sort(key=lambda k: k['cy'])
-
-        rows = []
-        if not boxes_with_center: return []
-        current_row = [boxes_with_center[0]]
-        row_threshold = 50
-        for item in boxes_with_center[1:]:
-            prev_cy = current_row[0]['cy']
-            curr_cy = item['cy']
-            if abs(curr_cy - prev_cy) < row_threshold: current_row.append(item)
-            else: rows.append(current_row); current_row = [item]
-        rows.append(current_row)
-
-        sorted_boxes = []
-        for row in rows:
-            row.sort(key=lambda k: k['x'])
-            for item in row: sorted_boxes.append(item['box'])
-                
-        return sorted_boxes
+
+        scale = VisionService._pyramid_scale(gray.shape)
+        if scale < 1.0:
+            # 粗層找候選框 -> 放大回原座標 (放寬篩選) -> 全解析度只精修四條邊線
+            small, fx, fy = VisionService._downscale(gray, scale)
+            # 單一雜訊像素在粗層只讓所在區塊變暗 255·s² (1/4 = 16 灰階)；offset 取這個值，2px 框線 (約 128) 仍遠高於門檻
+            offset = max(2.0, 255.0 * scale * scale)
+            contours, _ = cv2.findContours(VisionService._box_threshold(small, offset), cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+            if not contours: return []
+            coarse = np.array([cv2.boundingRect(cnt) for cnt in contours], dtype=np.float64)
+            coarse = np.rint(coarse * (fx, fy, fx, fy)).astype(np.int64)
+            search = int(np.ceil(4 * max(fx, fy))) + 2  # 粗層 dilate + 模糊線寬約 3 個粗像素
+            coarse = coarse[VisionService._box_candidate_mask(coarse, img_w, img_h, cutoff_y, slack=search)]
+            if not len(coarse): return []
+            rects = np.array([VisionService._refine_box(gray, b, search) for b in coarse], dtype=np.int64)
+        else:
+            contours, _ = cv2.findContours(VisionService._box_threshold(gray), cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+            if not contours: return []
+            rects = np.array([cv2.boundingRect(cnt) for cnt in contours], dtype=np.int64)
+
+        candidate_boxes = rects[VisionService._box_candidate_mask(rects, img_w, img_h, cutoff_y)]
+
+        if not len(candidate_boxes): return []
+
+        final_boxes = VisionService._filter_boxes(candidate_boxes)
+        if not len(final_boxes): return []
+        sorted_boxes = VisionService._sort_reading_order(final_boxes)
+        return [tuple(int(v) for v in b) for b in sorted_boxes]
+
+    @staticmethod
+    def parse_qr_page(qr_content: Optional[str]) -> Optional[int]:
+        """Extracts the page number from a system QR payload (e.g. EXAM_XXXX-P2)."""
+        if not qr_content: return None
+        # 搜尋 -P數字 或 -Page數字 (例如 -P1, -P2, -P10)
+        match = re.search(r'-(?:P|Page)(\d+)', qr_content)
+        return int(match.group(1)) if match else None
 
     @staticmethod
     def detect_answer_areas(
         image: np.ndarray, 
         is_first_page: bool = True,
-        manual_p1_ratio: float = 0.15
+        manual_p1_ratio: float = 0.15,
+        analysis: Optional[PageAnalysis] = None
     ) -> Tuple[List[Tuple[int, int, int, int]], int]:
         
-        qr_content = VisionService.detect_qr_marker(image)
+        analysis = VisionService._resolve_analysis(image, analysis)
         
         # [FIX] 使用 Regex 提取頁碼，解決 P3+ 與 P10 誤判問題
-        if qr_content:
-            # 搜尋 -P數字 或 -Page數字 (例如 -P1, -P2, -P10)
-            match = re.search(r'-(?:P|Page)(\d+)', qr_content)
-            if match:
-                page_num = int(match.group(1))
-                # 如果頁碼 > 1，強制設為 False；如果是 1，設為 True
-                is_first_page = (page_num == 1)
-            # 若沒搜尋到頁碼 (例如行銷 QR)，則維持傳入的 is_first_page 狀態，不做更動
+        page_num = VisionService.parse_qr_page(analysis.qr_content)
+        if page_num is not None:
+            # 如果頁碼 > 1，強制設為 False；如果是 1，設為 True
+            is_first_page = (page_num == 1)
+        # 若沒搜尋到頁碼 (例如行銷 QR)，則維持傳入的 is_first_page 狀態，不做更動
             
-        current_cutoff = VisionService.get_header_cutoff_y(image, is_first_page=is_first_page, manual_p1_ratio=manual_p1_ratio)
-        if len(image.shape) == 3: gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        else: gray = image
+        current_cutoff = VisionService.get_header_cutoff_y(image, is_first_page=is_first_page, manual_p1_ratio=manual_p1_ratio, analysis=analysis)
+        gray = analysis.gray
         
-        boxes = VisionService._find_boxes_with_cutoff(image, current_cutoff)
+        boxes = VisionService._find_boxes_with_cutoff(gray, current_cutoff)
         if not boxes and current_cutoff > image.shape[0] * 0.05:
             retry_cutoff = int(image.shape[0] * 0.005) 
-            boxes_retry = VisionService._find_boxes_with_cutoff(image, retry_cutoff)
+            boxes_retry = VisionService._find_boxes_with_cutoff(gray, retry_cutoff)
             if boxes_retry: return boxes_retry, retry_cutoff
 
         return boxes, current_cutoff
@@ -346,6 +930,125 @@ class VisionService:
                         cv2.FONT_HERSHEY_SIMPLEX, 1.0, (255, 255, 255), 2)
         return debug_img
 
+    @staticmethod
+    def find_ink_bbox(image: np.ndarray, min_line_frac: float = 0.4) -> Optional[Tuple[int, int, int, int]]:
+        """
+        (x, y, w, h) of the written region, or None when the crop holds no ink.
+        Ruled lines and box borders (rows / columns inked along more than `min_line_frac` of the crop)
+        are removed first, then the bounds come from the row / column projection profiles of the ink mask.
+        """
+        gray = VisionService._to_gray(image)
+        h, w = gray.shape[:2]
+        if h < 8 or w < 8: return None
+        ink = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 25, 15) > 0
+
+        # 格線 / 框線：墨跡佔整列 (欄) min_line_frac 以上者連同相鄰一列 (欄) 清除
+        line_rows = np.count_nonzero(ink, axis=1) >= w * min_line_frac
+        line_cols = np.count_nonzero(ink, axis=0) >= h * min_line_frac
+        ink[np.convolve(line_rows, np.ones(3), "same") > 0] = False
+        ink[:, np.convolve(line_cols, np.ones(3), "same") > 0] = False
+
+        # 投影：小於 INK_MIN_RUN 像素的列 / 欄視為雜點 (掃描污點、格線殘影)
+        rows = np.flatnonzero(np.count_nonzero(ink, axis=1) >= INK_MIN_RUN)
+        cols = np.flatnonzero(np.count_nonzero(ink, axis=0) >= INK_MIN_RUN)
+        if len(rows) < INK_MIN_RUN or len(cols) < INK_MIN_RUN: return None
+        return int(cols[0]), int(rows[0]), int(cols[-1] - cols[0] + 1), int(rows[-1] - rows[0] + 1)
+
+    @staticmethod
+    def trim_to_ink(image: np.ndarray, margin: int = 16) -> np.ndarray:
+        """View of `image` cut to its ink bounding box plus `margin` px; the crop itself when nothing is written."""
+        bbox = VisionService.find_ink_bbox(image)
+        if bbox is None: return image
+        x, y, w, h = bbox
+        img_h, img_w = image.shape[:2]
+        return image[max(0, y - margin):min(img_h, y + h + margin), max(0, x - margin):min(img_w, x + w + margin)]
+
+    @staticmethod
+    def _ink_stack(stack: np.ndarray) -> np.ndarray:
+        """(N, h, w) gray stack -> ink masks: one adaptiveThreshold over the stack, speckles dropped, ruled lines cleared."""
+        n, h, w = stack.shape
+        # 一次處理整疊 (N*h, w)：各 crop 邊界只互相影響 block/2 列，不影響判斷
+        tall = cv2.adaptiveThreshold(stack.reshape(-1, w), 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 25, 15)
+        # 雜點以連通區塊面積過濾 (medianBlur 會把縮小後 1px 寬的鉛筆筆畫一起抹掉)
+        _, labels, cc_stats, _ = cv2.connectedComponentsWithStats(tall, connectivity=8)
+        speckle = cc_stats[:, cv2.CC_STAT_AREA] < BLANK_SPECKLE_PX
+        speckle[0] = False
+        tall[speckle[labels]] = 0
+        ink = tall.reshape(n, h, w) > 0
+
+        # 格線 / 框線 (同 find_ink_bbox)：連同相鄰一列 / 欄清除
+        line_rows = np.count_nonzero(ink, axis=2) >= w * 0.4
+        line_cols = np.count_nonzero(ink, axis=1) >= h * 0.4
+        line_rows[:, 1:] |= line_rows[:, :-1].copy(); line_rows[:, :-1] |= line_rows[:, 1:].copy()
+        line_cols[:, 1:] |= line_cols[:, :-1].copy(); line_cols[:, :-1] |= line_cols[:, 1:].copy()
+        ink &= ~line_rows[:, :, None]
+        ink &= ~line_cols[:, None, :]
+        return ink
+
+    @staticmethod
+    def _register_stack(stack: np.ndarray) -> np.ndarray:
+        """Shifts every crop onto the stack's pixelwise median (phase correlation, driven by the shared printed content)."""
+        h, w = stack.shape[1:]
+        ref = 255.0 - np.median(stack, axis=0).astype(np.float32)
+        out = np.empty_like(stack)
+        for i, im in enumerate(stack):
+            (dx, dy), _ = cv2.phaseCorrelate(ref, 255.0 - im.astype(np.float32))
+            if max(abs(dx), abs(dy)) > BLANK_MAX_SHIFT: dx = dy = 0.0
+            dx, dy = round(dx), round(dy)  # 整數位移：不重新取樣，筆畫粗細與未對齊的 crop 一致
+            M = np.float32([[1, 0, -dx], [0, 1, -dy]])
+            out[i] = cv2.warpAffine(im, M, (w, h), flags=cv2.INTER_NEAREST, borderMode=cv2.BORDER_REPLICATE)
+        return out
+
+    @staticmethod
+    def answer_ink_counts(images: List[np.ndarray], scale: float = BLANK_SCALE) -> Tuple[np.ndarray, np.ndarray, int, int]:
+        """
+        Written ink per crop for all crops of one question at once
+        -> (residual ink counts, raw ink counts, template ink, pixels per crop).
+        Crops are resized to one common size, stacked and registered onto the stack median; raw ink is counted
+        before anything is subtracted. Pixels inked in nearly every registered crop (printed prompt, labels) form
+        the question's template, which is subtracted with a 1px tolerance to give the residual. The template's
+        own ink is the median crop's ink on the template footprint. Without a template (too few crops) residual == raw.
+        """
+        if not images: return np.zeros(0, np.int64), np.zeros(0, np.int64), 0, 0
+        widths = [im.shape[1] for im in images]; heights = [im.shape[0] for im in images]
+        w = max(8, int(np.median(widths) * scale)); h = max(8, int(np.median(heights) * scale))
+        stack = np.empty((len(images), h, w), np.uint8)
+        for i, im in enumerate(images):
+            stack[i] = cv2.resize(VisionService._to_gray(im), (w, h), interpolation=cv2.INTER_AREA)
+
+        if len(images) < BLANK_TEMPLATE_MIN_CROPS:
+            raw = np.count_nonzero(VisionService._ink_stack(stack).reshape(len(images), -1), axis=1)
+            return raw, raw, 0, h * w
+
+        # 先對齊到整疊的中位數影像，模板只收「幾乎每張都在同一位置」的墨跡 (印刷內容)；
+        # 多數學生在同一處寫了相似答案時，字形 / 位置的差異不會被 ±2px 的寬鬆投票吃掉
+        stack = VisionService._register_stack(stack)
+        ink = VisionService._ink_stack(stack)
+        raw = np.count_nonzero(ink.reshape(len(images), -1), axis=1)
+        template = cv2.dilate((ink.mean(axis=0) >= BLANK_TEMPLATE_FRAC).astype(np.uint8), np.ones((3, 3), np.uint8)) > 0
+        # 模板本身的墨跡量：各 crop 落在模板範圍內墨跡數的中位數 (與 raw 同一套門檻 / 邊緣條件)
+        template_ink = int(np.median(np.count_nonzero((ink & template[None]).reshape(len(images), -1), axis=1)))
+        ink &= ~template[None]
+        return np.count_nonzero(ink.reshape(len(images), -1), axis=1), raw, template_ink, h * w
+
+    @staticmethod
+    def answer_crop_masks(images: List[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        -> (blank, unwritten) boolean masks for all crops of one question (one answer_ink_counts pass).
+        unwritten: residual ink against the question template is negligible (printed content only).
+        blank: unwritten AND raw ink close to the template's own ink; crops that look empty only after template
+        subtraction are left for the grader.
+        """
+        residual, raw, template_ink, area = VisionService.answer_ink_counts(images)
+        max_ink = max(BLANK_MAX_INK_PX, BLANK_MAX_INK_RATIO * area)
+        unwritten = residual <= max_ink
+        return unwritten & (raw <= template_ink + max(max_ink, BLANK_RAW_SLACK * template_ink)), unwritten
+
+    @staticmethod
+    def classify_blank_crops(images: List[np.ndarray]) -> np.ndarray:
+        """Boolean mask: True where the crop holds no written answer (blank, or printed content only)."""
+        return VisionService.answer_crop_masks(images)[0]
+
     @staticmethod
     def crop_images_by_layout(image: np.ndarray, boxes: List[Tuple], padding: int = 20) -> List[np.ndarray]:
         crops = []
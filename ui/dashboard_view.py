@@ -13,27 +13,38 @@ import matplotlib.pyplot as plt
 import matplotlib.font_manager as fm
 import platform
 import streamlit as st
-import json, os, re, time, cv2, datetime, numpy as np
+import json, os, re, time, cv2, datetime, hashlib, numpy as np
 import uuid
+import asyncio
 import tempfile
 import base64
 import pytz
 from PIL import Image
 from io import BytesIO
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import as_completed
 
-from google import genai
 from google.genai import types
 
 import config
 from database.db_manager import (
     get_sys_conf, get_today_batch_count, save_batch_results,
-    get_user_weekly_page_count, User
+    get_user_weekly_page_count, User,
+    get_layout_template, save_layout_template, delete_layout_template
 )
 from utils.localization import t
-from utils.helpers import pdf_to_images, split_pdf_by_pages
+from utils.pdf_source import PdfPageSource, RenderError
+from utils.page_image import PageImage
+from utils.collage_compositor import CollageCell, get_compositor
 from services.grading_service import GradingService
-from services.vision_service import VisionService
+from services.vision_service import VisionService, AlignedPageCache
+from services.vision_pool import get_vision_pool
+from services.dedupe_service import DedupeIndex, page_index
+from services.llm_cache import acached_generate, get_llm_cache
+from services.rate_limiter import estimate_tokens, get_rate_limiter
+from services.retry_policy import SERVICE_FAILURES, agenerate_with_retry, get_breaker, new_retry_budget
+from services.async_grading import AsyncScheduler, get_max_in_flight
+from services.upload_policy import EncodedImage, get_upload_policy, estimate_image_tokens
+from services.layout_manifest import lookup_page_boxes, to_page_frame, parse_qr_exam_id
 from services.ai_service import generate_rubric, generate_class_analysis
 from services.report_service import (
     merge_and_calculate_data, 
@@ -48,6 +59,8 @@ from services.prompt_service import PromptService
 # [NEW] Import Plan Definitions
 from services.plans import PLAN_LIMITS
 
+logger = logging.getLogger(__name__)
+
 # ==============================================================================
 #  Global Helpers
 # ==============================================================================
@@ -133,6 +146,89 @@ def _map_rubric_to_labels(rubric_json: dict) -> list[str]:
         else: labels.append(pid)
     return labels
 
+def _manifest_page_boxes(image, analysis):
+    """
+    [Perf] 系統出的考卷：依 QR (EXAM_ID-P{n}) 查出卷時存下的答案框，不做輪廓偵測。
+    回傳 ([boxes in this page's frame], [labels])；查無 manifest 回傳 None。
+    """
+    entries = lookup_page_boxes(analysis.qr_content if analysis else None)
+    if entries is None: return None
+    boxes = [to_page_frame(e["box"], image.shape, analysis.is_aligned) for e in entries]
+    return boxes, [e["label"] for e in entries]
+
+def _layout_template_key(rubric_json, qr_content=None):
+    """Layout template registry key: 系統考卷以 QR 上的 EXAM_ID，其他以 Rubric 內容 hash。"""
+    exam_id = parse_qr_exam_id(qr_content)
+    if exam_id: return f"qr:{exam_id}"
+    if rubric_json:
+        blob = json.dumps(rubric_json, sort_keys=True, ensure_ascii=False, default=str)
+        return "rubric:" + hashlib.sha1(blob.encode("utf-8")).hexdigest()[:16]
+    return None
+
+def _first_page_qr(source):
+    """第一位學生各頁的系統 QR (每份上傳只解碼一次)。"""
+    qr_cache = st.session_state.setdefault("layout_qr_cache", {})
+    if source.digest not in qr_cache:
+        found = None
+        for img in source.student_pages(0):
+            # QR 只需要灰階：RGB 直接轉灰階，不先複製一份 BGR 整頁
+            analysis = VisionService.analyze_page(PageImage(img, "RGB").gray(), find_markers=False)
+            found = next((q for q in analysis.qr_payloads if parse_qr_exam_id(q)), None)
+            if found: break
+        qr_cache[source.digest] = found
+    return qr_cache[source.digest]
+
+def _show_render_error(e):
+    # 轉圖失敗 (多半是 poppler 未安裝)：整批停止，不以空白頁面繼續批改
+    st.error(f"❌ {t('err_pdf_render', 'PDF to Image Error (Check poppler)')}: {e}")
+
+def _analyze_layout(source, all_labels, man_ratio, ignore_first, saved_pages=None):
+    """
+    以第一位學生建立版面：偵測 (或沿用 saved_pages) 答案框，並產生縮圖預覽。
+    回傳 (layout_map, previews)；layout_map 只含 boxes / labels / cutoff (可存入 DB)。
+    """
+    saved_by_page = {p["page"]: p for p in (saved_pages or [])}
+    label_cursor = 0
+    layout_map, previews = [], []
+    for page_idx, page_img in enumerate(source.student_pages(0)):
+        aligned, page_info = VisionService.align_page(PageImage(page_img, "RGB").bgr())
+        is_p1 = (page_idx == 0)
+        if saved_pages is not None:
+            saved = saved_by_page.get(page_idx, {})
+            boxes, cutoff = [tuple(b) for b in saved.get("boxes", [])], saved.get("cutoff")
+        else:
+            from_manifest = _manifest_page_boxes(aligned, page_info)
+            if from_manifest is not None:
+                boxes, cutoff = from_manifest[0], None
+            else:
+                boxes, cutoff = VisionService.detect_answer_areas(aligned, is_first_page=is_p1, manual_p1_ratio=man_ratio, analysis=page_info)
+                if ignore_first and is_p1 and boxes: boxes.pop(0)
+
+        current_page_labels = []
+        if all_labels:
+            count = len(boxes)
+            current_page_labels = all_labels[label_cursor : label_cursor + count]
+            label_cursor += count
+
+        layout_map.append({
+            "page": page_idx, "boxes": [[int(v) for v in b] for b in boxes],
+            "labels": current_page_labels, "cutoff": int(cutoff) if cutoff is not None else None
+        })
+        # 只保留縮圖 (不再把整頁 debug 圖放在 session state)
+        debug_img = VisionService.draw_debug_boxes(aligned, boxes, labels=current_page_labels, actual_cutoff=cutoff)
+        scale = min(1.0, 800 / debug_img.shape[1])
+        thumb = cv2.resize(debug_img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        ok, buf = cv2.imencode(".jpg", thumb, [cv2.IMWRITE_JPEG_QUALITY, 80])
+        previews.append(buf.tobytes() if ok else None)
+    return layout_map, previews
+
+def _template_meta_to_layout(template_meta):
+    pages = {}
+    for m in template_meta:
+        p = pages.setdefault(m["page"], {"page": m["page"], "boxes": [], "labels": [], "cutoff": None})
+        p["boxes"].append([int(v) for v in m["box"]]); p["labels"].append(m["label"])
+    return [pages[k] for k in sorted(pages)]
+
 def _generate_meaningful_batch_id(user) -> str:
     clean_name = re.sub(r"[^a-zA-Z0-9]", "", user.username)
     utc_now = datetime.datetime.now(datetime.timezone.utc)
@@ -156,27 +252,13 @@ def _save_student_pdf(batch_id: str, student_id: str, pdf_chunk) -> str:
         else: f.write(pdf_chunk)
     return f_path
 
-def _get_max_workers(user=None):
-    plan = "free"
-    if user and hasattr(user, 'plan') and user.plan:
-        plan = user.plan.lower().strip()
-    
-    # [FIX] 優先從 plans.py 讀取設定，解決不同步問題
-    if plan in PLAN_LIMITS:
-        return PLAN_LIMITS[plan].get("max_workers", 3)
-    
-    # Legacy Fallback (如果 user.plan 是舊的 "pro")
-    if plan == "pro": return PLAN_LIMITS["personal"].get("max_workers", 5)
-    
-    db_key = f"MAX_WORKERS_{plan.upper()}"
-    try:
-        db_val = get_sys_conf(db_key)
-        if db_val and str(db_val).isdigit(): return int(db_val)
-    except: pass
-    if hasattr(config, 'PLAN_MAX_WORKERS') and isinstance(config.PLAN_MAX_WORKERS, dict):
-        config_val = config.PLAN_MAX_WORKERS.get(plan)
-        if config_val: return int(config_val)
-    return getattr(config, 'DEFAULT_MAX_WORKERS', 3)
+def _rate_stats(limiter, start=None, retry_budget=None, breaker=None):
+    """Current AIMD concurrency plus throttling accumulated since `start` (an earlier stats() snapshot), retries and breaker state."""
+    now = limiter.stats()
+    if start: now.update(throttled=now["throttled"] - start["throttled"], wait_s=round(now["wait_s"] - start["wait_s"], 1))
+    if retry_budget is not None: now.update(retry_budget.stats())
+    if breaker is not None: now.update(breaker.stats())
+    return now
 
 def _calculate_flash_cost(usage_metadata, model="gemini-2.5-flash"):
     if not usage_metadata: return 0.0
@@ -186,44 +268,60 @@ def _calculate_flash_cost(usage_metadata, model="gemini-2.5-flash"):
     out_t = getattr(usage_metadata, 'candidates_token_count', 0) or 0
     return (in_t / 1_000_000 * rate_input) + (out_t / 1_000_000 * rate_output)
 
-def _identify_student_info(user, img_pil, ratio):
-    if not user.google_api_key: return None, None, 0.0
-    try:
-        if isinstance(img_pil, Image.Image): cv_img = cv2.cvtColor(np.array(img_pil), cv2.COLOR_RGB2BGR)
-        else: cv_img = img_pil
-        aligned = VisionService.align_document(cv_img)
-        crop = VisionService.extract_header_image(aligned, True, ratio)
-        cost = 0.0
-        if crop is not None and crop.size > 0:
-            pil_crop = Image.fromarray(cv2.cvtColor(crop, cv2.COLOR_BGR2RGB))
-            img_byte_arr = BytesIO(); pil_crop.save(img_byte_arr, format='PNG')
-            client = genai.Client(api_key=user.google_api_key)
-            prompt = """
+IDENTIFY_MODEL = 'gemini-2.5-pro'
+IDENTIFY_PROMPT = """
             Identify the **Handwritten Name** (姓名) and **Student ID** (學號).
             Output JSON: {"Student ID": "...", "Name": "..."}
             If text is unclear or missing, use "Unknown".
             """
-            resp = client.models.generate_content(
-                model='gemini-2.5-pro', 
-                contents=[prompt, types.Part.from_bytes(data=img_byte_arr.getvalue(), mime_type='image/png')], 
-                config={'response_mime_type': 'application/json'}
-            )
-            cost = _calculate_flash_cost(resp.usage_metadata, 'gemini-2.5-pro')
-            try:
-                text = resp.text.strip()
-                if text.startswith("```json"): text = text[7:-3]
-                d = json.loads(text)
-                sid = str(d.get("Student ID", "")).strip()
-                name = str(d.get("Name", "")).strip()
-                if sid.lower() in ["unknown", "none", "null"]: sid = ""
-                if name.lower() in ["unknown", "none", "null"]: name = ""
-                if not sid and not name: return None, None, cost
-                return sid, name, cost
-            except: pass
+
+def _student_header_png(img_pil, ratio, aligned_page=None):
+    if aligned_page is not None:
+        # [Perf] 重用 Batch 內已對齊的頁面，不再重複 warp
+        aligned, page_info = aligned_page.image, aligned_page.analysis
+    else:
+        # PageImage / PIL / BGR ndarray
+        aligned, page_info = VisionService.align_page(PageImage.wrap(img_pil, "BGR").bgr())
+    crop = VisionService.extract_header_image(aligned, True, ratio, analysis=page_info)
+    if crop is None or crop.size == 0: return None
+    return PageImage(crop, "BGR").encode(".png")
+
+def _identity_json(text):
+    return json.loads(text.strip().removeprefix("```json").removesuffix("```"))
+
+def _identify_request(header_png):
+    return dict(model=IDENTIFY_MODEL,
+                contents=[IDENTIFY_PROMPT, types.Part.from_bytes(data=header_png, mime_type='image/png')],
+                config={'response_mime_type': 'application/json'})
+
+def _identify_tokens(header_png):
+    return estimate_tokens(IDENTIFY_PROMPT, [header_png], output_tokens=64)
+
+def _parse_identity(raw_text, usage):
+    cost = _calculate_flash_cost(usage, IDENTIFY_MODEL)
+    try:
+        d = _identity_json(raw_text)
+        sid = str(d.get("Student ID", "")).strip()
+        name = str(d.get("Name", "")).strip()
+        if sid.lower() in ["unknown", "none", "null"]: sid = ""
+        if name.lower() in ["unknown", "none", "null"]: name = ""
+        if not sid and not name: return None, None, cost
+        return sid, name, cost
+    except: return None, None, cost
+
+async def _aidentify_student_info(user, header_png, use_cache=True, retry_budget=None):
+    """Student ID / name from the header crop (Flash, client.aio); the crop is cut beforehand by the caller."""
+    if not user.google_api_key or header_png is None: return None, None, 0.0
+    try:
+        raw_text, usage, _ = await acached_generate(
+            "identify_student", IDENTIFY_MODEL, IDENTIFY_PROMPT, [header_png],
+            lambda: agenerate_with_retry(user.google_api_key, _identify_tokens(header_png), retry_budget, **_identify_request(header_png)),
+            use_cache=use_cache, validate=_identity_json
+        )
+        return _parse_identity(raw_text, usage)
     except Exception as e:
         print(f"[Dashboard] Identity OCR Error: {e}")
         return None, None, 0.0
-    return None, None, 0.0
 
 def display_pdf(pdf_input, height=600):
     try:
@@ -394,6 +492,7 @@ def render_step_2_grading(user):
         with st.expander(f"📐 {t('lbl_vision_settings', 'Vision')}", expanded=True):
             man_ratio = st.slider(t("lbl_header_ratio", "Header Ratio"), 0.10, 0.70, 0.25, 0.01)
             ignore_first = st.checkbox(t("lbl_ignore_first", "Ignore 1st Box"), help=t("help_ignore_first", "Skip box 1"))
+        force_regrade = st.checkbox(t("lbl_force_regrade", "Force regrade"), help=t("help_force_regrade", "Ignore cached AI responses"))
 
     with col_file:
        # up_pdf = st.file_uploader(t("upload_exam_label"), type=["pdf"], key="exam_up")
@@ -409,57 +508,70 @@ def render_step_2_grading(user):
             pps = st.number_input(t("pps_label"), 1, 10, 2)
             if st.button(f"✂️ {t('split_btn')}", type="primary", width="stretch"):
                 with st.spinner(t("splitting")):
-                    ss["exam_chunks"] = split_pdf_by_pages(up_pdf, pps); st.rerun()
+                    # [Perf] 不再切成每生一份 PDF；以頁碼索引原始檔，需要時才轉圖 / 產生 PDF
+                    # 舊上傳檔的暫存 PDF 先刪除
+                    if ss.get("exam_source") is not None: ss["exam_source"].close()
+                    try: ss["exam_source"] = PdfPageSource(up_pdf.getvalue(), pps)
+                    except Exception as e: st.error(f"PDF Split Error: {e}")
+                    st.rerun()
             
-            if ss.get("exam_chunks"):
-                chunks = ss["exam_chunks"]
-                st.info(f"📚 {len(chunks)} {t('msg_students_loaded', 'Students')}")
+            if ss.get("exam_source"):
+                source = ss["exam_source"]
+                st.info(f"📚 {len(source)} {t('msg_students_loaded', 'Students')}")
                 
+                layout_key = None
                 if "Collage" in strategy_raw:
                     st.markdown(f"#### 🖼️ {t('hdr_layout_analysis', 'Layout Analysis')}")
+                    rubric_json = ss.get("rubric_json", {})
+                    all_labels = _map_rubric_to_labels(rubric_json)
+                    try: first_qr = _first_page_qr(source)
+                    except RenderError as e:
+                        _show_render_error(e)
+                        st.stop()
+                    layout_key = _layout_template_key(rubric_json, first_qr)
+
+                    # [Perf] 同一份考卷 (QR) 或同一份 Rubric 的版面直接沿用上次存下的 template
+                    if layout_key and not ss.get("layout_map") and ss.get("layout_key_loaded") != layout_key:
+                        ss["layout_key_loaded"] = layout_key
+                        saved = get_layout_template(user.id, layout_key)
+                        if saved and saved.get("pages"):
+                            try:
+                                ss["layout_map"], ss["layout_previews"] = _analyze_layout(source, all_labels, man_ratio, ignore_first, saved_pages=saved["pages"])
+                                ss["layout_from_registry"] = True
+                            except RenderError as e: _show_render_error(e)
+
                     c_btn_1, c_btn_2 = st.columns([1, 1])
                     trigger_analysis = False
                     with c_btn_1:
-                        if st.button(f"🔍 {t('btn_detect_layout', 'Detect Layout')}", type="secondary", width="stretch"): trigger_analysis = True
+                        detect_label = f"🔄 {t('btn_redetect_layout', 'Re-detect')}" if ss.get("layout_map") else f"🔍 {t('btn_detect_layout', 'Detect Layout')}"
+                        if st.button(detect_label, type="secondary", width="stretch"): trigger_analysis = True
                     with c_btn_2:
-                         if st.button(f"❌ {t('btn_reset_layout', 'Reset')}", width="stretch"): ss.pop("layout_map", None); st.rerun()
+                         if st.button(f"❌ {t('btn_reset_layout', 'Reset')}", width="stretch"):
+                             for k in ["layout_map", "layout_previews", "layout_from_registry"]: ss.pop(k, None)
+                             if layout_key: delete_layout_template(user.id, layout_key)
+                             st.rerun()
 
                     if trigger_analysis:
                         with st.spinner(t("msg_analyzing_layout", "Analyzing...")):
-                            imgs = pdf_to_images(chunks[0])
-                            rubric_json = ss.get("rubric_json", {})
-                            all_labels = _map_rubric_to_labels(rubric_json)
                             if not all_labels: st.warning(f"⚠️ {t('warn_no_rubric_detected', 'No Rubric')}")
-                            
-                            label_cursor = 0 
-                            full_layout_list = []
-                            for page_idx, page_img in enumerate(imgs):
-                                cv_img = cv2.cvtColor(np.array(page_img), cv2.COLOR_RGB2BGR)
-                                aligned = VisionService.align_document(cv_img)
-                                is_p1 = (page_idx == 0)
-                                boxes, cutoff = VisionService.detect_answer_areas(aligned, is_first_page=is_p1, manual_p1_ratio=man_ratio)
-                                if ignore_first and is_p1 and boxes: boxes.pop(0)
-
-                                current_page_labels = []
-                                if all_labels:
-                                    count = len(boxes)
-                                    current_page_labels = all_labels[label_cursor : label_cursor + count]
-                                    label_cursor += count
-                                
-                                debug_img = VisionService.draw_debug_boxes(aligned, boxes, labels=current_page_labels, actual_cutoff=cutoff)
-                                full_layout_list.append({"page": page_idx, "boxes": boxes, "vis_img": debug_img})
-                            ss["layout_map"] = full_layout_list
+                            try:
+                                ss["layout_map"], ss["layout_previews"] = _analyze_layout(source, all_labels, man_ratio, ignore_first)
+                                ss["layout_from_registry"] = False
+                                if layout_key and ss["layout_map"]:
+                                    save_layout_template(user.id, layout_key, {"pages": ss["layout_map"]})
+                            except RenderError as e: _show_render_error(e)
 
                     if ss.get("layout_map"):
+                        if ss.get("layout_from_registry"): st.info(f"♻️ {t('msg_layout_reused', 'Reusing saved layout')} ({layout_key})")
                         st.success(f"✅ {t('msg_layout_analyzed', 'Done')}: {len(ss['layout_map'])} Pages")
-                        for p_data in ss["layout_map"]:
-                            st.image(cv2.cvtColor(p_data['vis_img'], cv2.COLOR_BGR2RGB), caption=f"Page {p_data['page']+1}", width='stretch')
+                        for p_data, preview in zip(ss["layout_map"], ss.get("layout_previews") or []):
+                            if preview: st.image(preview, caption=f"Page {p_data['page']+1}", width='stretch')
 
                 with st.expander(f"👀 {t('preview_chunks')}", expanded=True):
-                    num_chunks = len(chunks)
+                    num_chunks = len(source)
                     idx = st.slider("Student", 0, num_chunks - 1, 0) if num_chunks > 1 else 0
                     st.markdown("### 📄 PDF Preview")
-                    if idx < len(chunks): display_pdf(chunks[idx], height=600) 
+                    if idx < len(source): display_pdf(source.student_pdf_bytes(idx), height=600) 
                 
                 if st.button(t("start_grading_btn"), type="primary", width="stretch"):
                     user_plan = user.plan
@@ -475,15 +587,15 @@ def render_step_2_grading(user):
                         else:
                             max_limit = 70 # Default
 
-                    incoming_pages = len(chunks) * pps
+                    incoming_pages = len(source) * pps
                     if (current_weekly_usage + incoming_pages) > max_limit:
                         st.error(f"❌ {t('quota_exceeded_msg')}")
                     else: 
                         rubric_content = ss.get("rubric_content", "")
                         if "Collage" in strategy_raw:
-                            _run_collage_batch(user, chunks, rubric_content, rub_json, man_ratio, temp_val, mode, internal_subject, ignore_first=ignore_first)
+                            _run_collage_batch(user, source, rubric_content, rub_json, man_ratio, temp_val, mode, internal_subject, ignore_first=ignore_first, layout_key=layout_key, use_cache=not force_regrade)
                         else:
-                            _run_vertical_batch(user, chunks, mode, man_ratio, temp_val, internal_subject, rub_json)
+                            _run_vertical_batch(user, source, mode, man_ratio, temp_val, internal_subject, rub_json, use_cache=not force_regrade)
 
 def inject_progress_css():
     st.markdown("""
@@ -538,78 +650,141 @@ def _update_status(status_container, start_time, done, total, current_task):
     status_container.markdown(html, unsafe_allow_html=True)
 
 class AtomicBatchProcessor:
-    def __init__(self, batch_size=9, grid_cols=3):
+    MAX_CELL = (1024, 1024)   # 單格上限 (w, h)
+    MIN_CELL_H = 48
+    LABEL_GUTTER = 36         # 格子左側編號欄寬度
+    SCALE_STEPS = (1.0, 0.85, 0.7, 0.6, 0.5)
+    MAX_ASPECT = 3.0          # 拼貼圖長寬比上限，避免一長條 (模型閱讀時會被壓縮)
+
+    def __init__(self, batch_size=None, grid_cols=None, token_budget=None, max_cells=None, min_scale=None):
+        # batch_size + grid_cols 皆指定時維持固定格線 (1024x600)；否則依題目自動規劃
         self.batch_size = batch_size
         self.grid_cols = grid_cols
-
-    def _is_image_blank(self, img, threshold=5.0):
-        if img is None or img.size == 0: return True
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        var = cv2.Laplacian(gray, cv2.CV_64F).var()
-        return var < threshold
-
-    def create_batches(self, items, unit_size=(1024, 600)):
+        self.token_budget = token_budget or getattr(config, "COLLAGE_TOKEN_BUDGET", 1548)
+        self.max_cells = max_cells or getattr(config, "COLLAGE_MAX_CELLS", 16)
+        self.min_scale = min_scale or getattr(config, "COLLAGE_MIN_SCALE", 0.5)
+        self.compositor = get_compositor()
+
+    def plan_grid(self, items):
+        """
+        Grid for one question: cell size from the 75th-percentile ink box of its crops,
+        then the (cols, rows, scale) holding the most students whose image stays within
+        the per-request token budget (ties: larger scale, fewer tokens, fewer empty cells).
+        """
+        for item in items:
+            if "ink" not in item: item["ink"] = VisionService.trim_to_ink(item["img"])  # view, 不複製
+        if self.batch_size and self.grid_cols:
+            rows = (self.batch_size + self.grid_cols - 1) // self.grid_cols
+            return {"cols": self.grid_cols, "rows": rows, "unit": (1024, 600), "batch_size": self.batch_size,
+                    "scale": 1.0, "tokens": estimate_image_tokens(self.grid_cols * 1024, rows * 600)}
+
+        gutter = self.LABEL_GUTTER
+        sizes = np.array([item["ink"].shape[:2] for item in items] or [[600, 1024]], dtype=np.float64)
+        ref_h, ref_w = np.percentile(sizes, 75, axis=0)
+        max_w, max_h = self.MAX_CELL
+        base = float(min(1.0, (max_w - gutter) / ref_w, max_h / ref_h))
+        scales = [base * f for f in self.SCALE_STEPS if base * f >= self.min_scale] or [base]
+
+        best, best_key = None, None
+        for scale in scales:
+            unit_w = int(np.ceil(ref_w * scale)) + gutter
+            unit_h = max(self.MIN_CELL_H, int(np.ceil(ref_h * scale)))
+            for cols in range(1, self.max_cells + 1):
+                for rows in range(1, self.max_cells // cols + 1):
+                    tokens = estimate_image_tokens(cols * unit_w, rows * unit_h)
+                    if tokens > self.token_budget: break
+                    if max(cols * unit_w, rows * unit_h) > self.MAX_ASPECT * min(cols * unit_w, rows * unit_h): continue
+                    n = min(cols * rows, len(items))
+                    key = (n, scale, -tokens, -(cols * rows))
+                    if best_key is None or key > best_key:
+                        best_key = key
+                        best = {"cols": cols, "rows": rows, "unit": (unit_w, unit_h), "batch_size": cols * rows,
+                                "scale": scale, "tokens": tokens}
+        if best is None:  # 單格就超過預算：一人一張，用最小縮放
+            unit = (int(np.ceil(ref_w * scales[-1])) + gutter, max(self.MIN_CELL_H, int(np.ceil(ref_h * scales[-1]))))
+            best = {"cols": 1, "rows": 1, "unit": unit, "batch_size": 1, "scale": scales[-1],
+                    "tokens": estimate_image_tokens(*unit)}
+        return best
+
+    def create_batches(self, items, plan=None):
+        plan = plan or self.plan_grid(items)
         batches_result = []
-        for i in range(0, len(items), self.batch_size):
-            chunk = items[i : i + self.batch_size]
-            batches_result.append(self._create_single_batch(chunk, unit_size))
+        for i in range(0, len(items), plan["batch_size"]):
+            chunk = items[i : i + plan["batch_size"]]
+            batches_result.append(self._create_single_batch(chunk, plan, offset=i))
         return batches_result
 
-    def _create_single_batch(self, items, unit_size):
-        unit_w, unit_h = unit_size
-        grid_rows = (self.batch_size + self.grid_cols - 1) // self.grid_cols
-        canvas = np.full((grid_rows * unit_h, self.grid_cols * unit_w, 3), 255, dtype=np.uint8)
+    def _create_single_batch(self, items, plan, offset=0):
+        unit_w, unit_h = plan["unit"]
+        grid_cols, grid_rows = plan["cols"], plan["rows"]
+        gutter = self.LABEL_GUTTER if not (self.batch_size and self.grid_cols) else 0
         batch_uuid = str(uuid.uuid4())[:8]
-        manifest = {"batch_id": batch_uuid, "cells": []}
+        manifest = {"batch_id": batch_uuid, "grid": [grid_rows, grid_cols], "cells": []}
+        cells = []
         
-        for idx in range(self.batch_size):
-            r = idx // self.grid_cols; c = idx % self.grid_cols
-            x_start = c * unit_w; y_start = r * unit_h
-            cell_data = {"index": idx, "is_empty": True, "sid": None, "is_blank_paper": False}
-            
+        for idx in range(grid_rows * grid_cols):
+            cell_data = {"index": idx, "item_index": None, "is_empty": True, "sid": None}
             if idx < len(items):
                 item = items[idx]; src_img = item['img']
-                if self._is_image_blank(src_img):
-                    cell_data["is_blank_paper"] = True
-                    cv2.putText(src_img, "BLANK (0 pts)", (50, 100), cv2.FONT_HERSHEY_SIMPLEX, 2, (200, 200, 200), 5)
-                
-                resized_img = cv2.resize(src_img, (unit_w, unit_h), interpolation=cv2.INTER_LANCZOS4)
-                canvas[y_start : y_start+unit_h, x_start : x_start+unit_w] = resized_img
+                # [Perf] 只把實際作答區 (ink bbox) 等比例放進格子，不再把整塊留白拉伸成 1024x600
+                ink_img = item.get("ink")
+                if ink_img is None: ink_img = VisionService.trim_to_ink(src_img)
+                cells.append(CollageCell(ink_img, str(idx)))
                 cell_data["is_empty"] = False
                 cell_data["sid"] = item['sid']
-                
+                cell_data["item_index"] = offset + idx
             manifest["cells"].append(cell_data)
-        return {"image": canvas, "manifest": manifest, "batch_id": batch_uuid}
 
-def _run_vertical_batch(user, chunks, mode, ratio, temp, subject, rubric_json):
+        # [Perf] 共用畫布池合成後直接編碼成上傳用 bytes (來源裁切圖不被修改)
+        payload = self.compositor.render_encoded(cells, grid_cols, grid_rows, (unit_w, unit_h), gutter)
+        return {"payload": payload, "manifest": manifest, "batch_id": batch_uuid}
+
+def _run_vertical_batch(user, source, mode, ratio, temp, subject, rubric_json, use_cache=True):
     ss = st.session_state
     status_box = st.empty()
     bid = _generate_meaningful_batch_id(user)
     ss["current_batch_id"] = bid
-    workers = _get_max_workers(user) 
     start_t = time.time()
-    total = len(chunks)
+    total = len(source)
     results = []
     
     allowed_labels = _map_rubric_to_labels(rubric_json)
     current_lang = ss.get("language", "繁體中文")
+    llm_cache = get_llm_cache()
+    cache_hits_start = llm_cache.hits if llm_cache else 0
+    limiter = get_rate_limiter().get(user.google_api_key or "")
+    rate_start = limiter.stats()
+    retry_budget = new_retry_budget()
 
     _update_status(status_box, start_t, 0, total, f"{t('status_init_ai', 'Init AI')} ({subject} Mode)...")
 
-    with ThreadPoolExecutor(max_workers=workers) as ex:
-        futures = {ex.submit(
-            _process_single_student_vert, 
-            user, i, ck, ss.get("rubric_content", ""), bid, mode, ratio, temp, allowed_labels, current_lang, subject, rubric_json
-        ): i for i, ck in enumerate(chunks)}
+    # [Perf] 每位學生一個 coroutine：轉圖 / 編碼在 worker thread，等待 Gemini 時不佔執行緒
+    with AsyncScheduler(get_max_in_flight()) as sched:
+        futures = {sched.submit(
+            _aprocess_single_student_vert, 
+            user, i, source, ss.get("rubric_content", ""), bid, mode, ratio, temp, allowed_labels, current_lang, subject, rubric_json, use_cache, retry_budget
+        ): i for i in range(total)}
         
+        render_error = None
         for i, f in enumerate(as_completed(futures)):
             try:
                 res = f.result()
                 results.append(res)
-                _update_status(status_box, start_t, i + 1, total, f"{t('status_grading_student', 'Grading')} {i+1}/{total}")
+                _update_status(status_box, start_t, i + 1, total, f"{t('status_grading_student', 'Grading')} {i+1}/{total} (x{int(limiter.limit)})")
+            except RenderError as e:
+                render_error = e
+                sched.shutdown(wait=False, cancel_futures=True)
+                break
             except Exception as e:
                 print(f"Error: {e}")
 
+    if render_error is not None:
+        _show_render_error(render_error)
+        return
+
+    ss["batch_stats"] = {"batch_id": bid, "llm_cache_hits": (llm_cache.hits - cache_hits_start) if llm_cache else 0,
+                         **_rate_stats(limiter, rate_start, retry_budget, get_breaker(user.google_api_key or ""))}
+
     if results:
         save_batch_results(user.id, bid, results)
         ss["grading_results"] = results
@@ -618,16 +793,35 @@ def _run_vertical_batch(user, chunks, mode, ratio, temp, subject, rubric_json):
     else:
         st.error(t("err_grading_failed"))
 
-def _process_single_student_vert(user, idx, ck, rubric, bid, mode, ratio, temp, allowed_labels, lang, subject, rubric_json):
-    imgs = pdf_to_images(ck)
-    rid, rname, cost_ocr = _identify_student_info(user, imgs[0], ratio)
+def _prepare_student_vert(idx, source, ratio):
+    """Worker thread: rasterize one student, cut the header crop, encode every page for upload (arrays dropped here)."""
+    pages = [PageImage(arr, "RGB") for arr in source.student_pages(idx)]
+    header_png = None
+    try:
+        if pages: header_png = _student_header_png(pages[0], ratio)
+    except Exception as e:
+        print(f"[Dashboard] Identity OCR Error: {e}")
+    policy = get_upload_policy()
+    payloads = []
+    for page in pages:
+        data, mime = policy.encode(page)
+        payloads.append(EncodedImage(data, mime, page.width, page.height))
+    return header_png, payloads
+
+async def _aprocess_single_student_vert(user, idx, source, rubric, bid, mode, ratio, temp, allowed_labels, lang, subject, rubric_json, use_cache=True, retry_budget=None):
+    header_png, payloads = await asyncio.to_thread(_prepare_student_vert, idx, source, ratio)
+    rid, rname, cost_ocr = await _aidentify_student_info(user, header_png, use_cache=use_cache, retry_budget=retry_budget)
     
-    res = GradingService.grade_submission(
-        images=imgs, rubric_text=rubric, user=user, batch_id=bid, student_idx=idx+1, 
+    res = await GradingService.agrade_submission(
+        images=payloads, rubric_text=rubric, user=user, batch_id=bid, student_idx=idx+1, 
         mode=mode, subject=subject, ai_memory="", temperature=temp, 
-        allowed_labels=allowed_labels, language=lang
+        allowed_labels=allowed_labels, language=lang, use_cache=use_cache, retry_budget=retry_budget
     )
-    
+    sid = rid if rid else f"S{idx+1:03d}"
+    file_path = await asyncio.to_thread(lambda: _save_student_pdf(bid, sid, source.student_pdf_bytes(idx)))
+    return _finalize_student_vert(res, rubric_json, sid, rname, cost_ocr, file_path, len(payloads))
+
+def _finalize_student_vert(res, rubric_json, sid, rname, cost_ocr, file_path, page_count):
     recalc_total = 0.0
     if "questions" in res and rubric_json:
         for q in res["questions"]:
@@ -647,18 +841,16 @@ def _process_single_student_vert(user, idx, ck, rubric, bid, mode, ratio, temp,
     score = _safe_float(res.get("total_score") if res.get("total_score") is not None else res.get("score"), 0.0)
     cost_grading = _safe_float(res.get("cost_usd"), 0.0)
     total_cost = cost_ocr + cost_grading
-    sid = rid if rid else f"S{idx+1:03d}"
-    file_path = _save_student_pdf(bid, sid, ck)
     res["rubric"] = rubric_json 
     res.update({
         "Student ID": sid, "Name": rname or "Unknown", 
         "total_score": score, "cost_usd": total_cost, 
         "cost_breakdown": {"flash_ocr": cost_ocr, "pro_grading": cost_grading},
-        "file_path": file_path, "page_count": len(imgs)
+        "file_path": file_path, "page_count": page_count
     })
     return res
 
-def _run_collage_batch(user, chunks, rubric_text, rubric_json, ratio, temp, mode, subject, ignore_first=False):
+def _run_collage_batch(user, source, rubric_text, rubric_json, ratio, temp, mode, subject, ignore_first=False, layout_key=None, use_cache=True):
     ss = st.session_state
     inject_progress_css()
     
@@ -667,31 +859,26 @@ def _run_collage_batch(user, chunks, rubric_text, rubric_json, ratio, temp, mode
     bid = _generate_meaningful_batch_id(user)
     ss["current_batch_id"] = bid
     current_lang = ss.get("language", "繁體中文")
-    workers = _get_max_workers(user)
+    limiter = get_rate_limiter().get(user.google_api_key or "")
+    rate_start = limiter.stats()
+    retry_budget = new_retry_budget()
     
-    total_chunks = len(chunks)
+    total_chunks = len(source)
     student_map = []
-    
-    _update_status(status_box, start_t, 0, total_chunks * 3, t("status_phase_1", "Phase 1"))
-    for i, ck in enumerate(chunks):
-        imgs = pdf_to_images(ck)
-        sid, name, cost = _identify_student_info(user, imgs[0], ratio)
-        display_sid = sid if sid else f"S{i+1:03d}"
-        f_path = _save_student_pdf(bid, display_sid, ck)
-        cv_imgs = [cv2.cvtColor(np.array(img), cv2.COLOR_RGB2BGR) for img in imgs]
-        student_map.append({
-            "idx": i, "sid": display_sid, "name": name, "cv_imgs": cv_imgs,
-            "cost_ocr": cost, "file_path": f_path, "page_count": len(imgs)
-        })
-        _update_status(status_box, start_t, i+1, total_chunks * 3, f"{t('status_scanning', 'Scan')}: {display_sid}")
-
-    _update_status(status_box, start_t, total_chunks, total_chunks * 3, t("status_phase_2", "Phase 2"))
+    # [Perf] (student, page) -> warped page + homography, shared by Phase 1~3
+    page_cache = AlignedPageCache()
     q_labels = _map_rubric_to_labels(rubric_json)
+    expected_count = len(q_labels)
+    question_batches = {lbl: [] for lbl in q_labels}
+    # [Perf] 重複進紙的頁面只標記 (services/dedupe_service.py)；結果放進 ss["batch_stats"]
+    page_dedupe = page_index()
+    duplicate_pages = []
+    llm_cache = get_llm_cache()
+    cache_hits_start = llm_cache.hits if llm_cache else 0
     
     if ss.get("layout_map") and isinstance(ss["layout_map"], list):
         template_meta = []
         box_ptr = 0
-        expected_count = len(q_labels)
         for page_data in ss["layout_map"]:
             p_idx = page_data["page"]; boxes = page_data["boxes"]
             for b in boxes:
@@ -700,50 +887,142 @@ def _run_collage_batch(user, chunks, rubric_text, rubric_json, ratio, temp, mode
                  box_ptr += 1
     else:
         template_meta = None
-        expected_count = len(q_labels)
-        scan_limit = 20; checked_count = 0
-        for s in student_map:
-            if checked_count >= scan_limit: break
-            checked_count += 1
-            if len(s["cv_imgs"]) < 1: continue
-            detected_meta = []
-            total_boxes = 0
-            for p_idx, img in enumerate(s["cv_imgs"]):
-                aligned = VisionService.align_document(img)
-                boxes, _ = VisionService.detect_answer_areas(aligned, is_first_page=(p_idx==0), manual_p1_ratio=ratio)
-                if ignore_first and (p_idx == 0) and boxes: boxes.pop(0)
-                for b in boxes: detected_meta.append({"page": p_idx, "box": b})
-                total_boxes += len(boxes)
-            if total_boxes == expected_count:
-                final_meta = []
-                for idx, item in enumerate(detected_meta):
-                    lbl = q_labels[idx] if idx < expected_count else f"Extra_{idx}"
-                    item["label"] = lbl
-                    final_meta.append(item)
-                template_meta = final_meta
-                break
-        if template_meta is None:
-            s = student_map[0]; detected_meta = []; box_ptr = 0
-            for p_idx, img in enumerate(s["cv_imgs"]):
-                aligned = VisionService.align_document(img)
-                boxes, _ = VisionService.detect_answer_areas(aligned, is_first_page=(p_idx==0), manual_p1_ratio=ratio)
-                if ignore_first and (p_idx == 0) and boxes: boxes.pop(0)
-                for b in boxes:
-                    lbl = q_labels[box_ptr] if box_ptr < expected_count else f"Extra_{box_ptr}"
-                    detected_meta.append({"page": p_idx, "box": b, "label": lbl})
-                    box_ptr += 1
-            template_meta = detected_meta
-    
-    question_batches = {lbl: [] for lbl in q_labels}
-    for stu in student_map:
+    discover_template = template_meta is None
+
+    # Template discovery: 最多檢查前 20 位學生；在 template 確定前，這些學生的對齊頁面需暫留記憶體
+    scan_limit = 20
+    pending_students = []
+    fallback_meta = None
+
+    def _detect_template(stu):
+        detected_meta = []
+        for p_idx in range(stu["page_count"]):
+            page = page_cache.get((stu["idx"], p_idx))
+            if page.layout is not None: boxes = list(page.layout[0])  # vision pool 已先算好
+            else: boxes, _ = VisionService.detect_answer_areas(page.image, is_first_page=(p_idx==0), manual_p1_ratio=ratio, analysis=page.analysis)
+            if ignore_first and (p_idx == 0) and boxes: boxes.pop(0)
+            for b in boxes:
+                box_ptr = len(detected_meta)
+                lbl = q_labels[box_ptr] if box_ptr < expected_count else f"Extra_{box_ptr}"
+                detected_meta.append({"page": p_idx, "box": b, "label": lbl})
+        return detected_meta
+
+    def _manifest_template(stu):
+        # 每一頁都要能由 QR 對上 manifest，否則交給輪廓偵測
+        manifest_meta = []
+        for p_idx in range(stu["page_count"]):
+            page = page_cache.get((stu["idx"], p_idx))
+            entries = lookup_page_boxes(page.analysis.qr_content)
+            if entries is None: return None
+            for e in entries:
+                manifest_meta.append({"page": p_idx, "box": e["box"], "label": e["label"], "frame": "aligned"})
+        if not manifest_meta: return None
+        # Rubric 題號與試卷標籤不一致時，沿用「依順序對應」
+        if sorted(m["label"] for m in manifest_meta) != sorted(q_labels):
+            for box_ptr, m in enumerate(manifest_meta):
+                m["label"] = q_labels[box_ptr] if box_ptr < expected_count else f"Extra_{box_ptr}"
+        return manifest_meta
+
+    async def _aregister_student(stu_idx, header_png):
+        # 身分辨識 (Gemini) + 歸檔 PDF；與 Phase 1 的對齊 / 切圖同時進行
+        sid, name, cost = await _aidentify_student_info(user, header_png, use_cache=use_cache, retry_budget=retry_budget)
+        display_sid = sid if sid else f"S{stu_idx+1:03d}"
+        f_path = await asyncio.to_thread(lambda: _save_student_pdf(bid, display_sid, source.student_pdf_bytes(stu_idx)))
+        return display_sid, name, cost, f_path
+
+    def _cut_and_release(stu):
+        # Stage 3: 切出答案區 (copy 以免 view 綁住整頁)，接著立即釋放該生的頁面
+        # crop 先以學生 idx 標記，身分辨識結果收齊後才換成 sid
         for meta in template_meta:
             lbl = meta["label"]
             if lbl not in question_batches: continue
-            if meta["page"] < len(stu["cv_imgs"]):
-                raw_img = stu["cv_imgs"][meta["page"]]
-                aligned = VisionService.align_document(raw_img)
-                crops = VisionService.crop_images_by_layout(aligned, [meta["box"]])
-                if crops: question_batches[lbl].append({"sid": stu["sid"], "img": crops[0]})
+            page = page_cache.get((stu["idx"], meta["page"]))
+            if page is not None:
+                box = meta["box"]
+                if meta.get("frame") == "aligned": box = to_page_frame(box, page.image.shape, page.analysis.is_aligned)
+                crops = VisionService.crop_images_by_layout(page.image, [box])
+                if crops: question_batches[lbl].append({"idx": stu["idx"], "img": crops[0].copy()})
+        for p_idx in range(stu["page_count"]): page_cache.drop((stu["idx"], p_idx))
+
+    max_in_flight = getattr(config, "COLLAGE_MAX_PAGES_IN_FLIGHT", 0) or max(8, 2 * (os.cpu_count() or 4))
+
+    # [Perf] 對齊 (+ template 掃描期間的答案框偵測) 交給多程序 vision pool；不可用時在本執行緒處理
+    vision_pool = get_vision_pool()
+    students = source.iter_students(max_pages_in_flight=max_in_flight)
+    if vision_pool is not None:
+        def _layout_request(stu_idx, p_idx):
+            if template_meta is not None or stu_idx >= scan_limit: return None
+            return {"is_first_page": p_idx == 0, "manual_p1_ratio": ratio}
+        students = vision_pool.align_students(students, max_pages_in_flight=max_in_flight, layout_fn=_layout_request)
+
+    _update_status(status_box, start_t, 0, total_chunks * 3, t("status_phase_1", "Phase 1"))
+    # Stage 1 (背景 rasterize) -> Stage 2 (對齊；身分辨識送進 asyncio 引擎，不在此執行緒等待) -> Stage 3 (切圖入列)
+    try:
+        with AsyncScheduler(get_max_in_flight()) as id_sched:
+            for i, imgs in students:
+                for p_idx, img in enumerate(imgs):
+                    if vision_pool is not None: page_cache.put((i, p_idx), img)
+                    else: page_cache.get((i, p_idx), PageImage(img, "RGB").bgr())
+                page_count = len(imgs)
+                imgs = None
+                header_png = None
+                if page_count and user.google_api_key:
+                    try: header_png = _student_header_png(None, ratio, aligned_page=page_cache.get((i, 0)))
+                    except Exception as e: print(f"[Dashboard] Identity OCR Error: {e}")
+                stu = {
+                    "idx": i, "sid": None, "name": None, "cost_ocr": 0.0, "file_path": None, "page_count": page_count,
+                    "identity": id_sched.submit(_aregister_student, i, header_png)
+                }
+                student_map.append(stu)
+                for p_idx in range(page_count):
+                    dup = page_dedupe.match((i, p_idx + 1), page_cache.get((i, p_idx)).image)
+                    if dup is not None: duplicate_pages.append(((i, p_idx + 1), dup))
+
+                if template_meta is None:
+                    pending_students.append(stu)
+                    if page_count >= 1 and len(pending_students) <= scan_limit:
+                        manifest_meta = _manifest_template(stu)
+                        if manifest_meta:
+                            template_meta = manifest_meta
+                        else:
+                            detected_meta = _detect_template(stu)
+                            if fallback_meta is None: fallback_meta = detected_meta
+                            if len(detected_meta) == expected_count: template_meta = detected_meta
+                    if template_meta is None and len(pending_students) >= scan_limit:
+                        template_meta = fallback_meta or []
+                    if template_meta is not None:
+                        for p_stu in pending_students: _cut_and_release(p_stu)
+                        pending_students = []
+                else:
+                    _cut_and_release(stu)
+                _update_status(status_box, start_t, (i+1) * 1.5, total_chunks * 3, f"{t('status_scanning', 'Scan')}: {i+1}/{total_chunks}")
+
+            if pending_students:
+                if template_meta is None: template_meta = fallback_meta or []
+                for p_stu in pending_students: _cut_and_release(p_stu)
+                pending_students = []
+            page_cache.clear()
+    except RenderError as e:
+        # 轉圖失敗：已送出的身分辨識在離開 with 時取消，不存任何結果
+        page_cache.clear()
+        _show_render_error(e)
+        return
+
+    # 身分辨識結果收齊 (離開 with 時已全部完成)，再把 idx 換成 sid
+    for stu in student_map:
+        stu["sid"], stu["name"], stu["cost_ocr"], stu["file_path"] = stu.pop("identity").result()
+    sid_of = {stu["idx"]: stu["sid"] for stu in student_map}
+    for items in question_batches.values():
+        for item in items: item["sid"] = sid_of[item.pop("idx")]
+    duplicate_pages = [
+        {"sid": sid_of[i], "page": page_no, "dup_sid": sid_of[dup_i], "dup_page": dup_page}
+        for (i, page_no), (dup_i, dup_page) in duplicate_pages
+    ]
+    for d in duplicate_pages: logger.warning(f"Duplicate page: {d['sid']} p{d['page']} == {d['dup_sid']} p{d['dup_page']}")
+
+    # 本批自動偵測到的版面存入 registry，下一批同一份考卷 / Rubric 直接沿用 (manifest 版面本來就在 DB，不重存)
+    if discover_template and layout_key and template_meta and not any(m.get("frame") == "aligned" for m in template_meta):
+        save_layout_template(user.id, layout_key, {"pages": _template_meta_to_layout(template_meta)})
 
     final_grades = {
         s["sid"]: {
@@ -754,56 +1033,90 @@ def _run_collage_batch(user, chunks, rubric_text, rubric_json, ratio, temp, mode
         } for s in student_map
     }
         
-    BATCH_SIZE = 4; GRID_COLS = 2
-    processor = AtomicBatchProcessor(batch_size=BATCH_SIZE, grid_cols=GRID_COLS)
-    total_grids = sum([int(np.ceil(len(v)/BATCH_SIZE)) for v in question_batches.values()])
+    # [Perf] 空白作答區 (整題所有 crop 一次判斷，扣除共同的印刷內容) 在排版前移除，直接 0 分
+    crops_total = sum(len(items) for items in question_batches.values())
+    blank_crops, unwritten_sids = {}, {}
+    for q_id, items in question_batches.items():
+        if not items: continue
+        is_blank, unwritten = VisionService.answer_crop_masks([item["img"] for item in items])
+        blank_crops[q_id] = [item["sid"] for item, blank in zip(items, is_blank) if blank]
+        unwritten_sids[q_id] = {item["sid"] for item, u, blank in zip(items, unwritten, is_blank) if u and not blank}
+        question_batches[q_id] = [item for item, blank in zip(items, is_blank) if not blank]
+
+    # [Perf] 同一題中近乎相同的作答區只批改一次，結果最後複製給其他學生
+    # [Safety] 只限扣除題目模板後沒有筆跡的作答區 (只有印刷內容)；手寫的近似重複 (重複進紙 / 抄襲)
+    # 照常批改並標記供複核，不會把 A 的分數複製給 B
+    duplicate_crops, similar_crops = {}, {}
+    for q_id, items in question_batches.items():
+        crop_index = DedupeIndex()
+        unwritten = unwritten_sids.get(q_id, set())
+        unique_items = []
+        for item in items:
+            rep_sid = crop_index.match(item["sid"], item["img"])
+            if rep_sid is not None and item["sid"] in unwritten and rep_sid in unwritten:
+                duplicate_crops.setdefault(q_id, []).append((item["sid"], rep_sid))
+                continue
+            if rep_sid is not None: similar_crops.setdefault(q_id, []).append((item["sid"], rep_sid))
+            unique_items.append(item)
+        question_batches[q_id] = unique_items
+
+    # [Perf] 每題依作答區長寬比與 token 預算決定格線 / 格子大小 / 每張人數
+    processor = AtomicBatchProcessor()
+    grid_plans = {q_id: processor.plan_grid(items) for q_id, items in question_batches.items() if items}
+    total_grids = sum(int(np.ceil(len(question_batches[q_id]) / plan["batch_size"])) for q_id, plan in grid_plans.items())
+    grids_saved = sum(
+        int(np.ceil((len(question_batches[q_id]) + len(duplicate_crops.get(q_id, [])) + len(blank_crops.get(q_id, [])))
+                    / plan["batch_size"]))
+        for q_id, plan in grid_plans.items()
+    ) - total_grids
     grids_completed = 0
-    safe_workers = min(4, workers)
-    _update_status(status_box, start_t, total_chunks * 1.5, total_chunks * 3, f"{t('status_phase_3', 'Phase 3')} (Workers: {safe_workers})...")
+    # [Perf] 所有格線請求交給 asyncio 引擎，結果依送出順序彙整；實際並行度由 rate_limiter 的 AIMD 視窗決定
+    _update_status(status_box, start_t, total_chunks * 1.5, total_chunks * 3, f"{t('status_phase_3', 'Phase 3')} (x{int(limiter.limit)})...")
     
-    with ThreadPoolExecutor(max_workers=safe_workers) as ex:
+    with AsyncScheduler(get_max_in_flight()) as ex:
         futures = []
         for q_id, items in question_batches.items():
             if not items: continue
-            atomic_batches = processor.create_batches(items)
+            atomic_batches = processor.create_batches(items, grid_plans[q_id])
             for ab in atomic_batches:
                 ungraded_queue = set()
                 index_to_crop_map = {}
                 for c in ab['manifest']['cells']:
                     idx = c['index']
-                    if idx < len(items):
-                        item = items[idx]
-                        if not c['is_empty'] and not c.get('is_blank_paper', False):
+                    if c.get('item_index') is not None:
+                        item = items[c['item_index']]
+                        if not c['is_empty']:
                             ungraded_queue.add(idx)
                             index_to_crop_map[str(idx)] = item['img']
                 if not ungraded_queue: continue
 
                 valid_indices_list = list(ungraded_queue)
-                grid_pil = Image.fromarray(cv2.cvtColor(ab['image'], cv2.COLOR_BGR2RGB))
                 
                 f = ex.submit(
-                    GradingService.grade_collage_submission,
-                    grid_pil, q_id, rubric_text, user, mode,
+                    GradingService.agrade_collage,
+                    ab['payload'], q_id, rubric_text, user, mode,
                     subject, temp, "gemini-2.5-pro",
                     allowed_labels=q_labels,
                     valid_indices=valid_indices_list,
-                    language=current_lang
+                    language=current_lang,
+                    grid_shape=tuple(ab['manifest']['grid']),
+                    use_cache=use_cache, retry_budget=retry_budget
                 )
                 futures.append({
                     "future": f, "q_id": q_id, "manifest": ab['manifest'],
                     "index_to_crop_map": index_to_crop_map, "ungraded_queue": ungraded_queue
                 })
         
+        # [Fix] 服務端失敗 (5xx / 429 / 斷路器) 已在 services/retry_policy.py 退避重試過，整格標記失敗、不再逐格補救；
+        # 只有模型漏批 / 回應無法解析的作答區改送單張高解析度請求，與格線請求一樣並行送出
+        rescues = []
         for task in futures:
             try:
-                f = task["future"]; q_id = task["q_id"]; manifest = task["manifest"]
-                index_to_crop_map = task["index_to_crop_map"]; ungraded_queue = task["ungraded_queue"]
-                
-                ai_results = []; cost = 0.0
-                if f:
-                    res_data = f.result()
-                    ai_results = res_data.get("results", [])
-                    cost = res_data.get("cost_usd", 0)
+                q_id = task["q_id"]; index_to_crop_map = task["index_to_crop_map"]; ungraded_queue = task["ungraded_queue"]
+                res_data = task["future"].result()
+                ai_results = res_data.get("results", [])
+                task["cost"] = res_data.get("cost_usd", 0)
+                task["error"] = res_data.get("error") if res_data.get("error_kind") in SERVICE_FAILURES else None
                 
                 result_lookup = {str(r.get("index", "")).strip(): r for r in ai_results}
                 
@@ -816,35 +1129,46 @@ def _run_collage_batch(user, chunks, rubric_text, rubric_json, ratio, temp, mode
                             if is_qualified: ungraded_queue.remove(idx_int)
                             else: del result_lookup[idx_str]
                     except Exception as e: print(f"Queue Update Error: {e}")
-
-                MAX_RETRIES = 3; retry_count = 0
-                while ungraded_queue and retry_count < MAX_RETRIES:
-                    for target_idx in list(ungraded_queue):
-                        target_key = str(target_idx)
-                        rescue_img_cv = index_to_crop_map.get(target_key)
-                        if rescue_img_cv is not None:
-                            try:
-                                rescue_pil = Image.fromarray(cv2.cvtColor(rescue_img_cv, cv2.COLOR_BGR2RGB))
-                                rescue_res = GradingService.grade_submission(
-                                    images=[rescue_pil], rubric_text=rubric_text, user=user, batch_id="rescue_queue", 
-                                    student_idx=0, mode=mode, subject=subject, ai_memory="", temperature=temp,
-                                    allowed_labels=[q_id], language=current_lang
-                                )
-                                if "questions" in rescue_res and len(rescue_res["questions"]) > 0:
-                                    q_res = rescue_res["questions"][0]
-                                    new_result = {
-                                        "index": target_idx, "score": q_res.get("score", 0),
-                                        "reasoning": q_res.get("reasoning", "") + f" [High-Res Rescue]",
-                                        "breakdown": q_res.get("rubric_breakdown", []) or q_res.get("breakdown", [])
-                                    }
-                                    result_lookup[target_key] = new_result
-                                    cost += rescue_res.get("cost_usd", 0.0)
-                                    ungraded_queue.remove(target_idx)
-                            except Exception as e: print(f"Queue Rescue Error: {e}")
-                    retry_count += 1
+                task["result_lookup"] = result_lookup
+
+                if task["error"] is None:
+                    for target_idx in ungraded_queue:
+                        rescue_img_cv = index_to_crop_map.get(str(target_idx))
+                        if rescue_img_cv is None: continue
+                        rescues.append((task, target_idx, ex.submit(
+                            GradingService.agrade_submission,
+                            images=[PageImage(VisionService.trim_to_ink(rescue_img_cv), "BGR")], rubric_text=rubric_text, user=user, batch_id="rescue_queue",
+                            student_idx=0, mode=mode, subject=subject, ai_memory="", temperature=temp,
+                            allowed_labels=[q_id], language=current_lang, use_cache=use_cache, retry_budget=retry_budget
+                        )))
                 
-                valid_students = [c for c in manifest['cells'] if not c['is_empty'] and not c.get('is_blank_paper')]
-                unit_cost = cost / max(1, len(valid_students))
+                grids_completed += 1
+                current_prog = (total_chunks * 1.5) + (grids_completed / max(1, total_grids) * (total_chunks * 1.5))
+                _update_status(status_box, start_t, current_prog, total_chunks * 3, f"Grading {q_id} (Grid {grids_completed}/{total_grids}, x{int(limiter.limit)})")
+            
+            except Exception as e: print(f"Atomic Batch Error: {e}")
+            task["index_to_crop_map"] = None 
+            del task["index_to_crop_map"]
+
+        for task, target_idx, f in rescues:
+            try:
+                rescue_res = f.result()
+                if "questions" in rescue_res and len(rescue_res["questions"]) > 0:
+                    q_res = rescue_res["questions"][0]
+                    task["result_lookup"][str(target_idx)] = {
+                        "index": target_idx, "score": q_res.get("score", 0),
+                        "reasoning": q_res.get("reasoning", "") + f" [High-Res Rescue]",
+                        "breakdown": q_res.get("rubric_breakdown", []) or q_res.get("breakdown", [])
+                    }
+                    task["cost"] += rescue_res.get("cost_usd", 0.0)
+            except Exception as e: print(f"Queue Rescue Error: {e}")
+
+        for task in futures:
+            if "result_lookup" not in task: continue
+            try:
+                q_id = task["q_id"]; manifest = task["manifest"]; result_lookup = task["result_lookup"]
+                valid_students = [c for c in manifest['cells'] if not c['is_empty']]
+                unit_cost = task["cost"] / max(1, len(valid_students))
                 max_val = _find_max_score_in_rubric_json(rubric_json, q_id)
 
                 for i, cell in enumerate(manifest['cells']):
@@ -852,18 +1176,17 @@ def _run_collage_batch(user, chunks, rubric_text, rubric_json, ratio, temp, mode
                     sid = cell['sid']; target_key = str(cell['index']).strip()
                     score = 0.0; reasoning = ""; breakdown = []
                     
-                    if cell.get("is_blank_paper"):
-                        score = 0.0; reasoning = "⚠️ BLANK SUBMISSION (Detected)."; breakdown = [{"criterion": "Submission", "points": 0, "score": 0}]
-                    else:
-                        item_result = result_lookup.get(target_key)
-                        if item_result:
-                            try: score = float(item_result.get("score", 0))
-                            except: pass
-                            reasoning = item_result.get("reasoning", ""); breakdown = item_result.get("breakdown", [])
-                            if not breakdown and score > 0: breakdown = [{"criterion": "Score", "points": score, "score": score}]
-                        else: reasoning = f"⚠️ MISSING DATA: AI failed to grade Index {target_key} after retries."
+                    item_result = result_lookup.get(target_key)
+                    if item_result:
+                        try: score = float(item_result.get("score", 0))
+                        except: pass
+                        reasoning = item_result.get("reasoning", ""); breakdown = item_result.get("breakdown", [])
+                        if not breakdown and score > 0: breakdown = [{"criterion": "Score", "points": score, "score": score}]
+                    elif task["error"]: reasoning = f"⚠️ GRADING FAILED: Gemini unavailable after retries ({task['error'][:200]})."
+                    else: reasoning = f"⚠️ MISSING DATA: AI failed to grade Index {target_key} after retries."
 
                     q_data = {"id": q_id, "score": score, "reasoning": reasoning, "breakdown": breakdown}
+                    if task["error"] and not item_result: q_data["grading_error"] = True
                     if max_val is not None:
                         q_data["max_score"] = max_val
                         if score > max_val:
@@ -871,19 +1194,52 @@ def _run_collage_batch(user, chunks, rubric_text, rubric_json, ratio, temp, mode
                             q_data["reasoning"] += f" [Cap: {max_val}]"
 
                     if sid in final_grades:
-                        if not cell.get("is_blank_paper"):
-                            final_grades[sid]["cost_usd"] += unit_cost
-                            final_grades[sid]["cost_breakdown"]["pro_grading"] += unit_cost
+                        final_grades[sid]["cost_usd"] += unit_cost
+                        final_grades[sid]["cost_breakdown"]["pro_grading"] += unit_cost
                         final_grades[sid]["questions"].append(q_data)
                         final_grades[sid]["total_score"] += score
-                
-                grids_completed += 1
-                current_prog = (total_chunks * 1.5) + (grids_completed / max(1, total_grids) * (total_chunks * 1.5))
-                _update_status(status_box, start_t, current_prog, total_chunks * 3, f"Grading {q_id} (Grid {grids_completed}/{total_grids})")
-            
             except Exception as e: print(f"Atomic Batch Error: {e}")
-            task["index_to_crop_map"] = None 
-            del task["index_to_crop_map"]
+
+    # 空白作答區：0 分，不計批改費用
+    for q_id, sids in blank_crops.items():
+        max_val = _find_max_score_in_rubric_json(rubric_json, q_id)
+        for sid in sids:
+            if sid not in final_grades: continue
+            q_data = {"id": q_id, "score": 0.0, "reasoning": "⚠️ BLANK SUBMISSION (Detected).",
+                      "breakdown": [{"criterion": "Submission", "points": 0, "score": 0}]}
+            if max_val is not None: q_data["max_score"] = max_val
+            final_grades[sid]["questions"].append(q_data)
+
+    # 重複作答區：沿用代表學生的批改結果
+    for q_id, pairs in duplicate_crops.items():
+        for sid, rep_sid in pairs:
+            rep_q = next((q for q in final_grades.get(rep_sid, {}).get("questions", []) if q["id"] == q_id), None)
+            if rep_q is None or sid not in final_grades: continue
+            q_data = json.loads(json.dumps(rep_q))
+            q_data["reasoning"] = f"{q_data.get('reasoning', '')} [Identical to {rep_sid}]"
+            q_data["duplicate_of"] = rep_sid
+            final_grades[sid]["questions"].append(q_data)
+            final_grades[sid]["total_score"] += q_data.get("score", 0)
+
+    # 手寫近似重複：各自批改，只加註複核提示
+    similar_answers = []
+    for q_id, pairs in similar_crops.items():
+        for sid, rep_sid in pairs:
+            q_data = next((q for q in final_grades.get(sid, {}).get("questions", []) if q["id"] == q_id), None)
+            if q_data is not None:
+                q_data["reasoning"] = f"{q_data.get('reasoning', '')} [⚠️ Near-identical to {rep_sid}, please review]"
+                q_data["similar_to"] = rep_sid
+            similar_answers.append({"sid": sid, "q_id": q_id, "dup_sid": rep_sid})
+            logger.warning(f"Near-identical handwritten answer: {sid} Q{q_id} ~ {rep_sid}")
+
+    ss["batch_stats"] = {
+        "batch_id": bid, "crops_total": crops_total,
+        "crops_blank": sum(len(sids) for sids in blank_crops.values()),
+        "crops_deduped": sum(len(pairs) for pairs in duplicate_crops.values()),
+        "grading_calls_saved": grids_saved, "duplicate_pages": duplicate_pages, "similar_answers": similar_answers,
+        "llm_cache_hits": (llm_cache.hits - cache_hits_start) if llm_cache else 0,
+        **_rate_stats(limiter, rate_start, retry_budget, get_breaker(user.google_api_key or ""))
+    }
 
     results_list = list(final_grades.values())
     if results_list:
@@ -908,6 +1264,15 @@ def render_step_3_report(user):
     q_stats_df = analyze_questions_performance(res, rubric_json)
     
     st.success(f"✅ {t('batch_complete')}")
+    stats = ss.get("batch_stats")
+    if stats and stats.get("batch_id") == bid:
+        if stats.get("crops_blank"): st.caption(t("blank_summary").format(**stats))
+        if stats.get("crops_deduped"): st.caption(t("dedupe_summary").format(**stats))
+        if stats.get("llm_cache_hits"): st.caption(t("llm_cache_summary").format(**stats))
+        if "concurrency" in stats: st.caption(t("rate_limit_summary").format(**stats))
+        if stats.get("retries") or stats.get("retries_denied") or stats.get("circuit_opened"): st.caption(t("retry_summary").format(**stats))
+        for d in stats.get("duplicate_pages", []): st.warning(t("duplicate_page_warning").format(**d))
+        for d in stats.get("similar_answers", []): st.warning(t("similar_answer_warning").format(**d))
     st.dataframe(df)
 
     st.subheader(f"📊 {t('statistics_overview')}")
@@ -980,7 +1345,8 @@ def render_step_3_report(user):
     st.download_button(t("btn_download_zip", "Download ZIP"), zip_buf, f"{bid}.zip", "application/zip", type="primary", width="stretch")
     
     if st.button(f"🔄 {t('btn_new_session', 'New Session')}", width="stretch"):
-        for k in ["grading_results", "exam_chunks", "class_analysis", "layout_map", "rubric_editor_fixed", "rubric_json", "main_rubric_text_area"]: ss.pop(k, None)
+        if ss.get("exam_source") is not None: ss["exam_source"].close()
+        for k in ["grading_results", "exam_source", "class_analysis", "layout_map", "layout_previews", "layout_key_loaded", "layout_from_registry", "rubric_editor_fixed", "rubric_json", "main_rubric_text_area"]: ss.pop(k, None)
         pdf_cache_key = f"pdf_cache_{bid}"
         if pdf_cache_key in ss: del ss[pdf_cache_key]
         ss["current_step"] = 1; st.rerun()
@@ -110,7 +110,7 @@ def render_exam_generator(user):
     
     defaults = {
         'e_title': "", 'e_sub': "", 'e_subject': "", 'e_dept': "", 'e_note': "",
-        'e_category': "General", 'e_compact': False, 'e_layout': "combined",
+        'e_category': "General", 'e_compact': False, 'e_layout': "combined", 'e_aruco': False,
         'e_ay': str(datetime.now().year - 1911), 'e_sem': "上學期", 'e_type': "期中考"
     }
     for k, v in defaults.items():
@@ -197,6 +197,7 @@ def render_exam_generator(user):
                 st.session_state.e_category = header.get('category', "General")
                 st.session_state.e_compact = header.get('is_compact', False)
                 st.session_state.e_layout = header.get('layout_mode', "combined")
+                st.session_state.e_aruco = header.get('use_aruco', False)
                 st.session_state.e_ay = found.get('academic_year') or "114"
                 st.session_state.e_sem = found.get('semester') or "上學期"
                 st.session_state.e_type = found.get('exam_type') or "期中考"
@@ -221,6 +222,7 @@ def render_exam_generator(user):
         with c_compact:
             st.write(""); st.write("")
             st.checkbox(t('lbl_compact_header', 'Compact Header'), key="e_compact", help=t('help_compact', '縮減高度'))
+            st.checkbox(t('lbl_aruco_markers', 'ArUco 定位碼'), key="e_aruco", help=t('help_aruco', '四角印 ArUco 定位碼，掃描對齊更快更穩定'))
         st.write(f"📄 {t('lbl_layout_mode', '排版模式')}")
         st.radio(t('lbl_output_format', '格式：'), options=["combined", "separate"], 
             format_func=lambda x: t('opt_layout_combined', "標準合併") if x == "combined" else t('opt_layout_sep', "卷卡分離"),
@@ -238,7 +240,8 @@ def render_exam_generator(user):
                         "title": st.session_state.e_title, "subject": st.session_state.e_subject,
                         "subtitle": st.session_state.e_sub, "department": st.session_state.e_dept,
                         "note": st.session_state.e_note, "category": st.session_state.e_category,
-                        "is_compact": st.session_state.e_compact, "layout_mode": st.session_state.e_layout
+                        "is_compact": st.session_state.e_compact, "layout_mode": st.session_state.e_layout,
+                        "use_aruco": st.session_state.e_aruco
                     },
                     "questions_cache": st.session_state.exam_questions,
                     "question_count": len(st.session_state.exam_questions)
@@ -384,7 +387,8 @@ def render_exam_generator(user):
         "title": st.session_state.e_title, "subtitle": st.session_state.e_sub,
         "subject": st.session_state.e_subject, "dept": st.session_state.e_dept, 
         "note": st.session_state.e_note, "exam_time": st.session_state.get("e_time", ""),
-        "is_compact": st.session_state.e_compact, "layout_mode": st.session_state.get("e_layout", "combined")
+        "is_compact": st.session_state.e_compact, "layout_mode": st.session_state.get("e_layout", "combined"),
+        "use_aruco": st.session_state.get("e_aruco", False)
     }
     data_str = json.dumps({'h': exam_data, 'q': st.session_state.exam_questions}, sort_keys=True, default=str)
     current_hash = hashlib.md5(data_str.encode()).hexdigest()
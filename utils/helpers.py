@@ -4,12 +4,13 @@
 
 # utils/helpers.py
 # -*- coding: utf-8 -*-
-# Module-Version: 1.0.0 (Robust PDF Splitting)
+# Module-Version: 1.2.0 (Streaming Prefetch)
+# PDF 切割 / 轉圖已移至 utils/pdf_source.PdfPageSource
 
-import io
 import base64
+import queue
+import threading
 import streamlit as st
-from pypdf import PdfReader, PdfWriter
 
 def display_pdf(file_input, width=None, height=800):
     """
@@ -25,53 +26,52 @@ def display_pdf(file_input, width=None, height=800):
     pdf_display = f'<iframe src="data:application/pdf;base64,{base64_pdf}" width="100%" height="{height}" type="application/pdf"></iframe>'
     st.markdown(pdf_display, unsafe_allow_html=True)
 
-def split_pdf_by_pages(uploaded_file, pages_per_chunk: int):
+def iter_prefetched(count: int, render_fn, max_pages_in_flight: int = 16):
     """
-    將 PDF 切割為多個小檔案 (每個 chunk 代表一個學生)
+    串流轉檔：背景執行緒預先呼叫 render_fn(i)，依序 yield (idx, pages)。
+    同時存活的頁數上限為 max_pages_in_flight (+ 最多一筆)；
+    消費端要求下一筆時，上一筆的頁面即視為已釋放。
+    render_fn 拋出的例外會在消費端 (輪到該筆時) 重新拋出，之後不再產生。
     """
-    try:
-        # [CRITICAL FIX] 確保指標回到檔案開頭，防止讀取到空內容
-        if hasattr(uploaded_file, "seek"):
-            uploaded_file.seek(0)
-            
-        reader = PdfReader(uploaded_file)
-        total_pages = len(reader.pages)
-        chunks = []
-        
-        # 如果 PDF 總頁數小於設定的頁數，就當作一份
-        if total_pages <= pages_per_chunk:
-            # 重新讀取原始檔作為單一 chunk
-            if hasattr(uploaded_file, "seek"): uploaded_file.seek(0)
-            if hasattr(uploaded_file, "getvalue"): return [uploaded_file.getvalue()]
-            return [uploaded_file.read()]
+    cap = max(1, int(max_pages_in_flight))
+    ready = queue.Queue()
+    cond = threading.Condition()
+    state = {"in_flight": 0, "stop": False}
+    _DONE = object()
 
-        # 開始切割
-        for i in range(0, total_pages, pages_per_chunk):
-            writer = PdfWriter()
-            end_page = min(i + pages_per_chunk, total_pages)
-            
-            for page_num in range(i, end_page):
-                writer.add_page(reader.pages[page_num])
-            
-            output_stream = io.BytesIO()
-            writer.write(output_stream)
-            output_stream.seek(0) # 寫入後重置指標
-            chunks.append(output_stream.getvalue())
-            
-        return chunks
+    def _producer():
+        try:
+            for i in range(count):
+                with cond:
+                    while state["in_flight"] >= cap and not state["stop"]:
+                        cond.wait()
+                    if state["stop"]: return
+                try: pages = render_fn(i)
+                except Exception as e:
+                    ready.put(e)
+                    return
+                with cond:
+                    state["in_flight"] += len(pages)
+                ready.put((i, pages))
+        finally:
+            ready.put(_DONE)
 
-    except Exception as e:
-        st.error(f"PDF Split Error: {e}")
-        return []
+    threading.Thread(target=_producer, name="pdf-rasterizer", daemon=True).start()
 
-def pdf_to_images(pdf_bytes):
-    """
-    將 PDF (bytes) 轉換為 PIL Image 列表 (用於 Vision Service)
-    """
+    held = 0
     try:
-        from pdf2image import convert_from_bytes
-        return convert_from_bytes(pdf_bytes)
-    except Exception as e:
-        # Fallback if pdf2image/poppler is not installed
-        st.error(f"PDF to Image Error (Check poppler): {e}")
-        return []
+        while True:
+            item = ready.get()
+            with cond:
+                state["in_flight"] -= held
+                cond.notify_all()
+            held = 0
+            if item is _DONE: return
+            if isinstance(item, Exception): raise item
+            held = len(item[1])
+            yield item
+            item = None
+    finally:
+        with cond:
+            state["stop"] = True
+            cond.notify_all()
@@ -480,6 +480,16 @@ STRINGS = {
     "quota_exceeded_msg": "Quota exceeded",
     "no_results_yet": "No results",
     "batch_complete": "Batch Complete",
+    "blank_summary": "⬜ {crops_blank} of {crops_total} answer crops detected as blank (scored 0, not sent for grading)",
+    "dedupe_summary": "♻️ Identical unwritten answers (printed content only) graded once: {crops_deduped} of {crops_total} answer crops reused, {grading_calls_saved} grading call(s) saved",
+    "llm_cache_summary": "⚡ {llm_cache_hits} AI response(s) reused from the local cache (no new API cost; tick \"Force regrade\" to grade again)",
+    "rate_limit_summary": "🚦 Gemini concurrency settled at {concurrency} parallel request(s); {throttled} rate-limit response(s), {wait_s}s spent waiting for quota",
+    "retry_summary": "🔁 {retries} Gemini call(s) retried after transient / rate-limit errors; {retries_denied} failure(s) reported once the batch retry budget ran out; circuit breaker opened {circuit_opened} time(s)",
+    "err_pdf_render": "PDF to image conversion failed (is poppler installed?); grading stopped",
+    "lbl_force_regrade": "Force regrade (ignore cached AI responses)",
+    "help_force_regrade": "Re-run identical scans and rubric through the AI instead of reusing the stored answers",
+    "duplicate_page_warning": "⚠️ Possible duplicate scan: {sid} page {page} is identical to {dup_sid} page {dup_page}",
+    "similar_answer_warning": "⚠️ Near-identical handwritten answers: {sid} and {dup_sid} on {q_id} (each graded separately; please review)",
     "median_score": "Median",
     "pass_count": "Pass Count",
     "gen_class_analysis_btn": "Generate Report",
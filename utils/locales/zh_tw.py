@@ -491,6 +491,16 @@ STRINGS = {
     "quota_exceeded_msg": "已超出配額",
     "no_results_yet": "尚無結果",
     "batch_complete": "批次完成",
+    "blank_summary": "⬜ {crops_total} 個作答區中 {crops_blank} 個判定為空白 (0 分，未送批改)",
+    "dedupe_summary": "♻️ 相同的未作答區 (只有印刷內容) 只批改一次：{crops_total} 個作答區中 {crops_deduped} 個沿用結果，省下 {grading_calls_saved} 次批改呼叫",
+    "llm_cache_summary": "⚡ {llm_cache_hits} 筆 AI 回應取自本機快取 (無額外 API 費用；勾選「強制重新批改」可重批)",
+    "rate_limit_summary": "🚦 Gemini 並行度最後穩定在 {concurrency} 個請求；遇到 {throttled} 次限流回應，等待額度共 {wait_s} 秒",
+    "retry_summary": "🔁 因暫時性錯誤 / 限流重試 {retries} 次 Gemini 請求；批次重試額度用完後直接回報 {retries_denied} 次失敗；斷路器開啟 {circuit_opened} 次",
+    "err_pdf_render": "PDF 轉圖失敗 (請確認已安裝 poppler)，已停止批改",
+    "lbl_force_regrade": "強制重新批改 (不使用快取的 AI 回應)",
+    "help_force_regrade": "相同掃描與評分標準也重新送 AI 批改，不沿用已儲存的結果",
+    "duplicate_page_warning": "⚠️ 疑似重複掃描：{sid} 第 {page} 頁與 {dup_sid} 第 {dup_page} 頁相同",
+    "similar_answer_warning": "⚠️ 手寫作答幾乎相同：{sid} 與 {dup_sid} 的 {q_id} (已各自批改，請複核)",
     "median_score": "中位數",
     "pass_count": "及格人數",
     "gen_class_analysis_btn": "生成班級分析報告",
@@ -0,0 +1,141 @@
+# Copyright (c) 2026 [謝忠村/Chung Tsun Shieh]. All Rights Reserved.
+# This software is proprietary and confidential.
+# Unauthorized copying of this file, via any medium is strictly prohibited.
+
+# utils/page_image.py
+# -*- coding: utf-8 -*-
+# Module-Version: v2026.02.10-Page-Image
+# Description:
+# 1. [Perf] PageImage：頁面 / 裁切圖統一以「一個 uint8 陣列 + 宣告的通道順序 (RGB / BGR / GRAY)」傳遞，
+#    取代 PIL -> np.array -> cvtColor -> Image.fromarray -> PNG 的逐站複製。
+# 2. [Perf] 通道順序相符時一律回傳 view；需要轉換時只配置一次 (灰階結果快取)。
+# 3. [Perf] encode() 直接以 cv2.imencode 由陣列編碼 (BGR / GRAY 零轉換)，上傳 Gemini 不經 PIL。
+
+from typing import Optional, Sequence, Tuple, Union
+
+import cv2
+import numpy as np
+from PIL import Image
+
+CHANNEL_ORDERS = ("RGB", "BGR", "GRAY")
+
+_MIME_TYPES = {".png": "image/png", ".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".webp": "image/webp"}
+
+# cv2 預設 PNG 壓縮等級 (1) 比 PIL (6) 大將近一倍；預設與 PIL 相同，上傳大小不變且仍較快
+_DEFAULT_PARAMS = {".png": [cv2.IMWRITE_PNG_COMPRESSION, 6]}
+
+_CONVERT = {
+    ("RGB", "BGR"): cv2.COLOR_RGB2BGR, ("BGR", "RGB"): cv2.COLOR_BGR2RGB,
+    ("RGB", "GRAY"): cv2.COLOR_RGB2GRAY, ("BGR", "GRAY"): cv2.COLOR_BGR2GRAY,
+    ("GRAY", "RGB"): cv2.COLOR_GRAY2RGB, ("GRAY", "BGR"): cv2.COLOR_GRAY2BGR,
+}
+
+
+class PageImage:
+    """
+    One page (or crop) as a single uint8 array with a declared channel order.
+    Crops are views into the parent buffer; nothing is copied until a different
+    channel order or an encoded blob is actually requested.
+    """
+    __slots__ = ("array", "order", "_gray")
+
+    def __init__(self, array: np.ndarray, order: str = "BGR"):
+        order = order.upper()
+        if order not in CHANNEL_ORDERS: raise ValueError(f"Unknown channel order: {order}")
+        arr = np.asarray(array)
+        if arr.ndim == 3 and arr.shape[2] == 1: arr = arr[..., 0]
+        if arr.ndim == 3 and arr.shape[2] == 4:  # RGBA / BGRA -> 捨棄 alpha (view)
+            arr = arr[..., :3]
+        if arr.ndim == 2: order = "GRAY"
+        elif arr.ndim != 3 or arr.shape[2] != 3 or order == "GRAY":
+            raise ValueError(f"Unsupported page shape {arr.shape} for order {order}")
+        if arr.dtype != np.uint8: arr = np.clip(arr, 0, 255).astype(np.uint8)
+        self.array = arr
+        self.order = order
+        self._gray = arr if order == "GRAY" else None
+
+    # ------------------------------------------------------------------
+    # Construction
+    # ------------------------------------------------------------------
+    @classmethod
+    def from_pil(cls, img: Image.Image) -> "PageImage":
+        if img.mode in ("L", "1"): return cls(np.asarray(img.convert("L")), "GRAY")
+        if img.mode != "RGB": img = img.convert("RGB")
+        return cls(np.asarray(img), "RGB")
+
+    @classmethod
+    def wrap(cls, obj: Union["PageImage", Image.Image, np.ndarray], order: str = "BGR") -> "PageImage":
+        """PageImage -> itself; PIL -> from_pil; ndarray -> PageImage(obj, order)."""
+        if isinstance(obj, PageImage): return obj
+        if isinstance(obj, Image.Image): return cls.from_pil(obj)
+        return cls(obj, order)
+
+    # ------------------------------------------------------------------
+    # Views
+    # ------------------------------------------------------------------
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return self.array.shape
+
+    @property
+    def height(self) -> int:
+        return self.array.shape[0]
+
+    @property
+    def width(self) -> int:
+        return self.array.shape[1]
+
+    @property
+    def nbytes(self) -> int:
+        return self.array.nbytes
+
+    def as_order(self, order: str) -> np.ndarray:
+        """The pixels in `order`: the stored array itself when it already matches, otherwise one conversion."""
+        order = order.upper()
+        if order == self.order: return self.array
+        if order == "GRAY":
+            if self._gray is None: self._gray = cv2.cvtColor(self.array, _CONVERT[(self.order, "GRAY")])
+            return self._gray
+        return cv2.cvtColor(self.array, _CONVERT[(self.order, order)])
+
+    def rgb(self) -> np.ndarray:
+        return self.as_order("RGB")
+
+    def bgr(self) -> np.ndarray:
+        return self.as_order("BGR")
+
+    def gray(self) -> np.ndarray:
+        return self.as_order("GRAY")
+
+    def crop(self, x: int, y: int, w: int, h: int) -> "PageImage":
+        """Clipped (x, y, w, h) view; shares memory with this page."""
+        x0, y0 = max(0, int(x)), max(0, int(y))
+        x1, y1 = min(self.width, int(x + w)), min(self.height, int(y + h))
+        return PageImage(self.array[y0:max(y0, y1), x0:max(x0, x1)], self.order)
+
+    def copy(self) -> "PageImage":
+        """Detached copy (e.g. so a small crop does not keep the whole page alive)."""
+        return PageImage(self.array.copy(), self.order)
+
+    # ------------------------------------------------------------------
+    # Encoding / interop
+    # ------------------------------------------------------------------
+    @staticmethod
+    def mime_type(ext: str) -> str:
+        return _MIME_TYPES.get(ext.lower(), "application/octet-stream")
+
+    def encode(self, ext: str = ".png", params: Optional[Sequence[int]] = None, gray: bool = False) -> bytes:
+        """cv2.imencode straight from the buffer (OpenCV expects BGR / GRAY, so only RGB pages convert)."""
+        arr = self.gray() if gray or self.order == "GRAY" else self.bgr()
+        if params is None: params = _DEFAULT_PARAMS.get(ext.lower(), [])
+        ok, buf = cv2.imencode(ext, arr, list(params))
+        if not ok: raise ValueError(f"cv2.imencode failed for {ext} ({arr.shape})")
+        return buf.tobytes()
+
+    def to_pil(self) -> Image.Image:
+        """PIL copy for display widgets only (st.image / reportlab)."""
+        if self.order == "GRAY": return Image.fromarray(self.array, "L")
+        return Image.fromarray(np.ascontiguousarray(self.rgb()), "RGB")
+
+    def __repr__(self) -> str:
+        return f"PageImage({self.width}x{self.height}, {self.order})"
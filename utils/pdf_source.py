@@ -0,0 +1,169 @@
+# Copyright (c) 2026 [謝忠村/Chung Tsun Shieh]. All Rights Reserved.
+# This software is proprietary and confidential.
+# Unauthorized copying of this file, via any medium is strictly prohibited.
+
+# utils/pdf_source.py
+# -*- coding: utf-8 -*-
+# Module-Version: v2026.02.06-Page-Source
+# Description: 
+# 1. [Perf] 取代 split_pdf_by_pages：不再為每位學生產生 PDF bytes 再各自 rasterize。
+# 2. [Perf] 直接對原始上傳檔依頁碼範圍轉圖 (convert_from_path + first/last_page + thread_count)，
+#    一次 poppler 呼叫處理多位學生，結果逐頁寫入 RasterCache。
+# 3. [Logic] 學生 PDF 僅在需要時 (歸檔 / 預覽) 才以 PdfWriter 產生。
+# 4. [Perf] 快取淘汰每份上傳只做一次 (建立 PdfPageSource 時在背景執行緒)，不再於每次轉圖後掃描整個快取目錄；
+#    本份上傳的頁面不會被淘汰，快取最多暫時超出上限一份上傳的大小。
+# 5. [Safety] 轉圖失敗 (例如沒有安裝 poppler) 以 RenderError 往上拋，由批改流程顯示錯誤並中止，
+#    不再以「沒有頁面」繼續批改、存出整批 0 分。
+# 6. [Safety] 轉圖用的暫存 PDF 由 close() / weakref.finalize 刪除 (換新上傳檔或物件被回收時)，
+#    長時間執行的 Streamlit server 不再每份上傳留一份副本到程序結束。
+
+import io
+import os
+import hashlib
+import logging
+import tempfile
+import threading
+import weakref
+from typing import List, Optional, Tuple
+
+import numpy as np
+from pypdf import PdfReader, PdfWriter
+
+import config
+from utils.raster_cache import RasterCache, get_raster_cache
+
+logger = logging.getLogger(__name__)
+
+
+def _remove_file(path: str) -> None:
+    try: os.remove(path)
+    except OSError: pass
+
+
+class RenderError(RuntimeError):
+    """Rasterizing the upload failed (poppler missing, corrupt PDF, ...)."""
+
+
+class PdfPageSource:
+    """
+    Page-indexed view over the original exam upload.
+    Student `idx` owns pages [idx * pages_per_chunk + 1, (idx + 1) * pages_per_chunk] (1-based, inclusive).
+    """
+
+    def __init__(self, pdf_bytes: bytes, pages_per_chunk: int, dpi: int = None, thread_count: int = None):
+        if hasattr(pdf_bytes, "getvalue"): pdf_bytes = pdf_bytes.getvalue()
+        self.pdf_bytes = pdf_bytes
+        self.pages_per_chunk = max(1, int(pages_per_chunk))
+        self.dpi = int(dpi or getattr(config, "RASTER_DPI", 200))
+        self.thread_count = int(thread_count or getattr(config, "RASTER_THREADS", 0) or min(4, os.cpu_count() or 1))
+        self.digest = hashlib.sha256(pdf_bytes).hexdigest()
+        self.page_count = len(PdfReader(io.BytesIO(pdf_bytes)).pages)
+        self._reader = None
+        self._reader_lock = threading.Lock()
+        self._path = None
+        self._path_cleanup = None
+        self._path_lock = threading.Lock()
+        self._trim_cache()
+
+    # ------------------------------------------------------------------
+    # Indexing
+    # ------------------------------------------------------------------
+    def __len__(self) -> int:
+        return (self.page_count + self.pages_per_chunk - 1) // self.pages_per_chunk
+
+    def page_range(self, idx: int) -> Tuple[int, int]:
+        first = idx * self.pages_per_chunk + 1
+        last = min(self.page_count, first + self.pages_per_chunk - 1)
+        return first, last
+
+    def _cache_key(self, colorspace: str) -> str:
+        return RasterCache.make_key(self.digest, self.dpi, colorspace)
+
+    def _trim_cache(self) -> None:
+        """One LRU pass per upload, off the render path; this upload's pages are kept."""
+        cache = get_raster_cache()
+        if cache is None: return
+        keep = [self._cache_key(cs) for cs in ("RGB", "L")]
+        threading.Thread(target=cache.evict, kwargs={"keep": keep}, name="raster-cache-evict", daemon=True).start()
+
+    # ------------------------------------------------------------------
+    # Rendering
+    # ------------------------------------------------------------------
+    def _source_path(self) -> str:
+        """pdf2image.convert_from_bytes 每次都會把整份 PDF 寫到暫存檔；這裡只寫一次。"""
+        with self._path_lock:
+            if self._path is None or not os.path.exists(self._path):
+                fd, path = tempfile.mkstemp(suffix=".pdf", prefix="exam_src_")
+                with os.fdopen(fd, "wb") as f: f.write(self.pdf_bytes)
+                self._path = path
+                # 物件被回收或程序結束時刪除 (finalize 預設也在 atexit 執行)
+                self._path_cleanup = weakref.finalize(self, _remove_file, path)
+            return self._path
+
+    def close(self) -> None:
+        """Deletes the temporary copy of the upload (rendering again writes a new one)."""
+        with self._path_lock:
+            if self._path_cleanup is not None: self._path_cleanup()
+            self._path, self._path_cleanup = None, None
+
+    def _convert(self, first: int, last: int, colorspace: str) -> List[np.ndarray]:
+        from pdf2image import convert_from_path
+        imgs = convert_from_path(
+            self._source_path(), dpi=self.dpi, first_page=first, last_page=last,
+            thread_count=self.thread_count, grayscale=(colorspace == "L")
+        )
+        return [np.asarray(img.convert(colorspace)) for img in imgs]
+
+    def render_pages(self, first: int, last: int, colorspace: str = "RGB", prefetch_to: Optional[int] = None) -> List[np.ndarray]:
+        """
+        Renders pages [first, last] (1-based). Cached pages come back memory-mapped.
+        With a raster cache, misses are rendered in ONE poppler call that may run ahead
+        to `prefetch_to` so the following students are served from disk.
+        """
+        first = max(1, first); last = min(self.page_count, last)
+        if last < first: return []
+        cache = get_raster_cache()
+        if cache is None:
+            return self._convert(first, last, colorspace)
+
+        key = self._cache_key(colorspace)
+        pages = {p: cache.get_page(key, p) for p in range(first, last + 1)}
+        missing = [p for p, arr in pages.items() if arr is None]
+        if missing:
+            span_last = max(missing[-1], min(self.page_count, prefetch_to or last))
+            rendered = self._convert(missing[0], span_last, colorspace)
+            for offset, arr in enumerate(rendered):
+                p = missing[0] + offset
+                cache.put_page(key, p, arr, evict=False)
+                if p in pages and pages[p] is None: pages[p] = arr
+        return [pages[p] for p in range(first, last + 1) if pages[p] is not None]
+
+    def student_pages(self, idx: int, colorspace: str = "RGB", prefetch_students: int = 0) -> List[np.ndarray]:
+        first, last = self.page_range(idx)
+        prefetch_to = last + prefetch_students * self.pages_per_chunk if prefetch_students else None
+        try:
+            return self.render_pages(first, last, colorspace, prefetch_to=prefetch_to)
+        except Exception as e:
+            logger.error(f"Render pages {first}-{last} failed (Check poppler): {e}")
+            raise RenderError(f"Render pages {first}-{last} failed (Check poppler): {e}") from e
+
+    def iter_students(self, max_pages_in_flight: int = 16):
+        """依序 yield (idx, RGB arrays)；背景預先轉圖，並以一次 poppler 呼叫預先寫入後續學生的快取。轉圖失敗時拋出 RenderError。"""
+        from utils.helpers import iter_prefetched
+        prefetch = max(0, self.thread_count - 1)
+        return iter_prefetched(len(self), lambda i: self.student_pages(i, prefetch_students=prefetch), max_pages_in_flight)
+
+    # ------------------------------------------------------------------
+    # On-demand PDF (歸檔 / 預覽)
+    # ------------------------------------------------------------------
+    def student_pdf_bytes(self, idx: int) -> bytes:
+        first, last = self.page_range(idx)
+        if first == 1 and last == self.page_count: return self.pdf_bytes
+        with self._reader_lock:
+            if self._reader is None: self._reader = PdfReader(io.BytesIO(self.pdf_bytes))
+            writer = PdfWriter()
+            for page_num in range(first - 1, last):
+                writer.add_page(self._reader.pages[page_num])
+            output_stream = io.BytesIO()
+            writer.write(output_stream)
+        return output_stream.getvalue()
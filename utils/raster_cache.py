@@ -0,0 +1,161 @@
+# Copyright (c) 2026 [謝忠村/Chung Tsun Shieh]. All Rights Reserved.
+# This software is proprietary and confidential.
+# Unauthorized copying of this file, via any medium is strictly prohibited.
+
+# utils/raster_cache.py
+# -*- coding: utf-8 -*-
+# Module-Version: v2026.02.05-Raster-Cache
+# Description: 
+# 1. [Perf] PDF rasterization 的磁碟快取，Key = (sha256(pdf bytes), dpi, colorspace)。
+# 2. [Perf] 每頁存成 .npy，讀取時以 mmap 開啟 (不複製整頁)。
+# 3. [Safety] 依總容量做 LRU 淘汰；寫入採 temp file + rename，多執行緒安全。
+# 4. [New] get_page / put_page：以「整份上傳檔」為 key 的逐頁快取 (PdfPageSource 使用)。
+# 5. [Fix] LRU 改為逐頁淘汰 (每個頁檔的 mtime 即 LRU 時鐘)，evict(keep=...) 不會動到正在寫入的 key；
+#    三個色版完全相同的 RGB 頁 (灰階掃描) 只存一個色版 (.gray.npy，約 1/3 容量，讀取時還原成 RGB)。
+# 6. [Logic] 移除整檔 get / put (pdf_to_arrays 專用)，只保留逐頁 entry 與單一 key 格式 (make_key)。
+
+import os
+import shutil
+import logging
+import threading
+import uuid
+from typing import Iterable, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class RasterCache:
+    """
+    Disk-backed cache of rendered PDF pages.
+    Layout: <root>/<sha256>_<dpi>_<colorspace>_pages/page_0001.npy ... (page_0001.gray.npy for grayscale RGB pages)
+    Every page file's mtime is bumped on a hit and used as the LRU clock; eviction drops single pages.
+    """
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = int(max_bytes)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        try:
+            os.makedirs(self.root, exist_ok=True)
+        except Exception as e:
+            logger.error(f"Raster cache dir unavailable ({self.root}): {e}")
+
+    @staticmethod
+    def make_key(digest: str, dpi: int, colorspace: str) -> str:
+        """Entry of one upload: sha256 of the PDF bytes, render DPI and colorspace."""
+        # "_pages" 後綴：舊版整檔 entry (page_0000 起算) 留在磁碟上也不會被當成逐頁 entry 讀到，之後由 LRU 淘汰
+        return f"{digest}_{int(dpi)}_{colorspace}_pages"
+
+    def _entry_dir(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    @staticmethod
+    def _page_paths(entry: str, page_no: int):
+        base = os.path.join(entry, f"page_{int(page_no):04d}")
+        return base + ".npy", base + ".gray.npy"
+
+    @staticmethod
+    def _is_gray_rgb(arr: np.ndarray) -> bool:
+        return arr.ndim == 3 and arr.shape[2] == 3 and \
+            bool(np.array_equal(arr[..., 0], arr[..., 1]) and np.array_equal(arr[..., 0], arr[..., 2]))
+
+    def get_page(self, key: str, page_no: int) -> Optional[np.ndarray]:
+        """Single page of a page-indexed entry (see PdfPageSource). page_no is 1-based."""
+        path, gray_path = self._page_paths(self._entry_dir(key), page_no)
+        try:
+            try:
+                arr = np.load(path, mmap_mode="r")
+            except FileNotFoundError:
+                path = gray_path
+                gray = np.load(path, mmap_mode="r")
+                arr = np.empty(gray.shape + (3,), gray.dtype)
+                arr[...] = gray[..., None]
+            os.utime(path, None)
+        except FileNotFoundError:
+            with self._lock: self.misses += 1
+            return None
+        except Exception as e:
+            logger.warning(f"Raster cache page broken, dropping {key}#{page_no}: {e}")
+            try: os.remove(path)
+            except OSError: pass
+            with self._lock: self.misses += 1
+            return None
+        with self._lock: self.hits += 1
+        return arr
+
+    def put_page(self, key: str, page_no: int, arr: np.ndarray, evict: bool = True) -> None:
+        entry = self._entry_dir(key)
+        path, gray_path = self._page_paths(entry, page_no)
+        if os.path.exists(path) or os.path.exists(gray_path): return
+        if self._is_gray_rgb(arr):
+            # 灰階掃描轉出的 RGB 頁：三個色版相同，只存一個 (無損，約 1/3 容量)
+            arr, path = arr[..., 0], gray_path
+        tmp = os.path.join(entry, f".tmp_{uuid.uuid4().hex}.npy")
+        try:
+            os.makedirs(entry, exist_ok=True)
+            np.save(tmp, np.ascontiguousarray(arr))
+            os.replace(tmp, path)
+        except Exception as e:
+            logger.warning(f"Raster cache page write failed ({key}#{page_no}): {e}")
+            try: os.remove(tmp)
+            except OSError: pass
+            return
+        if evict: self.evict(keep=(key,))
+
+    def evict(self, keep: Iterable[str] = ()) -> int:
+        """
+        Drops least-recently-used pages until the cache fits in max_bytes. Returns bytes freed.
+        Pages of the `keep` keys (entries being filled / read) count toward the total but are never dropped.
+        """
+        keep = {self._entry_dir(k) for k in keep}
+        with self._lock:
+            try:
+                entries = [os.path.join(self.root, n) for n in os.listdir(self.root) if not n.startswith(".tmp_")]
+            except OSError:
+                return 0
+            total, pages, emptied = 0, [], set()
+            for e in entries:
+                try: names = os.listdir(e)
+                except OSError: continue
+                for n in names:
+                    path = os.path.join(e, n)
+                    try: st = os.stat(path)
+                    except OSError: continue
+                    total += st.st_size
+                    if e not in keep and not n.startswith(".tmp_"):
+                        pages.append((st.st_mtime, path, st.st_size, e))
+            freed = 0
+            for _, path, size, e in sorted(pages):
+                if total <= self.max_bytes: break
+                try: os.remove(path)
+                except OSError: continue
+                total -= size; freed += size
+                emptied.add(e)
+            for e in emptied:
+                try: os.rmdir(e)  # 只有整個 entry 都淘汰完才會成功
+                except OSError: pass
+            return freed
+
+    def clear(self) -> None:
+        with self._lock:
+            shutil.rmtree(self.root, ignore_errors=True)
+            os.makedirs(self.root, exist_ok=True)
+
+
+_default_cache = None
+_default_lock = threading.Lock()
+
+def get_raster_cache() -> Optional[RasterCache]:
+    """Process-wide cache configured from config.RASTER_CACHE_DIR / RASTER_CACHE_MAX_MB (None = disabled)."""
+    global _default_cache
+    with _default_lock:
+        if _default_cache is None:
+            import config
+            max_mb = getattr(config, "RASTER_CACHE_MAX_MB", 0)
+            if not max_mb or max_mb <= 0: return None
+            _default_cache = RasterCache(config.RASTER_CACHE_DIR, max_mb * 1024 * 1024)
+        return _default_cache